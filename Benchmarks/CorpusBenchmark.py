@@ -0,0 +1,357 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import contextlib
+import importlib.util
+from xml.sax.saxutils import escape
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'Scripts'))
+
+from DataManipulator import DataManipulator  # noqa: E402
+from DialogueDataStructurer import (DialogueDataStructurer, ClassificationCache, SegmentType,  # noqa: E402
+                                    classification_cache)
+
+
+MEDIAWIKI_NAMESPACE = "http://www.mediawiki.org/xml/export-0.11/"
+# Benchmarks that compare every quest against every chapter file only run at 1x
+QUADRATIC_BENCHMARKS = {'chapter_matching'}
+# Benchmarks reading the Quests folder tree as it is, scaling the in-memory corpus does not change them
+TREE_BENCHMARKS = {'directory_load', 'directory_load_serial'}
+# Optional dependencies, benchmarks are recorded as skipped when they are not installed
+REQUIRED_MODULES = {'parse_text': 'wikitextparser', 'chapter_matching': 'fuzzywuzzy'}
+
+
+class CorpusBenchmark:
+    """
+    Reproducible timings of the processing steps on the bundled Quests corpus, scaled up by replication.
+    """
+
+    def __init__(self, quests_root=os.path.join(REPO_DIR, 'Quests'), scales=(1, 10, 100), repeat=3):
+        self.quests_root = quests_root
+        self.chapter_folder = os.path.join(quests_root, 'ManuallyTaggedbyChapterType')
+        self.scales = scales
+        self.repeat = repeat
+        self.work_dir = tempfile.mkdtemp(prefix='questgen_benchmark_')
+        self.corpus = self.load_corpus()
+
+    def load_corpus(self):
+        """Load every distinct structured quest from GroupedByComplexity."""
+        quests = {}
+        grouped_folder = os.path.join(self.quests_root, 'GroupedByComplexity')
+        for root, dirs, files in sorted(os.walk(grouped_folder)):
+            for file in sorted(files):
+                if file.endswith('.json'):
+                    with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                        quest = json.load(f)
+                    quests.setdefault(quest.get('Quest_ID') or quest.get('Quest_Name'), quest)
+        return list(quests.values())
+
+    @staticmethod
+    def scale_corpus(quests, scale):
+        """
+        Replicate the corpus. Copies are shallow and share their strings, only the top-level
+        identifiers differ, so 100x stays affordable in memory. The text repeats in every copy,
+        so hit rates of caches keyed by text are only meaningful at 1x.
+        """
+        scaled = []
+        for copy_index in range(scale):
+            for quest in quests:
+                copy = dict(quest)
+                copy.pop('Structured_Dialogue', None)
+                if copy_index:
+                    copy['Quest_ID'] = f"{quest.get('Quest_ID')}-{copy_index}"
+                    copy['Quest_Name'] = f"{quest.get('Quest_Name')} ({copy_index})"
+                scaled.append(copy)
+        return scaled
+
+    @staticmethod
+    def build_wikitext(quest):
+        memory_infobox = quest.get('MemoryInfobox') or {}
+        parts = ["{{Era|Memories|ACOD}}", "{{Memory Infobox"]
+        parts.extend(f"|{key} = {value}" for key, value in memory_infobox.items() if value is not None)
+        parts.append("}}")
+        parts.append(quest.get('General_Description') or '')
+        for key, value in quest.items():
+            if key.startswith('Section_') and isinstance(value, str):
+                parts.append(f"=={key[len('Section_'):].replace('_', ' ')}==")
+                parts.append(value)
+        return "\n".join(parts)
+
+    def generate_mediawiki_xml(self, quests, file_path):
+        """
+        Write a synthetic MediaWiki export with one page per quest.
+        :param quests: Quests to turn into pages.
+        :param file_path: Output XML path.
+        """
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(f'<mediawiki xmlns="{MEDIAWIKI_NAMESPACE}" version="0.11" xml:lang="en">\n')
+            for page_id, quest in enumerate(quests, start=1):
+                f.write("  <page>\n")
+                f.write(f"    <title>{escape(str(quest.get('Quest_Name', 'Unknown')))}</title>\n")
+                f.write("    <ns>0</ns>\n")
+                f.write(f"    <id>{page_id}</id>\n")
+                f.write("    <revision>\n")
+                f.write(f"      <id>{page_id}</id>\n")
+                f.write("      <timestamp>2024-01-01T00:00:00Z</timestamp>\n")
+                f.write("      <model>wikitext</model>\n")
+                f.write("      <format>text/x-wiki</format>\n")
+                f.write(f'      <text xml:space="preserve">{escape(self.build_wikitext(quest))}</text>\n')
+                f.write("    </revision>\n")
+                f.write("  </page>\n")
+            f.write("</mediawiki>\n")
+
+    @staticmethod
+    def copy_quests(quests):
+        return json.loads(json.dumps(quests))
+
+    def measure(self, run, setup=None):
+        """
+        Time a benchmark, setup runs before every repetition and is not timed.
+        :return: Dictionary with the median and minimum time in seconds.
+        """
+        timings = []
+        # Keep the progress output of the benchmarked methods out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for _ in range(self.repeat):
+                argument = setup() if setup else None
+                start = time.perf_counter()
+                run(argument)
+                timings.append(time.perf_counter() - start)
+        return {'median_seconds': statistics.median(timings), 'min_seconds': min(timings)}
+
+    @staticmethod
+    def manipulator_for(quests):
+        data_manipulator = DataManipulator()
+        data_manipulator.data = quests
+        return data_manipulator
+
+    def get_benchmarks(self, quests):
+        dialogue_lines = [line for quest in quests if quest.get('Section_Dialogue')
+                          for line in quest['Section_Dialogue'].split('\n')]
+        structured = self.copy_quests(quests)
+        json_path = os.path.join(self.work_dir, 'quests.json')
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            self.manipulator_for(structured).structure_dialogues()
+            self.manipulator_for(structured).save_json(json_path)
+        xml_path = os.path.join(self.work_dir, 'pages.xml')
+        self.generate_mediawiki_xml(quests, xml_path)
+
+        def identify_segment_type(cache):
+            structurer = DialogueDataStructurer(None, cache=cache)
+            for line in dialogue_lines:
+                structurer.identify_segment_type(line)
+
+        def process_dialogue(cache):
+            for quest in quests:
+                if quest.get('Section_Dialogue'):
+                    DialogueDataStructurer(quest, cache=cache).process_dialogue(quest.get('Quest_Name'),
+                                                                                quest['Section_Dialogue'])
+
+        def cold_cache():
+            # Every repetition starts with an empty shared classification cache
+            classification_cache.clear()
+            return classification_cache
+
+        def clean(data_manipulator):
+            data_manipulator.delete_replace_sanitize()
+            data_manipulator.replace_empty_string_with_none_in_memory_infobox()
+            data_manipulator.remove_null_key_values_in_memory_infobox()
+
+        tree_files = sum(file.endswith('.json') for _, _, files in os.walk(self.quests_root) for file in files)
+
+        def directory_load_serial(_):
+            for root, dirs, files in os.walk(self.quests_root):
+                for file in files:
+                    if file.endswith('.json'):
+                        with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                            json.load(f)
+
+        def directory_load(_):
+            from DirectoryLoader import DirectoryLoader
+            DirectoryLoader().load(self.quests_root)
+
+        def parse_text(_):
+            # parse_all_pages runs parse_text on every page of the synthetic dump
+            from XMLParser import XMLParser
+            XMLParser(xml_path).parse_all_pages()
+
+        return {
+            'parse_text': (parse_text, None, len(quests)),
+            'identify_segment_type': (identify_segment_type, cold_cache, len(dialogue_lines)),
+            'identify_segment_type_uncached': (identify_segment_type, None, len(dialogue_lines)),
+            'process_dialogue': (process_dialogue, cold_cache, len(dialogue_lines)),
+            'process_dialogue_uncached': (process_dialogue, None, len(dialogue_lines)),
+            'clean': (clean, lambda: self.manipulator_for(self.copy_quests(quests)), len(quests)),
+            'chapter_matching': (
+                lambda data_manipulator: data_manipulator.match_quests_that_with_inside_manual_chapter_folder(
+                    self.chapter_folder, progress_interval=len(quests)),
+                lambda: self.manipulator_for(self.copy_quests(quests)), len(quests)),
+            'categorize': (lambda _: self.manipulator_for(structured).categorize_quests(), None, len(quests)),
+            'csv_export': (lambda data_manipulator: data_manipulator.save_dialogues_to_csv1(
+                os.path.join(self.work_dir, 'dialogues.csv')),
+                lambda: self.manipulator_for(self.copy_quests(structured)), len(quests)),
+            'json_save': (lambda _: self.manipulator_for(structured).save_json(json_path), None, len(quests)),
+            'json_load': (lambda _: DataManipulator(json_path), None, len(quests)),
+            'directory_load': (directory_load, None, tree_files),
+            'directory_load_serial': (directory_load_serial, None, tree_files),
+        }
+
+    @staticmethod
+    def measure_cache_categories(quests):
+        """
+        Replay the dialogue lines of process_dialogue through an empty cache shaped like the shared one
+        and count the hits per kind of line, image and narrative lines are the long ones.
+        :return: Dictionary of category -> lines, lines short enough to be cached, hits and hit rate.
+        """
+        cache = ClassificationCache(classification_cache.max_size, classification_cache.max_line_length)
+        structurer = DialogueDataStructurer(None, cache=cache)
+        categories = {SegmentType.IMG_FILE: 'image', SegmentType.NARRATIVE: 'narrative'}
+        counts = {category: {'lines': 0, 'cacheable': 0, 'hits': 0} for category in ('image', 'narrative', 'other')}
+        for quest in quests:
+            section_dialogue = quest.get('Section_Dialogue')
+            if not section_dialogue:
+                continue
+            for start, end in structurer.scan_lines(section_dialogue):
+                hits = cache.lookup.cache_info().hits
+                segment_type = structurer.identify_segment_type(section_dialogue, start, end)
+                count = counts[categories.get(segment_type, 'other')]
+                count['lines'] += 1
+                count['cacheable'] += end - start <= cache.max_line_length
+                count['hits'] += cache.lookup.cache_info().hits - hits
+        for count in counts.values():
+            count['hit_rate'] = count['hits'] / count['lines'] if count['lines'] else 0.0
+        return counts
+
+    @staticmethod
+    def measure_structured_memory(quests):
+        """
+        Compare the traced memory of the structured dialogue as dictionaries and as compact Segment objects.
+        :return: Dictionary with the bytes of both representations and their ratio.
+        """
+        sizes = {}
+        for compact in (False, True):
+            tracemalloc.start()
+            structurer = DialogueDataStructurer(None)
+            structured = [structurer.process_segments(quest.get('Quest_Name'), quest['Section_Dialogue']) if compact
+                          else structurer.process_dialogue(quest.get('Quest_Name'), quest['Section_Dialogue'])
+                          for quest in quests if quest.get('Section_Dialogue')]
+            sizes['compact_bytes' if compact else 'dict_bytes'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del structured
+        sizes['ratio'] = sizes['dict_bytes'] / sizes['compact_bytes'] if sizes['compact_bytes'] else 0.0
+        return sizes
+
+    def run(self, only=None):
+        """
+        Run every benchmark at every scale.
+        :param only: Optional list of benchmark names to run.
+        :return: Results dictionary with environment details.
+        """
+        results = {'environment': self.get_environment(), 'corpus_quests': len(self.corpus), 'benchmarks': {},
+                   'memory': {}, 'classification_cache': {}}
+        try:
+            for scale in self.scales:
+                quests = self.scale_corpus(self.corpus, scale)
+                if not only or 'structured_memory' in only:
+                    memory = self.measure_structured_memory(quests)
+                    results['memory'][f"structured_dialogue@{scale}x"] = memory
+                    print(f"structured_dialogue@{scale}x: {memory['dict_bytes']} bytes as dictionaries, "
+                          f"{memory['compact_bytes']} bytes as segments (x{memory['ratio']:.1f})")
+                if (not only or 'classification_cache' in only) and scale == 1:
+                    # The scaled corpora repeat the 1x corpus, every line of a copy would count as a hit
+                    categories = self.measure_cache_categories(quests)
+                    results['classification_cache'][f"lines@{scale}x"] = categories
+                    print(f"classification_cache@{scale}x: " + ", ".join(
+                        f"{category} {count['hits']}/{count['lines']} hits ({count['hit_rate']:.0%})"
+                        for category, count in categories.items()))
+                for name, (run, setup, items) in self.get_benchmarks(quests).items():
+                    if only and name not in only:
+                        continue
+                    key = f"{name}@{scale}x"
+                    if name in QUADRATIC_BENCHMARKS and scale != 1:
+                        results['benchmarks'][key] = {'skipped': 'quadratic benchmark, only run at 1x'}
+                        continue
+                    if name in TREE_BENCHMARKS and scale != 1:
+                        results['benchmarks'][key] = {'skipped': 'reads the Quests tree, only run at 1x'}
+                        continue
+                    module = REQUIRED_MODULES.get(name)
+                    if module and importlib.util.find_spec(module) is None:
+                        results['benchmarks'][key] = {'skipped': f"missing dependency: {module}"}
+                        continue
+                    measurement = self.measure(run, setup)
+                    if setup is not None and run.__name__ in ('identify_segment_type', 'process_dialogue'):
+                        measurement['classification_cache'] = classification_cache.get_statistics()
+                    measurement['items'] = items
+                    measurement['items_per_second'] = items / measurement['median_seconds'] \
+                        if measurement['median_seconds'] else 0.0
+                    results['benchmarks'][key] = measurement
+                    print(f"{key}: {measurement['median_seconds']:.4f}s ({items} items)")
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return results
+
+    @staticmethod
+    def get_environment():
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                                    text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = 'unknown'
+        return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform()}
+
+
+def save_results(results, output_folder=os.path.join(BENCHMARKS_DIR, 'results')):
+    os.makedirs(output_folder, exist_ok=True)
+    file_path = os.path.join(output_folder, f"benchmark_{results['environment']['commit']}.json")
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f"Saved benchmark results to {file_path}")
+    return file_path
+
+
+def compare_results(baseline, current, tolerance=0.1):
+    """
+    Compare two result dictionaries.
+    :param tolerance: Relative slowdown that counts as a regression.
+    :return: Dictionary mapping benchmark keys to current/baseline time ratios, regressions are printed.
+    """
+    ratios = {}
+    for key, measurement in current['benchmarks'].items():
+        previous = baseline['benchmarks'].get(key)
+        if not previous or 'median_seconds' not in previous or 'median_seconds' not in measurement:
+            continue
+        ratios[key] = measurement['median_seconds'] / previous['median_seconds']
+        marker = "REGRESSION" if ratios[key] > 1 + tolerance else ""
+        print(f"{key}: {previous['median_seconds']:.4f}s -> {measurement['median_seconds']:.4f}s "
+              f"(x{ratios[key]:.2f}) {marker}")
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the quest processing steps on the Quests corpus.")
+    parser.add_argument('--scales', type=int, nargs='*', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help="Benchmark names to run.")
+    parser.add_argument('--compare', help="Results JSON of an earlier commit to compare against.")
+    args = parser.parse_args(argv)
+
+    results = CorpusBenchmark(scales=args.scales, repeat=args.repeat).run(args.only)
+    save_results(results)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts')
+
+# Measured in a fresh interpreter, so the numbers include everything the import pulls in
+IMPORT_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in ('wikitextparser', 'fuzzywuzzy', 'msilib') if name in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy_modules': heavy}}))
+"""
+
+MODULES = ['DialogueDataStructurer', 'DataManipulator', 'XMLParser']
+MAX_IMPORT_SECONDS = {'DialogueDataStructurer': 0.1}
+
+
+def measure_import(module, runs=5):
+    """
+    Import a module in fresh interpreters and return the median import time.
+    :param module: Module name inside Scripts/.
+    :param runs: Number of interpreter launches.
+    :return: Dictionary with the median time in seconds and heavy modules loaded by the import.
+    """
+    timings = []
+    heavy_modules = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET.format(module=module)], cwd=SCRIPTS_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        heavy_modules = result['heavy_modules']
+    return {'median_seconds': statistics.median(timings), 'heavy_modules': heavy_modules}
+
+
+def run_startup_benchmark(runs=5):
+    results = {module: measure_import(module, runs) for module in MODULES}
+    print(json.dumps(results, indent=4))
+
+    failures = []
+    for module, result in results.items():
+        if result['heavy_modules']:
+            failures.append(f"{module} imports {result['heavy_modules']} at import time")
+    # The time budget is only checked on Linux workers, other platforms report the numbers only
+    if sys.platform.startswith('linux'):
+        for module, limit in MAX_IMPORT_SECONDS.items():
+            if results[module]['median_seconds'] > limit:
+                failures.append(f"{module} took {results[module]['median_seconds']:.3f}s to import, limit {limit}s")
+
+    assert not failures, "; ".join(failures)
+    return results
+
+
+if __name__ == "__main__":
+    run_startup_benchmark()
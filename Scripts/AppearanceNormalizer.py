@@ -0,0 +1,112 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+
+ODYSSEY = "Assassin's Creed: Odyssey"
+VALHALLA = "Assassin's Creed: Valhalla"
+
+# Separators between game and expansion: spaced hyphen, en dash or em dash, or a run of spaces left
+# behind when a dash was stripped during sanitizing
+separator_pattern = re.compile(r"\s+[-–—]\s+|\s{2,}")
+link_pattern = re.compile(r"\[\[([^\]|]*)(?:\|[^\]]*)?\]\]")
+# Standalone releases listed in appearance fields that belong to a game
+expansion_games = {
+    "discovery tour: viking age": VALHALLA,
+    "discovery tour: ancient greece": ODYSSEY,
+}
+ANY_EXPANSION = object()
+
+
+def clean_title(part):
+    """
+    Resolve links to their target page, drop the italic quote marks around a title and fix spacing.
+    Sanitizing strips the brackets of a link but keeps its label, the label after '|' is dropped too.
+    """
+    part = link_pattern.sub(r"\1", part).split('|', 1)[0]
+    part = unicodedata.normalize('NFKC', part).replace('’', "'")
+    return " ".join(part.strip().strip("'").split())
+
+
+@lru_cache(maxsize=4096)
+def normalize_appearance(appearance):
+    """
+    Parse a raw or sanitized appearance value into a canonical (game, expansion) tuple, e.g.
+    "''[[Assassin's Creed: Odyssey]]'' – ''[[Legacy of the First Blade: Hunted]]''" and
+    "'Assassin's Creed: Odyssey - Legacy of the First Blade: Hunted'" both become
+    ("Assassin's Creed: Odyssey", "Legacy of the First Blade: Hunted").
+    :param appearance: Appearance value of a MemoryInfobox.
+    :return: Tuple (game, expansion), expansion is None for the base game. (None, None) if empty.
+    """
+    if not isinstance(appearance, str):
+        return None, None
+    # The quote marks may wrap the whole value or each title, split on the raw text and clean each part
+    parts = [clean_title(part) for part in separator_pattern.split(appearance.strip())]
+    parts = [part for part in parts if part]
+    if not parts:
+        return None, None
+
+    game = parts[0]
+    if game.lower() in expansion_games:
+        return expansion_games[game.lower()], game
+    expansion = " – ".join(parts[1:]) or None
+    return game, expansion
+
+
+class AppearanceIndex:
+    """
+    Positions of the quests per canonical game and per (game, expansion), so splitting by game or DLC
+    is a dictionary lookup instead of matching every formatting variant of the appearance field.
+    """
+
+    def __init__(self):
+        self.games = {}
+        self.expansions = {}
+        self.size = 0
+
+    def build(self, data):
+        self.games = {}
+        self.expansions = {}
+        for position, quest in enumerate(data):
+            game, expansion = normalize_appearance((quest.get('MemoryInfobox') or {}).get('appearance'))
+            self.games.setdefault(game, []).append(position)
+            self.expansions.setdefault((game, expansion), []).append(position)
+        self.size = len(data)
+        return self
+
+    def get_positions(self, game, expansion=ANY_EXPANSION):
+        """
+        :param game: Canonical game name, e.g. AppearanceNormalizer.ODYSSEY.
+        :param expansion: Canonical expansion name, None for the base game only, or ANY_EXPANSION.
+        """
+        if expansion is ANY_EXPANSION:
+            return self.games.get(game, [])
+        return self.expansions.get((game, expansion), [])
+
+    def get_counts(self):
+        """Number of quests per (game, expansion), most common first."""
+        counts = {key: len(positions) for key, positions in self.expansions.items()}
+        return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+
+if __name__ == "__main__":
+    from DataManipulator import odyssey_apperances, valhalla_apperances
+
+    # Raw variants and the sanitized values they become, each must map to its canonical tuple
+    expected = {
+        "''[[Assassin's Creed: Odyssey]]'' – ''[[Legacy of the First Blade: Hunted]]''":
+            (ODYSSEY, "Legacy of the First Blade: Hunted"),
+        "'Assassin's Creed: Odyssey - Legacy of the First Blade: Hunted'": (ODYSSEY, "Legacy of the First Blade: Hunted"),
+        "''[[Assassin's Creed: Valhalla]] – [[Mastery Challenge|Mastery Challenge: The Reckoning]]''":
+            (VALHALLA, "Mastery Challenge"),
+        "'Assassin's Creed: Odyssey' – Mastery Challenge|Mastery Challenge: The Reckoning'": (ODYSSEY, "Mastery Challenge"),
+        "''[[Discovery Tour: Viking Age]]''": (VALHALLA, "Discovery Tour: Viking Age"),
+        "'Assassin's Creed: Valhalla'": (VALHALLA, None),
+    }
+    for appearance, result in expected.items():
+        assert normalize_appearance(appearance) == result, (appearance, normalize_appearance(appearance))
+    for game, appearances in ((ODYSSEY, odyssey_apperances), (VALHALLA, valhalla_apperances)):
+        for appearance in appearances:
+            assert normalize_appearance(appearance)[0] == game, (appearance, normalize_appearance(appearance))
+            assert '|' not in (normalize_appearance(appearance)[1] or ''), appearance
+    print(f"{len(expected) + len(odyssey_apperances) + len(valhalla_apperances)} appearance values normalized")
@@ -0,0 +1,234 @@
+import json
+from array import array
+from collections import defaultdict
+
+from DialogueDataStructurer import SegmentType, extract_speaker_and_text
+from QuestQuery import get_quest_key
+
+
+class CharacterIndex:
+    """
+    Speaker index and character interaction graph built in one pass over Structured_Dialogue.
+    Speakers and quests get integer ids, postings are (quest id, global id) arrays per speaker and
+    the interaction graph is stored as CSR arrays (offsets, neighbours, weights) once finalized.
+    """
+
+    def __init__(self):
+        self.speaker_names = []
+        self.speaker_ids = {}
+        self.quest_keys = []
+        self.quest_ids = {}
+        self.posting_quests = []  # speaker id -> array of quest ids
+        self.posting_segments = []  # speaker id -> array of global ids
+        self.pending_edges = defaultdict(int)  # (speaker id, speaker id) -> exchanged turns
+        self.offsets = array('I', [0])
+        self.neighbours = array('I')
+        self.weights = array('I')
+
+    def get_speaker_id(self, speaker, create=False):
+        speaker_id = self.speaker_ids.get(speaker)
+        if speaker_id is None and create:
+            speaker_id = len(self.speaker_names)
+            self.speaker_ids[speaker] = speaker_id
+            self.speaker_names.append(speaker)
+            self.posting_quests.append(array('I'))
+            self.posting_segments.append(array('I'))
+        return speaker_id
+
+    def add_quest(self, quest):
+        """
+        Add the dialogue lines of a quest, a quest already in the index is replaced.
+        Call finalize() after adding quests to rebuild the graph.
+        :param quest: Quest dictionary with 'Structured_Dialogue'.
+        """
+        quest_key = get_quest_key(quest)
+        quest_id = self.quest_ids.get(quest_key)
+        if quest_id is not None:
+            self.remove_quest(quest_key)
+        else:
+            quest_id = len(self.quest_keys)
+            self.quest_ids[quest_key] = quest_id
+            self.quest_keys.append(quest_key)
+
+        previous_speaker_id = None
+        for segment in quest.get('Structured_Dialogue') or []:
+            if segment['segment_type'] != SegmentType.DIALOGUE.value:
+                continue
+            speaker, _ = extract_speaker_and_text(segment['content'])
+            if not speaker:
+                continue
+            speaker_id = self.get_speaker_id(speaker, create=True)
+            self.posting_quests[speaker_id].append(quest_id)
+            self.posting_segments[speaker_id].append(int(segment['global_id']))
+
+            # A turn exchange is a dialogue line directly answering a different speaker
+            if previous_speaker_id is not None and previous_speaker_id != speaker_id:
+                edge = (min(previous_speaker_id, speaker_id), max(previous_speaker_id, speaker_id))
+                self.pending_edges[edge] += 1
+            previous_speaker_id = speaker_id
+
+    def remove_quest(self, quest_key):
+        """
+        Remove the lines of a quest and take its turn exchanges off the graph, applied by the next finalize().
+        :return: True if the quest was in the index.
+        """
+        quest_id = self.quest_ids.get(quest_key)
+        if quest_id is None:
+            return False
+        lines = []
+        for speaker_id, (quest_ids, global_ids) in enumerate(zip(self.posting_quests, self.posting_segments)):
+            if quest_id not in quest_ids:
+                continue
+            kept = [(posting_quest_id, global_id) for posting_quest_id, global_id in zip(quest_ids, global_ids)
+                    if posting_quest_id != quest_id]
+            lines.extend((global_id, speaker_id) for posting_quest_id, global_id in zip(quest_ids, global_ids)
+                         if posting_quest_id == quest_id)
+            self.posting_quests[speaker_id] = array('I', (posting_quest_id for posting_quest_id, _ in kept))
+            self.posting_segments[speaker_id] = array('I', (global_id for _, global_id in kept))
+
+        # The postings keep the order of the lines, so the exchanges added for the quest can be replayed
+        previous_speaker_id = None
+        for _, speaker_id in sorted(lines):
+            if previous_speaker_id is not None and previous_speaker_id != speaker_id:
+                edge = (min(previous_speaker_id, speaker_id), max(previous_speaker_id, speaker_id))
+                self.pending_edges[edge] -= 1
+            previous_speaker_id = speaker_id
+        return True
+
+    def build(self, data):
+        """
+        Build the index from a list of quests, e.g. DataManipulator.data.
+        :return: The index itself.
+        """
+        for quest in data:
+            self.add_quest(quest)
+        self.finalize()
+        return self
+
+    def finalize(self):
+        """Merge pending turn exchanges into the compact CSR adjacency arrays."""
+        edges = defaultdict(int)
+        for speaker_id in range(len(self.offsets) - 1):
+            for position in range(self.offsets[speaker_id], self.offsets[speaker_id + 1]):
+                neighbour_id = self.neighbours[position]
+                if speaker_id < neighbour_id:
+                    edges[(speaker_id, neighbour_id)] += self.weights[position]
+        for edge, weight in self.pending_edges.items():
+            edges[edge] += weight
+        self.pending_edges.clear()
+
+        adjacency = [[] for _ in self.speaker_names]
+        for (speaker_a, speaker_b), weight in edges.items():
+            if weight <= 0:  # Every exchange of the edge belonged to removed quests
+                continue
+            adjacency[speaker_a].append((speaker_b, weight))
+            adjacency[speaker_b].append((speaker_a, weight))
+
+        self.offsets = array('I', [0])
+        self.neighbours = array('I')
+        self.weights = array('I')
+        for neighbours in adjacency:
+            neighbours.sort()
+            self.neighbours.extend(neighbour_id for neighbour_id, _ in neighbours)
+            self.weights.extend(weight for _, weight in neighbours)
+            self.offsets.append(len(self.neighbours))
+
+    def get_lines(self, speaker):
+        """
+        Return all lines of a speaker as (quest key, global id) tuples.
+        :param speaker: Speaker name as it appears in the dialogue.
+        """
+        speaker_id = self.get_speaker_id(speaker)
+        if speaker_id is None:
+            return []
+        return [(self.quest_keys[quest_id], global_id)
+                for quest_id, global_id in zip(self.posting_quests[speaker_id], self.posting_segments[speaker_id])]
+
+    def get_quests(self, speaker):
+        speaker_id = self.get_speaker_id(speaker)
+        if speaker_id is None:
+            return set()
+        return {self.quest_keys[quest_id] for quest_id in set(self.posting_quests[speaker_id])}
+
+    def get_line_counts(self):
+        """Return the number of lines per speaker, most talkative first."""
+        counts = {name: len(self.posting_quests[speaker_id]) for speaker_id, name in enumerate(self.speaker_names)}
+        return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+    def get_neighbours(self, speaker, limit=None):
+        """
+        Return the characters a speaker exchanged turns with, sorted by number of exchanges.
+        :return: List of (name, weight) tuples.
+        """
+        speaker_id = self.get_speaker_id(speaker)
+        if speaker_id is None or speaker_id + 1 >= len(self.offsets):
+            return []
+        start, end = self.offsets[speaker_id], self.offsets[speaker_id + 1]
+        neighbours = [(self.speaker_names[self.neighbours[position]], self.weights[position])
+                      for position in range(start, end)]
+        neighbours.sort(key=lambda item: item[1], reverse=True)
+        return neighbours[:limit]
+
+    def get_exchange_count(self, speaker_a, speaker_b):
+        speaker_a_id, speaker_b_id = self.get_speaker_id(speaker_a), self.get_speaker_id(speaker_b)
+        if speaker_a_id is None or speaker_b_id is None or speaker_a_id + 1 >= len(self.offsets):
+            return 0
+        for position in range(self.offsets[speaker_a_id], self.offsets[speaker_a_id + 1]):
+            if self.neighbours[position] == speaker_b_id:
+                return self.weights[position]
+        return 0
+
+    def slice_quests(self, data, speakers, require_all=False):
+        """
+        Yield the quests in which the given characters speak, without re-parsing any dialogue.
+        :param data: List of quests the index was built from.
+        :param speakers: Iterable of speaker names.
+        :param require_all: If True, every speaker has to appear in the quest.
+        """
+        quest_sets = [self.get_quests(speaker) for speaker in speakers]
+        if not quest_sets:
+            return
+        keys = set.intersection(*quest_sets) if require_all else set.union(*quest_sets)
+        for quest in data:
+            if get_quest_key(quest) in keys:
+                yield quest
+
+    def save(self, file_path):
+        if self.pending_edges:
+            self.finalize()
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'speaker_names': self.speaker_names,
+                'quest_keys': self.quest_keys,
+                'posting_quests': [postings.tolist() for postings in self.posting_quests],
+                'posting_segments': [postings.tolist() for postings in self.posting_segments],
+                'offsets': self.offsets.tolist(),
+                'neighbours': self.neighbours.tolist(),
+                'weights': self.weights.tolist(),
+            }, f)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+        index = cls()
+        index.speaker_names = stored['speaker_names']
+        index.speaker_ids = {name: speaker_id for speaker_id, name in enumerate(index.speaker_names)}
+        index.quest_keys = stored['quest_keys']
+        index.quest_ids = {quest_key: quest_id for quest_id, quest_key in enumerate(index.quest_keys)}
+        index.posting_quests = [array('I', postings) for postings in stored['posting_quests']]
+        index.posting_segments = [array('I', postings) for postings in stored['posting_segments']]
+        index.offsets = array('I', stored['offsets'])
+        index.neighbours = array('I', stored['neighbours'])
+        index.weights = array('I', stored['weights'])
+        return index
+
+
+if __name__ == "__main__":
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator("OdysseyChapterAndSequenceStructuredDialogue.json")
+    character_index = CharacterIndex().build(data_manipulator.data)
+    character_index.save("character_index.json")
+    print(list(character_index.get_line_counts().items())[:20])
+    print(character_index.get_neighbours("Kassandra", limit=20))
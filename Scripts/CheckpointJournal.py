@@ -0,0 +1,114 @@
+import os
+import json
+
+from DialogueDataStructurer import serialize_segment
+from Metrics import metrics
+
+
+class CheckpointJournal:
+    """
+    Append-only JSON lines journal of the work items a long stage has finished, e.g.
+    {"key": "1234", "output": {...}} per parsed page or matched quest. Records are buffered and written
+    every checkpoint_interval items, so the interval trades I/O against the work lost by a crash.
+    With resume the finished items of an existing journal are loaded and the stage skips them, a record
+    torn by a crash while writing is dropped and overwritten.
+
+        with CheckpointJournal("parse.journal", stage='parse_all_pages', resume=True) as journal:
+            for key, item in work:
+                if not journal.is_done(key):
+                    journal.record(key, process(item))
+        journal.discard()  # Once the results of the stage are saved
+    """
+
+    def __init__(self, journal_path, stage, fingerprint=None, checkpoint_interval=100, resume=False):
+        """
+        :param stage: Name of the stage, a journal of another stage is not resumed.
+        :param fingerprint: JSON serializable identity of the inputs, e.g. [file size, mtime], a journal
+                            written for other inputs is started over.
+        :param checkpoint_interval: Number of records buffered before they are written and synced.
+        :param resume: Continue an existing journal, otherwise it is started over.
+        """
+        self.journal_path = journal_path
+        self.checkpoint_interval = max(1, checkpoint_interval)
+        self.header = {'stage': stage, 'fingerprint': fingerprint}
+        self.completed = {}
+        self.buffer = []
+        self.resumed_count = 0
+        if not resume and os.path.exists(journal_path):
+            os.remove(journal_path)
+        self.load()
+        self.file = open(journal_path, 'a', encoding='utf-8')
+        if self.file.tell() == 0:
+            self.file.write(json.dumps(self.header) + "\n")
+            self.file.flush()
+
+    def load(self):
+        if not os.path.exists(self.journal_path):
+            return
+        valid_size = 0
+        with open(self.journal_path, 'rb') as f:
+            for line_number, line in enumerate(f):
+                try:
+                    record = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    break  # Torn write, everything after it is rewritten
+                if line_number == 0:
+                    if record != self.header:
+                        print(f"{self.journal_path} belongs to {record.get('stage')} with other inputs, starting over")
+                        valid_size = 0
+                        break
+                else:
+                    self.completed[record['key']] = record['output']
+                valid_size += len(line)
+        if valid_size == 0:
+            self.completed = {}
+        with open(self.journal_path, 'r+b') as f:
+            f.truncate(valid_size)
+        self.resumed_count = len(self.completed)
+        if self.resumed_count:
+            print(f"Resuming from {self.journal_path}: {self.resumed_count} items already done")
+            metrics.increment('checkpoint.items_resumed', self.resumed_count)
+
+    def is_done(self, key):
+        return key in self.completed
+
+    def get_output(self, key):
+        return self.completed[key]
+
+    def record(self, key, output=None):
+        self.completed[key] = output
+        self.buffer.append(json.dumps({'key': key, 'output': output}, default=serialize_segment) + "\n")
+        if len(self.buffer) >= self.checkpoint_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer or self.file.closed:
+            return
+        self.file.write(''.join(self.buffer))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        metrics.increment('checkpoint.records_written', len(self.buffer))
+        metrics.increment('checkpoint.flushes')
+        self.buffer = []
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def discard(self):
+        """Delete the journal once the results of the stage are saved."""
+        self.buffer = []
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Also on Ctrl-C or an exception, so the finished items are not lost
+        self.close()
+        return False
@@ -1,27 +1,123 @@
-from calendar import c
-from itertools import count
 import json
-from enum import Enum
 import re
-import struct
-from fuzzywuzzy import fuzz
-
-from regex import P
-from DialogueDataStructurer import DialogueDataStructurer
+from DialogueDataStructurer import DialogueDataStructurer, extract_speaker_and_text, segment_to_dict, serialize_segment, \
+    speaker_pattern
+from Metrics import metrics
+from QuestQuery import Query, HashIndex, Field, Infobox
+from AppearanceNormalizer import AppearanceIndex, ANY_EXPANSION
+from WikitextRenderer import WikitextRenderer
+from QuestChainGraph import QuestChainGraph
+from SQLiteQuestStore import SQLiteQuestStore
+from CheckpointJournal import CheckpointJournal
 import os
 import csv
+import hashlib
 import logging
 
+# Dialogue text of the CSV export, everything after the speaker's colon to the end of the line
+csv_dialogue_pattern = re.compile(r"\*'''(.*?):'''\s*(.*)$")
+
+
 class DataManipulator:
     def __init__(self, json_file_path=None):
-        self.data = self.load_json(json_file_path) if json_file_path else []
-        self.dialogue_structurer = DialogueDataStructurer(self.data)
-        
+        self.store = None  # SQLiteQuestStore when the quests are backed by a database, see from_sqlite
+        self._data = self.load_json(json_file_path) if json_file_path else []
+        self.dialogue_structurer = DialogueDataStructurer(self._data)
+        self.indexes = {}  # path -> HashIndex used by query(), rebuilt by query() once quests changed
+        self.indexes_stale = False
+        self.appearance_index = None
+        self.quest_chain_graph = None
+        self.wikitext_renderer = WikitextRenderer()  # Memoizes rendered text across calls
+
+    def create_index(self, path):
+        """
+        Index a top-level key or dotted path like 'MemoryInfobox.appearance' for query().
+        :return: The HashIndex.
+        """
+        self.indexes[path] = HashIndex(path).build(self.data)
+        return self.indexes[path]
+
+    def invalidate_indexes(self):
+        """
+        Mark the indexes out of date after quests were changed in place, every method changing self.data calls it.
+        The query indexes are rebuilt by the next query(), the appearance index and chain graph when next used.
+        """
+        self.indexes_stale = True
+        self.appearance_index = None
+        self.quest_chain_graph = None
+
+    def query(self, predicate=None):
+        """
+        Start a lazy query over the quests, e.g.
+        self.query(Infobox('appearance') == appearance).select('Quest_Name').limit(5)
+        :param predicate: Optional predicate built from QuestQuery.Field, Infobox, HasSegmentType, ...
+        :return: Query, iterate it or call all(), first() or count().
+        """
+        if self.store is not None and self._data is None:
+            return self.store.query(predicate)
+        if self.indexes_stale:
+            for path in self.indexes:
+                self.indexes[path] = HashIndex(path).build(self.data)
+            self.indexes_stale = False
+        return Query(self.data, self.indexes, predicate)
+
+    @property
+    def data(self):
+        # With a SQLite store the quests are only read when a method needs the whole list
+        if self._data is None:
+            self._data = self.store.read_quests()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.invalidate_indexes()
+
+    def get_loaded_data(self):
+        """Quests already in memory, mutations of a store backed manipulator only update them if loaded."""
+        return self._data if self._data is not None else []
+
+    @classmethod
+    def from_sqlite(cls, db_path):
+        """
+        Open a database written by save_sqlite. query(), get_length(), get_quest_by_name() and the cleaning
+        mutations run as SQL until self.data is used, which reads every quest into memory once. The cleaning
+        mutations then update both, other changes to self.data are written back with save_sqlite.
+        """
+        data_manipulator = cls()
+        data_manipulator.store = SQLiteQuestStore(db_path)
+        data_manipulator._data = None
+        return data_manipulator
+
+    def save_sqlite(self, db_path):
+        """Write the quests to a SQLite database in one transaction and keep it as the store."""
+        store = SQLiteQuestStore(db_path)
+        store.write_quests(self.data)
+        if self.store is not None and self.store is not store:
+            self.store.close()
+        self.store = store
+        print(f"Saved {len(self.data)} quests to {db_path}")
+
+    @classmethod
+    def from_directory(cls, base_path, **loader_options):
+        """
+        Build a DataManipulator from a directory tree of per-quest JSON files, see DirectoryLoader.
+        :param base_path: Root folder, e.g. 'Quests/ManuallyTaggedbyChapterType'.
+        :param loader_options: DirectoryLoader options like max_concurrency, decode_processes or chapter_metadata=True
+                               for a chapter structured tree.
+        """
+        from DirectoryLoader import DirectoryLoader
+        return DirectoryLoader(**loader_options).load(base_path)
+
+    @metrics.timed()
     def load_json(self, json_file_path):
         # Load data from a JSON file
         with open(json_file_path, 'r', encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
+        metrics.add_items(len(data) if isinstance(data, list) else 1)
+        return data
 
+    @metrics.timed()
     def save_json(self, json_file_path):
         # Save data to a JSON file with null values removed at the first level
         cleaned_data = []
@@ -30,10 +126,14 @@ class DataManipulator:
             cleaned_data.append(cleaned_quest)
 
         with open(json_file_path, 'w', encoding="utf-8") as f:
-            json.dump(cleaned_data, f, indent=4)
+            json.dump(cleaned_data, f, indent=4, default=serialize_segment)
+            metrics.increment('bytes_written', f.tell())
+        metrics.add_items(len(cleaned_data))
 
     def get_quest_by_index(self, index):
         # Retrieve a quest by its index
+        if self.store is not None and self._data is None:
+            return self.store.read_quest(index) if 0 <= index < self.store.count() else None
         return self.data[index] if 0 <= index < len(self.data) else None
     
     def get_quests_by_index_range(self, start, end):
@@ -45,6 +145,8 @@ class DataManipulator:
     def get_length(self):
         
         # Get the number of quests in the dataset
+        if self.store is not None and self._data is None:
+            return self.store.count()
         return len(self.data)
     
     def sanitize_filename(self, name):
@@ -61,17 +163,15 @@ class DataManipulator:
     
     def get_dialogue_by_name(self, name):
         # Retrieve dialogue for a quest by its name
-        for quest in self.data:
-            if quest.get('Quest_Name') == name:
-                return quest.get('Section_Dialogue')
-        return None
+        quest = self.query(Field('Quest_Name') == name).first()
+        return quest.get('Section_Dialogue') if quest is not None else None
 
     def get_generic_value(self, index, key):
         """
         Retrieve a specific value from the generic level of a quest.
         """
         try:
-            quest = self.data[index]
+            quest = self.store.read_quest(index) if self.store is not None and self._data is None else self.data[index]
             return quest.get(key, "Key not found")
         except IndexError:
             return "Invalid index"
@@ -82,19 +182,69 @@ class DataManipulator:
         :param appearance: The appearance value to match.
         :return: List of quests with the specified appearance.
         """
-        matching_quests = []
-        for quest in self.data:
-            memory_infobox = quest.get('MemoryInfobox', {})
-            if memory_infobox.get('appearance') == appearance:
-                matching_quests.append(quest)
+        return self.query(Infobox('appearance') == appearance).all()
+
+    def get_appearance_index(self):
+        """Return the canonical game/expansion index, rebuilt when quests were added or removed."""
+        if self.appearance_index is None or self.appearance_index.size != len(self.data):
+            self.appearance_index = AppearanceIndex().build(self.data)
+        return self.appearance_index
+
+    def get_quest_chain_graph(self):
+        """Return the previous/next link graph, rebuilt when quests were added or removed."""
+        if self.quest_chain_graph is None or self.quest_chain_graph.size != len(self.data):
+            self.quest_chain_graph = QuestChainGraph().build(self.data)
+        return self.quest_chain_graph
+
+    def get_story_so_far(self, quest_name, max_depth=None):
+        """
+        The quests leading up to a quest, following the previous links back from the direct predecessor.
+        :param quest_name: Name of the quest.
+        :param max_depth: Maximum number of quests to walk back, all by default.
+        :return: List of quests, earliest first. Empty if the quest is unknown or starts a storyline.
+        """
+        graph = self.get_quest_chain_graph()
+        node = graph.get_node(quest_name=quest_name)
+        if node is None:
+            return []
+        return [self.data[graph.node_positions[previous]] for previous in graph.get_chain_before(node, max_depth)]
+
+    def get_quests_in_chain_order(self):
+        """Return the quests in the topological order of the previous/next links, each quest once."""
+        graph = self.get_quest_chain_graph()
+        return [self.data[graph.node_positions[node]] for node in graph.topological_order]
+
+    def get_quests_by_game(self, game, expansion=ANY_EXPANSION):
+        """
+        Get quests by canonical game and expansion, independent of how the appearance is formatted.
+        :param game: Canonical game name, e.g. AppearanceNormalizer.ODYSSEY.
+        :param expansion: Canonical expansion name, None for the base game only, or all expansions by default.
+        :return: List of quests.
+        """
+        return [self.data[position] for position in self.get_appearance_index().get_positions(game, expansion)]
+
+    def save_quests_by_game(self, game, output_file_path, expansion=ANY_EXPANSION):
+        """
+        Save the quests of a game, optionally of one expansion, to a JSON file.
+        :param game: Canonical game name.
+        :param output_file_path: Path to the output JSON file.
+        :param expansion: Canonical expansion name, None for the base game only, or all expansions by default.
+        """
+        matching_quests = self.get_quests_by_game(game, expansion)
+        with open(output_file_path, 'w', encoding="utf-8") as f:
+            json.dump(matching_quests, f, indent=4, default=serialize_segment)
         return matching_quests
 
     def add_feature_to_quest(self, index, key, value):
         """
         Add a new feature (key-value pair) to a quest at a generic level.
         """
+        self.invalidate_indexes()
         try:
-            self.data[index][key] = value
+            if self.store is not None:
+                self.store.set_value(index, key, value)
+            if self._data is not None:
+                self._data[index][key] = value
         except IndexError:
             return "Invalid index"
 
@@ -102,8 +252,12 @@ class DataManipulator:
         """
         Add a new feature (key-value pair) to a specific section of a quest.
         """
+        self.invalidate_indexes()
         try:
-            self.data[index][section][key] = value
+            if self.store is not None:
+                self.store.set_nested_value(index, section, key, value)
+            if self._data is not None:
+                self._data[index][section][key] = value
         except (IndexError, KeyError):
             return "Invalid index or section"
         
@@ -112,11 +266,7 @@ class DataManipulator:
         Identify quests that have 'Section_Dialogue' but no 'Structured_Dialogue'.
         Returns a list of such quests.
         """
-        missing_structured_dialogues = []
-        for quest in self.data:
-            if 'Section_Dialogue' in quest and 'Structured_Dialogue' not in quest:
-                missing_structured_dialogues.append(quest)
-        return missing_structured_dialogues
+        return self.query(Field('Section_Dialogue').exists() & Field('Structured_Dialogue').missing()).all()
 
     def save_missing_structured_dialogues(self, output_file_path):
         """
@@ -152,10 +302,7 @@ class DataManipulator:
     def get_quest_by_name(self, name):
         if not isinstance(name, str):
             raise ValueError("Quest name must be a string")
-        for quest in self.data:
-            if 'Quest_Name' in quest and quest['Quest_Name'] == name:
-                return quest
-        return None
+        return self.query(Field('Quest_Name') == name).first()
     
     def save_quests_by_index(self, start, end, output_file_path):
         """
@@ -210,12 +357,7 @@ class DataManipulator:
         :param source: The source value to match.
         :return: List of quests with the specified appearance and source.
         """
-        matching_quests = []
-        for quest in self.data:
-            memory_infobox = quest.get('MemoryInfobox', {})
-            if memory_infobox.get('appearance') == appearance and memory_infobox.get('source') == source:
-                matching_quests.append(quest)
-        return matching_quests
+        return self.query((Infobox('appearance') == appearance) & (Infobox('source') == source)).all()
 
     def get_unique_source_appearance_pairs(self):
         """
@@ -256,11 +398,7 @@ class DataManipulator:
         :param value: The value to match.
         :return: List of quests with the specified value for the key.
         """
-        matching_quests = []
-        for quest in self.data:
-            memory_infobox = quest.get('MemoryInfobox', {})
-            if memory_infobox.get(key) == value:
-                matching_quests.append(quest)
+        matching_quests = self.query(Infobox(key) == value).all()
         print(f"Number of quests with value '{value}' for key '{key}': {len(matching_quests)}")
         return matching_quests
 
@@ -271,11 +409,7 @@ class DataManipulator:
         :param values: List of values to match.
         :param output_file_path: Path to the output JSON file.
         """
-        matching_quests = []
-        for quest in self.data:
-            memory_infobox = quest.get('MemoryInfobox', {})
-            if memory_infobox.get(key) in values:
-                matching_quests.append(quest)
+        matching_quests = self.query(Infobox(key).isin(values)).all()
 
         with open(output_file_path, 'w', encoding="utf-8") as f:
             json.dump(matching_quests, f, indent=4)
@@ -309,7 +443,10 @@ class DataManipulator:
         return pair_counts
     
     def delete_revision_text(self):
-        for quest in self.data:
+        self.invalidate_indexes()
+        if self.store is not None:
+            self.store.delete_nested_key('Revision', 'text')
+        for quest in self.get_loaded_data():
             if 'Revision' in quest:
                 quest['Revision'].pop('text', None)
 
@@ -318,7 +455,10 @@ class DataManipulator:
         Replace essentially null values (like empty strings) with None.
         This method iterates through each quest and its nested elements.
         """
-        for quest in self.data:
+        self.invalidate_indexes()
+        if self.store is not None:
+            self.store.replace_essentially_null_values()
+        for quest in self.get_loaded_data():
             for key, value in quest.items():
                 if self.is_essentially_null(value):
                     quest[key] = None
@@ -336,12 +476,16 @@ class DataManipulator:
 
     def sanitize_memory_infobox(self):
         """Sanitize the MemoryInfobox fields in each quest."""
-        for quest in self.data:
+        self.invalidate_indexes()
+        if self.store is not None:
+            self.store.sanitize_infobox_values()
+        for quest in self.get_loaded_data():
             memory_infobox = quest.get('MemoryInfobox', {})
             for key, value in memory_infobox.items():
                 sanitized_value = self.sanitize_value(value)
                 memory_infobox[key] = sanitized_value
                 
+    @metrics.timed()
     def save_dialogues_to_csv1(self, output_csv_file):
         """
         Save all structured dialogues to a CSV file.
@@ -353,7 +497,9 @@ class DataManipulator:
                 quest_name = quest.get('Quest_Name', 'UnknownQuest')
                 structured_dialogue = quest.get('Structured_Dialogue', [])
 
-                for dialogue_element in structured_dialogue:
+                for segment in structured_dialogue:
+                    # Rows are copies, the stored segments keep their four keys
+                    dialogue_element = dict(segment_to_dict(segment))
                     dialogue_element['Quest_Name'] = quest_name  # Add QuestName to each dialogue element
                     # Add additional fields to dialogue_element
                     memory_infobox = quest.get('MemoryInfobox', {})
@@ -382,19 +528,20 @@ class DataManipulator:
                         csvwriter.writeheader()
 
                     csvwriter.writerow(dialogue_element)
-                    
+            metrics.increment('bytes_written', csvfile.tell())
+
     def extract_speaker_and_dialogue(self, text):
-        dialogue_pattern = re.compile(r"\*'''(.*?):'''\s*(.*)$")  # Captures everything after the speaker's colon to the end of the line)
-        match = dialogue_pattern.search(text)
-        if match:
-            speaker = match.group(1).strip()
-            dialogue = match.group(2).strip()
-            # Manually replace double single quotes with single quote within the dialogue
-            dialogue = re.sub(r"''", "'", dialogue)
-            return speaker, dialogue
-        else:
+        # The speaker is found like in CharacterIndex, for every DIALOGUE variant in regex_patterns
+        speaker, _ = extract_speaker_and_text(text)
+        if not speaker:
             return None, None
+        # The CSV keeps the dialogue text as before: everything after the speaker's colon, with the
+        # italic quotes turned into single quotes instead of stripped
+        match = csv_dialogue_pattern.search(text)
+        dialogue = match.group(2) if match else speaker_pattern.match(text.strip()).group('text')
+        return speaker, re.sub(r"''", "'", dialogue.strip())
 
+    @metrics.timed()
     def save_dialogues_to_csv(self, output_csv_file):
         """
         Save all structured dialogues to a CSV file.
@@ -406,7 +553,8 @@ class DataManipulator:
                 quest_name = quest.get('Quest_Name', 'UnknownQuest')
                 structured_dialogue = quest.get('Structured_Dialogue', [])
 
-                for dialogue_element in structured_dialogue:
+                for segment in structured_dialogue:
+                    dialogue_element = dict(segment_to_dict(segment))
                     dialogue_element['Quest_Name'] = quest_name  # Add QuestName to each dialogue element
                     if csvwriter is None:
                         # Initialize CSV writer and write headers on first iteration
@@ -415,43 +563,96 @@ class DataManipulator:
                         csvwriter.writeheader()
 
                     csvwriter.writerow(dialogue_element)
-    
-    def process_and_update_dialogues(self):
+            metrics.increment('bytes_written', csvfile.tell())
+
+    @metrics.timed()
+    def process_and_update_dialogues(self, journal_path=None, checkpoint_interval=100, resume=False):
         """
         Process and update dialogues for each quest that contains 'Section_Dialogue'.
+        :param journal_path: Optional CheckpointJournal file for structure_dialogues, see there.
+        """
+        count_not_found = self.structure_dialogues(journal_path=journal_path, checkpoint_interval=checkpoint_interval,
+                                                   resume=resume)
+
+        categorized_quests = self.categorize_quests()
+        print(f"Number of quests without 'Section_Dialogue': {count_not_found}")
+        self.save_categorized_quests(categorized_quests)
+
+    @metrics.timed()
+    def structure_dialogues(self, compact=False, journal_path=None, checkpoint_interval=100, resume=False):
         """
+        Add 'Structured_Dialogue' to each quest that contains 'Section_Dialogue'.
+        :param compact: Store array-backed SegmentList objects instead of dictionaries, many times smaller in memory.
+                        save_json and save_quests_in_folder write both forms the same way.
+        :param journal_path: Optional CheckpointJournal file the structured dialogues are written to as they are done.
+        :param checkpoint_interval: Number of structured quests between two writes of the journal.
+        :param resume: Take the dialogues already in the journal from it, these are dictionaries even when compact.
+        :return: Number of quests without 'Section_Dialogue'.
+        """
+        self.invalidate_indexes()
         count_not_found = 0
         count_structured_missing = 0
-        for quest in self.data:
-            quest_name = quest.get('Quest_Name', 'UnknownQuest')
-            dialogue_text = quest.get('Section_Dialogue')
-            if dialogue_text:
-                structurer = DialogueDataStructurer(quest)
-                structured_dialogue = structurer.process_dialogue(quest_name, dialogue_text)
-                if structured_dialogue:
-                    quest['Structured_Dialogue'] = structured_dialogue
+        journal = None
+        if journal_path:
+            journal = CheckpointJournal(journal_path, 'DataManipulator.structure_dialogues', None,
+                                        checkpoint_interval, resume)
+        try:
+            for quest in self.data:
+                quest_name = quest.get('Quest_Name', 'UnknownQuest')
+                dialogue_text = quest.get('Section_Dialogue')
+                if dialogue_text:
+                    # Keyed by the input of the structurer, duplicated quest keys can hold different dialogue versions
+                    work_key = hashlib.blake2b(f"{quest_name}\n{dialogue_text}".encode('utf-8'), digest_size=16).hexdigest()
+                    if journal and journal.is_done(work_key):
+                        structured_dialogue = journal.get_output(work_key)
+                    else:
+                        structurer = DialogueDataStructurer(quest)
+                        if compact:
+                            structured_dialogue = structurer.process_segments(quest_name, dialogue_text)
+                        else:
+                            structured_dialogue = structurer.process_dialogue(quest_name, dialogue_text)
+                        if journal:
+                            journal.record(work_key, structured_dialogue or None)
+                    if structured_dialogue:
+                        quest['Structured_Dialogue'] = structured_dialogue
+                    else:
+                        logging.warning(f"Structured dialogue missing for quest: {quest_name}")
+                        count_structured_missing += 1
                 else:
-                    logging.warning(f"Structured dialogue missing for quest: {quest_name}")
-                    count_structured_missing += 1
-            else:
-                logging.info(f"No 'Section_Dialogue' found for quest: {quest_name}")
-                count_not_found += 1
+                    logging.info(f"No 'Section_Dialogue' found for quest: {quest_name}")
+                    count_not_found += 1
+        finally:
+            if journal:
+                journal.close()
 
         print(f"Number of quests without 'Section_Dialogue': {count_not_found}")
         print(f"Number of quests with missing structured dialogues: {count_structured_missing}")
+        metrics.add_items(len(self.data))
+        metrics.increment('quests_without_dialogue', count_not_found)
+        metrics.increment('quests_with_missing_structured_dialogue', count_structured_missing)
+        return count_not_found
 
-        categorized_quests = self.categorize_quests()
-        print(f"Number of quests without 'Section_Dialogue': {count_not_found}")
-        self.save_categorized_quests(categorized_quests)
+    def render_plaintext(self, include_dialogue=True):
+        """
+        Store markup-free copies of General_Description, the Section_* fields and the Structured_Dialogue
+        contents under quest['Plaintext'], for exports that should not carry links, quotes or templates.
+        :param include_dialogue: Also render the Structured_Dialogue segments, run structure_dialogues first.
+        :return: Number of rendered fields.
+        """
+        rendered_fields = self.wikitext_renderer.render_quests(self.data, include_dialogue)
+        print(f"Rendered {rendered_fields} fields to plain text: {self.wikitext_renderer.get_statistics()}")
+        return rendered_fields
 
-    def save_categorized_quests(self, categorized_quests):
+    def save_categorized_quests(self, categorized_quests, main_folder="All_Quests"):
         """
         Save categorized quests into respective folders.
         :param categorized_quests: Dictionary of categorized quests.
+        :param main_folder: Name of the main folder to contain all subfolders.
         """
         for folder_name, quests in categorized_quests.items():
-            self.save_quests_in_folder(quests, folder_name)
+            self.save_quests_in_folder(quests, folder_name, main_folder)
             
+    @metrics.timed()
     def categorize_quests(self):
         """
         Categorize quests based on certain criteria.
@@ -488,6 +689,7 @@ class DataManipulator:
 
         return categorized_quests
 
+    @metrics.timed()
     def save_quests_in_folder(self, quests, folder_name, main_folder="All_Quests"):
         """
         Save quests in a specified subfolder within a main folder, each quest as a separate JSON file.
@@ -507,8 +709,10 @@ class DataManipulator:
             quest_name = self.sanitize_filename(quest.get('Quest_Name', 'UnknownQuest'))
             file_path = os.path.join(subfolder_path, f'{quest_name}.json')
             with open(file_path, 'w', encoding="utf-8") as f:
-                json.dump(quest, f, indent=4)
-                
+                json.dump(quest, f, indent=4, default=serialize_segment)
+                metrics.increment('bytes_written', f.tell())
+        metrics.add_items(len(quests))
+
     def save_quests_by_index_with_QuestName(self, start, end, output_file_path):
         """
         Save quests by index range to a JSON file.
@@ -517,6 +721,7 @@ class DataManipulator:
         :param output_file_path: Path to the output JSON file.
         """
         quests = self.get_quests_by_range(start, end)
+        self.invalidate_indexes()
         for quest in quests:
             quest.pop('Quest_Name', None)
             
@@ -587,11 +792,9 @@ class DataManipulator:
         :param quest_name: Name of the quest to retrieve.
         :return: Quest dictionary or None if not found.
         """
-        for quest in self.data:
-            if quest.get('Quest_Name') == quest_name:
-                return quest
-        return None
+        return self.query(Field('Quest_Name') == quest_name).first()
     
+    @metrics.timed()
     def delete_replace_sanitize(self):
         self.delete_revision_text()
         self.drop_unnessary_keys()
@@ -599,11 +802,7 @@ class DataManipulator:
         self.sanitize_memory_infobox()
  
     def return_quests_that_do_not_have_apperance(self):
-        quests = []
-        for quest in self.data:
-            if 'MemoryInfobox' in quest:
-                if 'appearance' not in quest['MemoryInfobox']:
-                    quests.append(quest)
+        quests = self.query(Field('MemoryInfobox').exists() & Infobox('appearance').missing()).all()
         for quest in quests:
             print(quest['Quest_Name'])
         return quests       
@@ -612,7 +811,10 @@ class DataManipulator:
         """
         Replace empty string values with None in the MemoryInfobox of each quest.
         """
-        for quest in self.data:
+        self.invalidate_indexes()
+        if self.store is not None:
+            self.store.replace_infobox_values([''], None)
+        for quest in self.get_loaded_data():
             memory_infobox = quest.get('MemoryInfobox', {})
             for key, value in memory_infobox.items():
                 if value == "":
@@ -622,53 +824,110 @@ class DataManipulator:
         """
         Remove null key-value pairs in the MemoryInfobox of each quest.
         """
-        for quest in self.data:
+        self.invalidate_indexes()
+        if self.store is not None:
+            self.store.delete_null_infobox_values()
+        for quest in self.get_loaded_data():
             memory_infobox = quest.get('MemoryInfobox', {})
             keys_to_remove = [key for key, value in memory_infobox.items() if value is None]
             for key in keys_to_remove:
                 memory_infobox.pop(key, None)
                 
-    def match_quests_that_with_inside_manual_chapter_folder(self, base_path):
+    @metrics.timed()
+    def match_quests_that_with_inside_manual_chapter_folder(self, base_path, progress_interval=100, journal_path=None,
+                                                            checkpoint_interval=100, resume=False):
+        """
+        Tag quests with chapter details from the best fuzzy match in the manually tagged chapter folder.
+        :param base_path: Folder with chapter type / chapter / quest JSON files.
+        :param progress_interval: Print progress every n quests, printing every quest slows the loop down.
+        :param journal_path: Optional CheckpointJournal file the chapter details are written to as quests are matched.
+        :param checkpoint_interval: Number of matched quests between two writes of the journal.
+        :param resume: Take the chapter details already in the journal from it instead of matching again.
+        """
+        from fuzzywuzzy import fuzz  # Imported here so loading the module stays fast
+
+        self.invalidate_indexes()
         total_quests = len(self.data)
         processed_count = 0
+        fuzzy_comparisons = 0
+        journal = None
+        if journal_path:
+            journal = CheckpointJournal(journal_path, 'DataManipulator.match_quests_that_with_inside_manual_chapter_folder',
+                                        os.path.abspath(base_path), checkpoint_interval, resume)
 
-        for quest in self.data:
-            quest_name = self.sanitize_filename(quest['Quest_Name'])
-            highest_match_score = 0
-            matched_file = None
-            matched_folder = None
-            matched_parent_folder = None
-
-            for root, dirs, files in os.walk(base_path):
-                for file in files:
-                    if file.endswith('.json'):
-                        file_name = os.path.splitext(file)[0]
-                        match_score = fuzz.partial_ratio(quest_name, file_name)
-
-                        if match_score > highest_match_score:
-                            highest_match_score = match_score
-                            matched_file = file
-                            matched_folder = os.path.basename(root)
-                            matched_parent_folder = os.path.basename(os.path.dirname(root))
-
-            if highest_match_score >= 80:  # Assuming 80% as the threshold
-                chapter_sequence_id = self.extract_sequence_id(matched_folder)
-                quest_sequence_id = self.extract_sequence_id(matched_file)
-                chapter_name = self.extract_chapter_name(matched_folder)
-                chapter_type = self.determine_chapter_type(matched_parent_folder, base_path)
-                quest['Chapter_SequenceID'] = chapter_sequence_id
-                quest['Chapter_Name'] = chapter_name
-                quest['Chapter_Type'] = chapter_type
-                quest["Quest_SequenceID"] = quest_sequence_id
-
-            # Log the progress and matched details
-            processed_count += 1
-            print(f"Processed {processed_count}/{total_quests} quests. "
-                f"Current Quest: '{quest_name}'. "
-                f"Match Score: {highest_match_score}. "
-                f"Matched File: '{matched_file}'. "
-                f"Matched Folder: '{matched_folder}'. "
-                f"Chapter Type: '{chapter_type}'.")
+        try:
+            for quest in self.data:
+                quest_name = self.sanitize_filename(quest['Quest_Name'])
+                # The match only depends on the name, so quests sharing it share the journal record
+                if journal and journal.is_done(quest_name):
+                    quest.update(journal.get_output(quest_name))
+                    processed_count += 1
+                    continue
+                highest_match_score = 0
+                matched_file = None
+                matched_folder = None
+                matched_parent_folder = None
+
+                for root, dirs, files in os.walk(base_path):
+                    for file in files:
+                        if file.endswith('.json'):
+                            file_name = os.path.splitext(file)[0]
+                            match_score = fuzz.partial_ratio(quest_name, file_name)
+                            fuzzy_comparisons += 1
+
+                            if match_score > highest_match_score:
+                                highest_match_score = match_score
+                                matched_file = file
+                                matched_folder = os.path.basename(root)
+                                matched_parent_folder = os.path.basename(os.path.dirname(root))
+
+                chapter_details = {}
+                if highest_match_score >= 80:  # Assuming 80% as the threshold
+                    chapter_details = self.get_chapter_details(matched_file, matched_folder, matched_parent_folder, base_path)
+                    quest.update(chapter_details)
+                if journal:
+                    journal.record(quest_name, chapter_details)
+
+                # Log the progress and matched details
+                processed_count += 1
+                if processed_count % progress_interval == 0 or processed_count == total_quests:
+                    print(f"Processed {processed_count}/{total_quests} quests. "
+                        f"Current Quest: '{quest_name}'. "
+                        f"Match Score: {highest_match_score}. "
+                        f"Matched File: '{matched_file}'. "
+                        f"Matched Folder: '{matched_folder}'. "
+                        f"Chapter Type: '{quest.get('Chapter_Type')}'.")
+        finally:
+            if journal:
+                journal.close()
+
+        metrics.add_items(processed_count)
+        metrics.increment('fuzzy_comparisons', fuzzy_comparisons)
+
+    def get_chapter_details(self, file_name, folder_name, parent_folder_name, base_path):
+        """
+        Chapter fields of a quest file in the manually tagged chapter folder.
+        :param file_name: Quest file name.
+        :param folder_name: Folder containing the file, the chapter.
+        :param parent_folder_name: Folder containing the chapter, the chapter type.
+        :param base_path: Root of the chapter folder.
+        """
+        return {
+            'Chapter_SequenceID': self.extract_sequence_id(folder_name),
+            'Chapter_Name': self.extract_chapter_name(folder_name),
+            'Chapter_Type': self.determine_chapter_type(parent_folder_name, base_path),
+            'Quest_SequenceID': self.extract_sequence_id(file_name),
+        }
+
+    def get_folder_chapter_details(self, file_path, base_path):
+        """Chapter fields derived from the location of a quest file below base_path."""
+        base_path = os.path.normpath(base_path)
+        folder_path = os.path.normpath(os.path.dirname(file_path))
+        # Files directly inside base_path have no chapter type, determine_chapter_type returns None for them
+        parent_folder_name = os.path.basename(os.path.dirname(folder_path)) if folder_path != base_path \
+            else os.path.basename(base_path)
+        return self.get_chapter_details(os.path.basename(file_path), os.path.basename(folder_path),
+                                        parent_folder_name, base_path)
 
     def extract_sequence_id(self, name):
         """
@@ -699,6 +958,8 @@ class DataManipulator:
         return all_quest_filenames
     
     def match_quests_in_odyssey_chapters(self, base_path):
+        from fuzzywuzzy import fuzz
+
         odyssey_chapters_path = os.path.join(base_path, "Odyssey Chapters")
         unmatched_quests = set([quest['Quest_Name'] for quest in self.data])
 
@@ -715,6 +976,7 @@ class DataManipulator:
         return unmatched_quests
     
     def update_quest_details(self, quest_name, folder_path, file_name):
+        self.invalidate_indexes()
         for quest in self.data:
             if quest['Quest_Name'] == quest_name:
                 folder_name = os.path.basename(folder_path)
@@ -778,7 +1040,10 @@ class DataManipulator:
             return parent_folder_name.replace('_', ' ')
     
     def drop_unnessary_keys(self):
-        for quest in self.data:
+        self.invalidate_indexes()
+        if self.store is not None:
+            self.store.delete_keys(['Revision', 'Section_Gallery'])
+        for quest in self.get_loaded_data():
             quest.pop('Revision', None)
             quest.pop('Section_Gallery', None)
             
@@ -799,6 +1064,7 @@ class DataManipulator:
             
     
             
+# Raw appearance variants, kept for reference. Filter with get_quests_by_game, it covers new variants too
 odyssey_apperances  = [
     "''[[Assassin's Creed: Odyssey]]''",
     "''[[Assassin's Creed: Odyssey]] – [[The Lost Tales of Greece]]''",
@@ -847,145 +1113,148 @@ valhalla_apperances = [
     "''[[Assassin's Creed: Valhalla]] – [[The Last Chapter]]''"
 ]
 
-data_manipulator_new = DataManipulator("Memories relived using the Animus HR-8.5.json")
-data_manipulator_new.save_quests_by_memory_infobox_values("appearance", odyssey_apperances, "odysseys.json")
-data_manipulator_new.save_quests_by_memory_infobox_values("appearance", valhalla_apperances, "valhalla.json")
-data_manipulator_new.delete_replace_sanitize()
-data_manipulator_new.replace_empty_string_with_none_in_memory_infobox()
-data_manipulator_new.save_json("AllQuestsCleaned.json")
-
-data_manipulator_odyssey = DataManipulator("odysseys.json")
-data_manipulator_odyssey.delete_replace_sanitize()
-data_manipulator_odyssey.replace_empty_string_with_none_in_memory_infobox()
-data_manipulator_odyssey.remove_null_key_values_in_memory_infobox()
-data_manipulator_odyssey.save_json("odysseyNew.json")
-
-data_manipulator_odyssey = DataManipulator("odysseyNew.json")
-#data_manipulator_odyssey.match_quests_in_odyssey_chapters("Manual Chapterin")
-#data_manipulator_odyssey.save_json("odysseychapter.json")
-
-for key,value in data_manipulator_odyssey.count_unique_keys(data_manipulator_odyssey.data).items():
-    for quest in data_manipulator_odyssey.data:
-        if quest['Quest_Name'] == key:
-            print(quest['Quest_Name'])    
-    print(key,value)
-
-
-data_manipulator_odyssey.match_quests_that_with_inside_manual_chapter_folder("Manual Chapterin")
-data_manipulator_odyssey.drop_unnessary_keys()
-data_manipulator_odyssey.save_json("OdysseyChapterAndSequenceAdded.json")
-data_manipulator_odyssey.process_and_update_dialogues()
-data_manipulator_odyssey.save_json("OdysseyChapterAndSequenceStructuredDialogue.json")
-data_manipulator_odyssey.save_dialogues_to_csv("dialoguesNew.csv")
-data_manipulator_odyssey.save_dialogues_to_csv1("dialoguesNew1.csv")
-#data_manipulator_odyssey.save_json("odysseyNews.json")
-
-#print(data_manipulator_odyssey.get_length())
-print("===========================================" + "\n")
-data_manipulator_last = DataManipulator("OdysseyChapterAndSequenceAdded.json")
-data_manipulator_last.get_quests_by_chapter_type("Odyssey Chapter")
-data_manipulator_last.get_quests_by_chapter_type("Character")
-data_manipulator_last.get_quests_by_chapter_type("World")
-data_manipulator_last.get_quests_by_chapter_type("The Lost Tales of Greece")
-data_manipulator_last.get_quests_by_chapter_type("DLC Chapters")
-data_manipulator_last.get_quests_by_chapter_type("Other")
-
-
-
-""" Valhalla
-data_manipulator_valhalla = DataManipulator("valhalla.json")
-data_manipulator_valhalla.delete_replace_sanitize()
-data_manipulator_valhalla.replace_empty_string_with_none_in_memory_infobox()
-data_manipulator_valhalla.save_json("valhallaNew.json")
-for key,value in data_manipulator_valhalla.count_unique_keys(data_manipulator_valhalla.data).items():
-    print(key,value)
-"""
-
-""" Source Filter Kassandra
-# Initialize the DataManipulator with your JSON file
-data_manipulator = DataManipulator("Memories relived using the Animus HR-8.5.json")
-print(data_manipulator.get_length())
-print(data_manipulator.get_unique_source_appearance_pairs())
-print("===========================================")
-
-print(data_manipulator.get_unique_values_for_memory_infobox_key("source"))
-print("===========================================" + "\n")
-
-
-print(data_manipulator.get_unique_values_for_memory_infobox_key("appearance"))
-print("===========================================" + "\n")
-
-print(data_manipulator.get_unique_values_for_memory_infobox_key("type"))
-print("===========================================" + "\n")
-
-# Define the key for filtering and the list of values to filter by
-key = "source"
-filter_sources = [
-    "[[Kassandra]]",
-    "[[Kassandra]], [[Layla Hassan]]",
-    "[[Alexios|Deimos]]",
-    "[[Leonidas I of Sparta]]"
-    "[[Deimos]]",
-]
-# We are only taking quests with the above sources into consideration
-
-
-# Call the method to filter and save the quests
-output_file_path = "onlyKassandraQuests.json"
-data_manipulator.save_quests_by_memory_infobox_values(key, filter_sources, output_file_path)
-print("===========================================")
-print(f"Filtered quests saved to {output_file_path}")
-"""
-
-""" Appearance Filter Odyssey
-data_manipulator.save_quests_by_memory_infobox_values("appearance", ["''[[Assassin's Creed: Odyssey]]''"], "onlyAppearanceACOdyssey.json")
-data_manipulator2 = DataManipulator("onlyAppearanceACOdyssey.json")
-print(data_manipulator2.get_length())
-data_manipulator2.get_unique_source_appearance_pairs()
-data_manipulator2.get_unique_values_for_memory_infobox_key("source")
-print(data_manipulator2.get_unique_values_for_memory_infobox_key("source"))
-print(data_manipulator2.get_unique_values_for_memory_infobox_key("appearance"))
-"""
-
-
-"""
-data_manipulator1 = DataManipulator("onlyKassandraQuests.json")
-print(data_manipulator1.get_unique_source_appearance_pairs())
-print(data_manipulator1.count_unique_keys(data_manipulator1.data))
-print(data_manipulator1.unique_count(data_manipulator1.data))
-print(data_manipulator1.get_unique_values_for_memory_infobox_key("appearance"))
-print(data_manipulator1.get_unique_values_for_memory_infobox_key("type"))
-
-for key,value in data_manipulator1.count_unique_keys(data_manipulator1.data).items():
-    print(key,value)
-        
-print(data_manipulator1.get_length())
-data_manipulator1.delete_revision_text()
-data_manipulator1.replace_essentially_null_with_none()
-data_manipulator1.sanitize_memory_infobox()
-
-data_manipulator1.save_json("OnlyKassandraSanitizedAndCleaned.json")
-data_manipulator = DataManipulator("OnlyKassandraSanitizedAndCleaned.json")
-data_manipulator.process_and_update_dialogues()
-data_manipulator.get_dialogue_by_index(0) 
-data_manipulator.get_dialogue_by_name("A Fresh Start")
-data_manipulator.save_quests_by_index(0, 1, "test.json")
-data_manipulator.save_json("idsegment.json")
-data_manipulator.save_dialogues_to_csv("dialoguesNew.csv")
-"""
-
-"""
-data_manipulator.get_structured_dialogue_by_index(0)
-for each in data_manipulator.get_structured_dialogue_by_index(0):
-    print(each)
-""" 
-
-"""
-b = data_manipulator_odyssey.get_length()
-a = data_manipulator_valhalla.get_length()
-
-print(a)
-print(b)
-print(a+b)
-
-"""
\ No newline at end of file
+if __name__ == "__main__":
+    from AppearanceNormalizer import ODYSSEY, VALHALLA
+
+    data_manipulator_new = DataManipulator("Memories relived using the Animus HR-8.5.json")
+    data_manipulator_new.save_quests_by_game(ODYSSEY, "odysseys.json")
+    data_manipulator_new.save_quests_by_game(VALHALLA, "valhalla.json")
+    data_manipulator_new.delete_replace_sanitize()
+    data_manipulator_new.replace_empty_string_with_none_in_memory_infobox()
+    data_manipulator_new.save_json("AllQuestsCleaned.json")
+
+    data_manipulator_odyssey = DataManipulator("odysseys.json")
+    data_manipulator_odyssey.delete_replace_sanitize()
+    data_manipulator_odyssey.replace_empty_string_with_none_in_memory_infobox()
+    data_manipulator_odyssey.remove_null_key_values_in_memory_infobox()
+    data_manipulator_odyssey.save_json("odysseyNew.json")
+
+    data_manipulator_odyssey = DataManipulator("odysseyNew.json")
+    #data_manipulator_odyssey.match_quests_in_odyssey_chapters("Manual Chapterin")
+    #data_manipulator_odyssey.save_json("odysseychapter.json")
+
+    for key,value in data_manipulator_odyssey.count_unique_keys(data_manipulator_odyssey.data).items():
+        for quest in data_manipulator_odyssey.data:
+            if quest['Quest_Name'] == key:
+                print(quest['Quest_Name'])    
+        print(key,value)
+
+
+    data_manipulator_odyssey.match_quests_that_with_inside_manual_chapter_folder("Manual Chapterin")
+    data_manipulator_odyssey.drop_unnessary_keys()
+    data_manipulator_odyssey.save_json("OdysseyChapterAndSequenceAdded.json")
+    data_manipulator_odyssey.process_and_update_dialogues()
+    data_manipulator_odyssey.save_json("OdysseyChapterAndSequenceStructuredDialogue.json")
+    data_manipulator_odyssey.save_dialogues_to_csv("dialoguesNew.csv")
+    data_manipulator_odyssey.save_dialogues_to_csv1("dialoguesNew1.csv")
+    #data_manipulator_odyssey.save_json("odysseyNews.json")
+
+    #print(data_manipulator_odyssey.get_length())
+    print("===========================================" + "\n")
+    data_manipulator_last = DataManipulator("OdysseyChapterAndSequenceAdded.json")
+    data_manipulator_last.get_quests_by_chapter_type("Odyssey Chapter")
+    data_manipulator_last.get_quests_by_chapter_type("Character")
+    data_manipulator_last.get_quests_by_chapter_type("World")
+    data_manipulator_last.get_quests_by_chapter_type("The Lost Tales of Greece")
+    data_manipulator_last.get_quests_by_chapter_type("DLC Chapters")
+    data_manipulator_last.get_quests_by_chapter_type("Other")
+
+
+
+    """ Valhalla
+    data_manipulator_valhalla = DataManipulator("valhalla.json")
+    data_manipulator_valhalla.delete_replace_sanitize()
+    data_manipulator_valhalla.replace_empty_string_with_none_in_memory_infobox()
+    data_manipulator_valhalla.save_json("valhallaNew.json")
+    for key,value in data_manipulator_valhalla.count_unique_keys(data_manipulator_valhalla.data).items():
+        print(key,value)
+    """
+
+    """ Source Filter Kassandra
+    # Initialize the DataManipulator with your JSON file
+    data_manipulator = DataManipulator("Memories relived using the Animus HR-8.5.json")
+    print(data_manipulator.get_length())
+    print(data_manipulator.get_unique_source_appearance_pairs())
+    print("===========================================")
+
+    print(data_manipulator.get_unique_values_for_memory_infobox_key("source"))
+    print("===========================================" + "\n")
+
+
+    print(data_manipulator.get_unique_values_for_memory_infobox_key("appearance"))
+    print("===========================================" + "\n")
+
+    print(data_manipulator.get_unique_values_for_memory_infobox_key("type"))
+    print("===========================================" + "\n")
+
+    # Define the key for filtering and the list of values to filter by
+    key = "source"
+    filter_sources = [
+        "[[Kassandra]]",
+        "[[Kassandra]], [[Layla Hassan]]",
+        "[[Alexios|Deimos]]",
+        "[[Leonidas I of Sparta]]"
+        "[[Deimos]]",
+    ]
+    # We are only taking quests with the above sources into consideration
+
+
+    # Call the method to filter and save the quests
+    output_file_path = "onlyKassandraQuests.json"
+    data_manipulator.save_quests_by_memory_infobox_values(key, filter_sources, output_file_path)
+    print("===========================================")
+    print(f"Filtered quests saved to {output_file_path}")
+    """
+
+    """ Appearance Filter Odyssey
+    data_manipulator.save_quests_by_memory_infobox_values("appearance", ["''[[Assassin's Creed: Odyssey]]''"], "onlyAppearanceACOdyssey.json")
+    data_manipulator2 = DataManipulator("onlyAppearanceACOdyssey.json")
+    print(data_manipulator2.get_length())
+    data_manipulator2.get_unique_source_appearance_pairs()
+    data_manipulator2.get_unique_values_for_memory_infobox_key("source")
+    print(data_manipulator2.get_unique_values_for_memory_infobox_key("source"))
+    print(data_manipulator2.get_unique_values_for_memory_infobox_key("appearance"))
+    """
+
+
+    """
+    data_manipulator1 = DataManipulator("onlyKassandraQuests.json")
+    print(data_manipulator1.get_unique_source_appearance_pairs())
+    print(data_manipulator1.count_unique_keys(data_manipulator1.data))
+    print(data_manipulator1.unique_count(data_manipulator1.data))
+    print(data_manipulator1.get_unique_values_for_memory_infobox_key("appearance"))
+    print(data_manipulator1.get_unique_values_for_memory_infobox_key("type"))
+
+    for key,value in data_manipulator1.count_unique_keys(data_manipulator1.data).items():
+        print(key,value)
+
+    print(data_manipulator1.get_length())
+    data_manipulator1.delete_revision_text()
+    data_manipulator1.replace_essentially_null_with_none()
+    data_manipulator1.sanitize_memory_infobox()
+
+    data_manipulator1.save_json("OnlyKassandraSanitizedAndCleaned.json")
+    data_manipulator = DataManipulator("OnlyKassandraSanitizedAndCleaned.json")
+    data_manipulator.process_and_update_dialogues()
+    data_manipulator.get_dialogue_by_index(0) 
+    data_manipulator.get_dialogue_by_name("A Fresh Start")
+    data_manipulator.save_quests_by_index(0, 1, "test.json")
+    data_manipulator.save_json("idsegment.json")
+    data_manipulator.save_dialogues_to_csv("dialoguesNew.csv")
+    """
+
+    """
+    data_manipulator.get_structured_dialogue_by_index(0)
+    for each in data_manipulator.get_structured_dialogue_by_index(0):
+        print(each)
+    """ 
+
+    """
+    b = data_manipulator_odyssey.get_length()
+    a = data_manipulator_valhalla.get_length()
+
+    print(a)
+    print(b)
+    print(a+b)
+
+    """
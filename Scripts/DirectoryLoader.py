@@ -0,0 +1,116 @@
+import os
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from DataManipulator import DataManipulator
+from Metrics import metrics
+
+
+def decode_files(files):
+    """
+    Decode a batch of (path, bytes) tuples, runs in a worker process when decode_processes is set.
+    :return: List of (path, decoded JSON or None, error message or None) tuples.
+    """
+    decoded = []
+    for file_path, content in files:
+        try:
+            decoded.append((file_path, json.loads(content), None))
+        except ValueError as e:
+            decoded.append((file_path, None, str(e)))
+    return decoded
+
+
+class DirectoryLoader:
+    """
+    Build a DataManipulator from a directory tree of per-quest JSON files, e.g. Quests/ManuallyTaggedbyChapterType.
+    Files are read concurrently by a thread pool driven by asyncio, with at most max_concurrency
+    reads in flight, which hides the per-file latency of network mounted storage. Decoding happens
+    in the reading threads, or in decode_processes worker processes for CPU-bound trees of large files.
+    On a local disk with the files in the page cache a serial loop is as fast, the gain comes from latency.
+    With chapter_metadata the Chapter_Type and Chapter_Name are taken from the folders of a chapter structured
+    tree like Quests/ManuallyTaggedbyChapterType. Other trees, e.g. the complexity buckets of
+    Quests/GroupedByComplexity, are not organized by chapter and are loaded as they are.
+    """
+
+    def __init__(self, max_concurrency=32, decode_processes=0, batch_size=16, chapter_metadata=False):
+        self.max_concurrency = max_concurrency
+        self.decode_processes = decode_processes
+        self.batch_size = batch_size
+        self.chapter_metadata = chapter_metadata
+        self.skipped_files = []
+
+    @staticmethod
+    def find_json_files(base_path):
+        """Return the JSON files below base_path in a stable order, so loads are deterministic."""
+        file_paths = []
+        for root, dirs, files in os.walk(base_path):
+            dirs.sort()
+            file_paths.extend(os.path.join(root, file) for file in sorted(files) if file.endswith('.json'))
+        return file_paths
+
+    @staticmethod
+    def read_file(file_path):
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    def read_batch(self, file_paths):
+        files = [(file_path, self.read_file(file_path)) for file_path in file_paths]
+        # Decode in the reading thread unless worker processes take over, no extra hop through the event loop
+        return files if self.decode_processes else decode_files(files)
+
+    async def read_files(self, file_paths, executor):
+        """
+        Read the files in batches on the thread pool. The pool size bounds the reads in flight,
+        batching keeps the event loop overhead per file small.
+        """
+        loop = asyncio.get_running_loop()
+        batches = [file_paths[i:i + self.batch_size] for i in range(0, len(file_paths), self.batch_size)]
+        results = await asyncio.gather(*(loop.run_in_executor(executor, self.read_batch, batch) for batch in batches))
+        return [entry for batch in results for entry in batch]
+
+    async def decode_in_processes(self, files):
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=self.decode_processes) as executor:
+            batches = [files[i:i + self.batch_size] for i in range(0, len(files), self.batch_size)]
+            results = await asyncio.gather(*(loop.run_in_executor(executor, decode_files, batch) for batch in batches))
+        return [entry for batch in results for entry in batch]
+
+    async def load_async(self, base_path):
+        file_paths = self.find_json_files(base_path)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            entries = await self.read_files(file_paths, executor)
+        if self.decode_processes:
+            entries = await self.decode_in_processes(entries)
+        return entries
+
+    @metrics.timed('DirectoryLoader.load')
+    def load(self, base_path):
+        """
+        Load every quest file below base_path.
+        :param base_path: Root folder, with chapter_metadata the chapter fields are derived from the folders relative to it.
+        :return: DataManipulator holding the quests in file path order.
+        """
+        data_manipulator = DataManipulator()
+        self.skipped_files = []
+        for file_path, quest, error in asyncio.run(self.load_async(base_path)):
+            if not isinstance(quest, dict):
+                # e.g. 'Unmatched Quests.json' is a list of quest names, not a quest
+                self.skipped_files.append((file_path, error or f"not a quest ({type(quest).__name__})"))
+                continue
+            if self.chapter_metadata:
+                # Fields already stored in the file win over the folder-derived ones
+                for key, value in data_manipulator.get_folder_chapter_details(file_path, base_path).items():
+                    if value is not None:
+                        quest.setdefault(key, value)
+            data_manipulator.data.append(quest)
+
+        print(f"Loaded {len(data_manipulator.data)} quests from {base_path}, skipped {len(self.skipped_files)} files")
+        metrics.add_items(len(data_manipulator.data))
+        metrics.increment('directory_loader.skipped_files', len(self.skipped_files))
+        return data_manipulator
+
+
+if __name__ == "__main__":
+    loaded = DirectoryLoader(chapter_metadata=True).load("Manual Chapterin")
+    loaded.save_json("ManualChapterQuests.json")
@@ -0,0 +1,237 @@
+import json
+import hashlib
+import re
+
+from PromptTemplates import PromptTemplate, QuestFragmentRenderer, DEFAULT_USER_TEMPLATE
+from QuestQuery import get_quest_key
+
+
+DEFAULT_SYSTEM_PROMPT = (
+    "Generate a detailed quest design for **{Quest Title}**, integrating complex narrative elements, deep character "
+    "interactions, and strategic gameplay mechanics. Ensure the quest explores **{specified themes}** and reflects the "
+    "cultural and societal complexities of **{game world’s society}**. \n\n"
+    "**Player motivations** should align with achieving **{specific player goals}**, and gameplay should offer varied "
+    "interactions such as **{combat, puzzles, dialogue choices}**. \n\n"
+    "**Environmental design** must enhance the storytelling, offering immersive and interactive settings like "
+    "**{specific places in the game world}**. The quest should offer multiple outcomes based on player decisions, "
+    "influencing future narratives and character relationships. \n\n"
+    "**Detail the progression** of tasks, challenges, and character interactions that align with the overarching goals "
+    "of both player satisfaction and narrative depth. **The quest’s conclusion** should leave a lasting impact on "
+    "the player and the game world, shaping future events and character developments. \n\n"
+    "Ensure the quest design is **engaging, coherent, and aligned** with the overall narrative and gameplay experience "
+    "of the game."
+)
+
+# Assistant record fields, in the order used by training_file.jsonl: (output key, quest key, MemoryInfobox key)
+ASSISTANT_FIELDS = [
+    ('Quest_Name', 'Quest_Name', None),
+    ('Quest_Date', None, 'date'),
+    ('Quest_Description', None, 'description'),
+    ('Quest_Location', None, 'location'),
+    ('Quest_SequenceID', 'Quest_SequenceID', None),
+    ('Quest_Type', None, 'type'),
+    ('Chapter_Name', 'Chapter_Name', None),
+    ('Chapter_SequenceID', 'Chapter_SequenceID', None),
+    ('Chapter_Type', 'Chapter_Type', None),
+    ('General_Description', 'General_Description', None),
+    ('Section_Description', 'Section_Description', None),
+    ('Section_Dialogue', 'Section_Dialogue', None),
+]
+
+token_pattern = re.compile(r"\w+|[^\w\s]")
+
+
+class FineTuningDatasetBuilder:
+    def __init__(self, data_manipulator, system_prompt=DEFAULT_SYSTEM_PROMPT, max_tokens=4096, validation_ratio=0.1,
+                 user_template=DEFAULT_USER_TEMPLATE, fragment_renderer=None, clean_dialogue=False):
+        self.data_manipulator = data_manipulator
+        self.system_prompt = PromptTemplate(system_prompt).render({})
+        self.system_prompt_tokens = self.estimate_tokens(self.system_prompt)
+        self.user_template = PromptTemplate(user_template)
+        # Pass a shared renderer to reuse rendered fragments across builders with different templates
+        self.fragment_renderer = fragment_renderer if fragment_renderer is not None else QuestFragmentRenderer()
+        self.clean_dialogue = clean_dialogue
+        self.max_tokens = max_tokens
+        self.validation_ratio = validation_ratio
+        self.stats = {'train': 0, 'validation': 0, 'truncated': 0, 'skipped_over_budget': 0}
+
+    @staticmethod
+    def estimate_tokens(text):
+        """
+        Fast local token estimate without loading a tokenizer.
+        Takes the larger of the word/punctuation count and the ~4 characters per token rule of thumb.
+        :param text: Text to estimate.
+        :return: Estimated number of tokens.
+        """
+        if not text:
+            return 0
+        return max(len(token_pattern.findall(text)), (len(text) + 3) // 4)
+
+    def is_validation(self, quest_id):
+        """
+        Deterministically assign a quest to the validation split based on its Quest_ID.
+        The same Quest_ID always ends up in the same split, independent of corpus order.
+        :param quest_id: The Quest_ID of the quest.
+        :return: True if the quest belongs to the validation split.
+        """
+        digest = hashlib.md5(str(quest_id).encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) / 0xFFFFFFFF < self.validation_ratio
+
+    def iter_quests(self, chapter_types=None, appearances=None):
+        """
+        Lazily yield quests filtered by Chapter_Type and MemoryInfobox appearance.
+        :param chapter_types: Iterable of Chapter_Type values to keep, or None for all.
+        :param appearances: Iterable of appearance values to keep, or None for all.
+        """
+        chapter_types = set(chapter_types) if chapter_types is not None else None
+        appearances = set(appearances) if appearances is not None else None
+        for quest in self.data_manipulator.data:
+            if chapter_types is not None and quest.get('Chapter_Type') not in chapter_types:
+                continue
+            if appearances is not None and (quest.get('MemoryInfobox') or {}).get('appearance') not in appearances:
+                continue
+            yield quest
+
+    def build_user_content(self, quest):
+        """
+        Render the user message. Available placeholders: {Quest Title}, {Narrative Overview}, {Quest Summary},
+        {Setting}, {Infobox Summary} (overview and setting) and {Dialogue}.
+        Fragments are only rendered when the template uses them.
+        """
+        fields = self.user_template.fields
+        section_description = quest.get('Section_Description')
+        values = {
+            'Quest Title': quest.get('Quest_Name', 'UnknownQuest'),
+            'Quest Summary': f"**## Quest Summary:**\n\n{section_description}\n\n" if section_description else '',
+        }
+        if 'Narrative Overview' in fields:
+            values['Narrative Overview'] = self.fragment_renderer.narrative_overview(quest)
+        if 'Setting' in fields:
+            values['Setting'] = self.fragment_renderer.setting(quest)
+        if 'Infobox Summary' in fields:
+            values['Infobox Summary'] = self.fragment_renderer.infobox_summary(quest)
+        if 'Dialogue' in fields:
+            values['Dialogue'] = self.fragment_renderer.cleaned_dialogue(quest) or ''
+        content = self.user_template.render(values)
+        # Fragments end with a blank line, the message ends with a single newline
+        return content[:-1] if content.endswith('\n\n') else content
+
+    def build_assistant_fields(self, quest):
+        memory_infobox = quest.get('MemoryInfobox') or {}
+        fields = {}
+        for output_key, quest_key, infobox_key in ASSISTANT_FIELDS:
+            if output_key == 'Section_Dialogue' and self.clean_dialogue:
+                value = self.fragment_renderer.cleaned_dialogue(quest)
+            else:
+                value = quest.get(quest_key) if quest_key else memory_infobox.get(infobox_key)
+            if value is not None:
+                fields[output_key] = value
+        return fields
+
+    def fit_to_budget(self, user_content, assistant_fields):
+        """
+        Trim dialogue lines from the end of Section_Dialogue until the record fits into max_tokens.
+        :return: Tuple of (assistant content, whether it was truncated) or (None, False) if it cannot fit.
+        """
+        fixed_tokens = self.system_prompt_tokens + self.estimate_tokens(user_content)
+        assistant_content = json.dumps(assistant_fields, ensure_ascii=False)
+        if fixed_tokens + self.estimate_tokens(assistant_content) <= self.max_tokens:
+            return assistant_content, False
+
+        dialogue = assistant_fields.get('Section_Dialogue')
+        if not dialogue:
+            return None, False
+
+        # Estimate every line once and drop lines from the end instead of re-estimating the whole record
+        without_dialogue = dict(assistant_fields, Section_Dialogue='')
+        budget = self.max_tokens - fixed_tokens - self.estimate_tokens(json.dumps(without_dialogue, ensure_ascii=False))
+        lines = dialogue.split('\n')
+        kept_tokens = 0
+        kept = 0
+        for line in lines:
+            line_tokens = self.estimate_tokens(line) + 1
+            if kept_tokens + line_tokens > budget:
+                break
+            kept_tokens += line_tokens
+            kept += 1
+        if kept == 0:
+            return None, False
+        assistant_fields = dict(assistant_fields, Section_Dialogue='\n'.join(lines[:kept]))
+        return json.dumps(assistant_fields, ensure_ascii=False), True
+
+    def build_record(self, quest):
+        """
+        Build a single chat-format record for a quest.
+        :param quest: Quest dictionary.
+        :return: Record dictionary with 'messages', or None if the quest does not fit the token budget.
+        """
+        user_content = self.build_user_content(quest)
+        assistant_content, truncated = self.fit_to_budget(user_content, self.build_assistant_fields(quest))
+        if assistant_content is None:
+            self.stats['skipped_over_budget'] += 1
+            return None
+        if truncated:
+            self.stats['truncated'] += 1
+        return {"messages": [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_content},
+            {"role": "assistant", "content": assistant_content},
+        ]}
+
+    def write_jsonl(self, train_file_path, validation_file_path, chapter_types=None, appearances=None,
+                    deduplicator=None):
+        """
+        Stream quests into training and validation JSONL files, one record per line.
+        Records are written as soon as they are built, so memory use does not grow with the output size.
+        :param train_file_path: Path for the training JSONL file.
+        :param validation_file_path: Path for the validation JSONL file.
+        :param chapter_types: Optional Chapter_Type filter.
+        :param appearances: Optional appearance filter.
+        :param deduplicator: Optional QuestDeduplicator, near-duplicate quests are kept in the same split.
+        :return: Dictionary with record statistics.
+        """
+        split_keys = {}
+        if deduplicator is not None:
+            clusters = deduplicator.find_clusters(self.iter_quests(chapter_types, appearances))
+            split_keys = deduplicator.get_split_keys(clusters)
+            print(f"Found {len(clusters)} near-duplicate clusters covering {len(split_keys)} quests")
+
+        self.stats = {'train': 0, 'validation': 0, 'truncated': 0, 'skipped_over_budget': 0}
+        # The system message is identical for every record, so it is encoded once and reused
+        record_prefix = '{"messages":[' + json.dumps({"role": "system", "content": self.system_prompt},
+                                                     ensure_ascii=False, separators=(',', ':')) + ','
+        with open(train_file_path, 'w', encoding='utf-8') as train_file, \
+                open(validation_file_path, 'w', encoding='utf-8') as validation_file:
+            for quest in self.iter_quests(chapter_types, appearances):
+                record = self.build_record(quest)
+                if record is None:
+                    continue
+                user_message, assistant_message = record['messages'][1:]
+                line = (record_prefix
+                        + json.dumps(user_message, ensure_ascii=False, separators=(',', ':')) + ','
+                        + json.dumps(assistant_message, ensure_ascii=False, separators=(',', ':')) + ']}\n')
+                # The same key as the near-duplicate clusters, also for quests with a None or missing Quest_ID
+                quest_key = get_quest_key(quest)
+                if self.is_validation(split_keys.get(quest_key, quest_key)):
+                    validation_file.write(line)
+                    self.stats['validation'] += 1
+                else:
+                    train_file.write(line)
+                    self.stats['train'] += 1
+
+        self.stats['fragment_cache'] = self.fragment_renderer.cache.get_statistics()
+        print(f"Saved {self.stats['train']} training and {self.stats['validation']} validation records "
+              f"({self.stats['truncated']} truncated, {self.stats['skipped_over_budget']} over budget)")
+        return self.stats
+
+
+if __name__ == "__main__":
+    from DataManipulator import DataManipulator
+    from QuestDeduplicator import QuestDeduplicator
+
+    data_manipulator = DataManipulator("OdysseyChapterAndSequenceStructuredDialogue.json")
+    builder = FineTuningDatasetBuilder(data_manipulator, max_tokens=4096, validation_ratio=0.1)
+    builder.write_jsonl("training_file.jsonl", "validation_file.jsonl",
+                        chapter_types=["Odyssey Chapter", "Character", "World", "The Lost Tales of Greece",
+                                       "DLC Chapters", "Other"],
+                        deduplicator=QuestDeduplicator(threshold=0.8))
@@ -0,0 +1,156 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import functools
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Lightweight stage timings and counters for XMLParser, DataManipulator and DialogueDataStructurer.
+    Disabled by default: every hook checks the `enabled` flag first and returns immediately.
+    Enable with metrics.enable() or by setting QUESTGEN_METRICS=1.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.profile = False
+        self.reset()
+
+    def reset(self):
+        self.stages = defaultdict(lambda: {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0,
+                                           'peak_memory_bytes': 0})
+        self.counters = defaultdict(int)
+        self.stack = []
+        self.profiler = None
+
+    def enable(self, trace_memory=False, profile=False):
+        """
+        Start recording.
+        :param trace_memory: Record peak Python memory per stage with tracemalloc (slows allocations down).
+        :param profile: Run cProfile while stages are active, see get_profile_report().
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        self.profile = profile
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if profile:
+            self.profiler = cProfile.Profile()
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+        self.profile = False
+
+    def increment(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def add_items(self, value):
+        """Count processed items for the innermost running stage, used for items/sec."""
+        if self.enabled and self.stack:
+            self.stack[-1]['items'] += value
+
+    @contextmanager
+    def stage(self, name, items=0):
+        """
+        Record wall time, CPU time, processed items and peak memory of a block.
+        :param name: Stage name, e.g. 'XMLParser.parse_all_pages'.
+        :param items: Number of items processed, can also be added with add_items().
+        """
+        if not self.enabled:
+            yield
+            return
+
+        frame = {'name': name, 'items': items, 'peak': 0}
+        if self.trace_memory:
+            if self.stack:
+                parent = self.stack[-1]
+                parent['peak'] = max(parent['peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        if self.profiler is not None and not self.stack:
+            self.profiler.enable()
+        self.stack.append(frame)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            self.stack.pop()
+            if self.profiler is not None and not self.stack:
+                self.profiler.disable()
+
+            stats = self.stages[name]
+            stats['calls'] += 1
+            stats['wall_seconds'] += wall
+            stats['cpu_seconds'] += cpu
+            stats['items'] += frame['items']
+            if self.trace_memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                stats['peak_memory_bytes'] = max(stats['peak_memory_bytes'], peak)
+                if self.stack:
+                    self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+
+    def timed(self, name=None):
+        """Decorator recording every call of a function or method as a stage."""
+        def decorator(function):
+            stage_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.stage(stage_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def get_statistics(self):
+        stages = {}
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats)
+            stages[name]['items_per_second'] = stats['items'] / stats['wall_seconds'] if stats['wall_seconds'] else 0.0
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+    def to_json(self, file_path=None):
+        statistics = self.get_statistics()
+        if file_path:
+            with open(file_path, 'w', encoding='utf-8') as f:
+                json.dump(statistics, f, indent=4)
+        return json.dumps(statistics, indent=4)
+
+    def to_prometheus(self, prefix="questgen"):
+        """Render the statistics in the Prometheus text exposition format."""
+        statistics = self.get_statistics()
+        lines = []
+        for metric in ['calls', 'wall_seconds', 'cpu_seconds', 'items', 'items_per_second', 'peak_memory_bytes']:
+            lines.append(f"# TYPE {prefix}_stage_{metric} gauge")
+            for name, stats in sorted(statistics['stages'].items()):
+                lines.append(f'{prefix}_stage_{metric}{{stage="{name}"}} {stats[metric]}')
+        lines.append(f"# TYPE {prefix}_counter_total counter")
+        for name, value in sorted(statistics['counters'].items()):
+            lines.append(f'{prefix}_counter_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def get_profile_report(self, sort_by='cumulative', limit=30):
+        if self.profiler is None:
+            return ""
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats(sort_by).print_stats(limit)
+        return output.getvalue()
+
+
+metrics = Metrics()
+if os.environ.get('QUESTGEN_METRICS') == '1':
+    metrics.enable(trace_memory=os.environ.get('QUESTGEN_METRICS_MEMORY') == '1')
@@ -0,0 +1,200 @@
+import re
+import json
+import time
+import heapq
+import argparse
+from collections import Counter, defaultdict
+
+from DialogueDataStructurer import DialogueDataStructurer, SegmentType, regex_patterns, segment_type_order
+
+
+def split_alternation(pattern_source):
+    """
+    Split a regex into its top-level alternation branches, ignoring '|' inside groups,
+    character classes and escapes.
+    :param pattern_source: Source of a compiled pattern, e.g. pattern.pattern.
+    :return: List of branch sources.
+    """
+    branches = []
+    current = []
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in pattern_source:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']' or (current and current[-1] == '[')
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            branches.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    branches.append(''.join(current))
+    return branches
+
+
+def get_line_shape(line, length=24):
+    """
+    Reduce a line to its markup skeleton so similar unidentified lines land in the same bucket:
+    letters become 'a', digits '0' and runs of the same class are collapsed.
+    """
+    shape = re.sub(r"[^\W\d_]+", "a", line.strip())
+    shape = re.sub(r"\d+", "0", shape)
+    shape = re.sub(r"\s+", " ", shape)
+    return shape[:length] if shape else "<empty>"
+
+
+class PatternProfiler:
+    """
+    Profiling mode for DialogueDataStructurer.identify_segment_type. Every line runs through the
+    patterns in segment_type_order and records, per pattern and per top-level alternation branch,
+    hits, misses and cumulative match time. Branches are tried one by one in order until the first
+    hit, the same way the regex engine walks the alternation.
+    """
+
+    def __init__(self, patterns=regex_patterns, slowest_lines=20, examples_per_shape=3):
+        self.patterns = patterns
+        self.branches = {
+            segment_type: [re.compile(branch, patterns[segment_type].flags)
+                           for branch in split_alternation(patterns[segment_type].pattern)]
+            for segment_type in segment_type_order
+        }
+        self.slowest_limit = slowest_lines
+        self.examples_per_shape = examples_per_shape
+        self.reset()
+
+    def reset(self):
+        self.pattern_stats = {segment_type: {'hits': 0, 'misses': 0, 'seconds': 0.0}
+                              for segment_type in segment_type_order}
+        self.branch_stats = {segment_type: [{'hits': 0, 'misses': 0, 'seconds': 0.0} for _ in branches]
+                             for segment_type, branches in self.branches.items()}
+        self.type_counts = Counter()
+        self.slowest = []  # min-heap of (seconds, line number, quest, line)
+        self.unidentified_shapes = Counter()
+        self.unidentified_examples = defaultdict(list)
+        self.lines = 0
+        self.current_quest = None
+
+    def profile_branches(self, segment_type, line):
+        for branch, stats in zip(self.branches[segment_type], self.branch_stats[segment_type]):
+            start = time.perf_counter()
+            match = branch.match(line)
+            stats['seconds'] += time.perf_counter() - start
+            if match:
+                stats['hits'] += 1
+                return
+            stats['misses'] += 1
+
+    def identify_segment_type(self, line):
+        """Drop-in replacement for DialogueDataStructurer.identify_segment_type that records statistics."""
+        self.lines += 1
+        result = SegmentType.UNIDENTIFIED
+        line_seconds = 0.0
+        for segment_type in segment_type_order:
+            start = time.perf_counter()
+            match = self.patterns[segment_type].match(line)
+            seconds = time.perf_counter() - start
+            line_seconds += seconds
+
+            stats = self.pattern_stats[segment_type]
+            stats['seconds'] += seconds
+            self.profile_branches(segment_type, line)
+            if match:
+                stats['hits'] += 1
+                result = segment_type
+                break
+            stats['misses'] += 1
+
+        self.type_counts[result.value] += 1
+        entry = (line_seconds, self.lines, self.current_quest, line)
+        if len(self.slowest) < self.slowest_limit:
+            heapq.heappush(self.slowest, entry)
+        elif line_seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+        if result is SegmentType.UNIDENTIFIED:
+            shape = get_line_shape(line)
+            self.unidentified_shapes[shape] += 1
+            if len(self.unidentified_examples[shape]) < self.examples_per_shape:
+                self.unidentified_examples[shape].append(line)
+        return result
+
+    def profile_quests(self, data):
+        """
+        Run process_dialogue with profiling over a list of quests.
+        :param data: List of quests with 'Section_Dialogue', e.g. DataManipulator.data.
+        :return: The profiler itself.
+        """
+        for quest in data:
+            section_dialogue = quest.get('Section_Dialogue')
+            if section_dialogue:
+                quest_name = quest.get('Quest_Name') or quest.get('QuestName')
+                DialogueDataStructurer(quest, profiler=self).process_dialogue(quest_name, section_dialogue)
+        return self
+
+    def get_report(self, limit=20):
+        patterns = {}
+        for segment_type in segment_type_order:
+            stats = dict(self.pattern_stats[segment_type])
+            attempts = stats['hits'] + stats['misses']
+            stats['microseconds_per_attempt'] = stats['seconds'] / attempts * 1e6 if attempts else 0.0
+            stats['branches'] = [dict(branch_stats, pattern=branch.pattern)
+                                 for branch, branch_stats in zip(self.branches[segment_type],
+                                                                 self.branch_stats[segment_type])]
+            patterns[segment_type.value] = stats
+
+        return {
+            'lines': self.lines,
+            'segment_types': dict(self.type_counts.most_common()),
+            'patterns': patterns,
+            # Slow lines are the candidates for catastrophic backtracking
+            'slowest_lines': [{'microseconds': seconds * 1e6, 'quest': quest, 'line': line}
+                              for seconds, _, quest, line in sorted(self.slowest, reverse=True)],
+            'unidentified_histogram': [{'shape': shape, 'count': count,
+                                        'examples': self.unidentified_examples[shape]}
+                                       for shape, count in self.unidentified_shapes.most_common(limit)],
+        }
+
+    def print_report(self, limit=20):
+        report = self.get_report(limit)
+        print(f"Profiled {report['lines']} lines: {report['segment_types']}")
+        for name, stats in report['patterns'].items():
+            print(f"{name}: {stats['hits']} hits, {stats['misses']} misses, {stats['seconds'] * 1000:.1f} ms")
+            for index, branch in enumerate(stats['branches']):
+                if len(stats['branches']) > 1:
+                    print(f"    branch {index}: {branch['hits']} hits, {branch['misses']} misses, "
+                          f"{branch['seconds'] * 1000:.1f} ms  {branch['pattern']}")
+        print("Slowest lines:")
+        for entry in report['slowest_lines'][:limit]:
+            print(f"    {entry['microseconds']:.0f} us [{entry['quest']}] {entry['line'][:100]}")
+        print("Unidentified lines:")
+        for entry in report['unidentified_histogram']:
+            print(f"    {entry['count']:6d}  {entry['shape']!r}  e.g. {entry['examples'][0][:80]!r}")
+
+    def save(self, file_path, limit=50):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.get_report(limit), f, indent=4)
+
+
+if __name__ == "__main__":
+    from DataManipulator import DataManipulator
+
+    parser = argparse.ArgumentParser(description="Profile the segment type patterns over a quest corpus.")
+    parser.add_argument('json_file_path', nargs='?', default="OdysseyChapterAndSequenceStructuredDialogue.json")
+    parser.add_argument('--output', help="Write the report as JSON.")
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    pattern_profiler = PatternProfiler(slowest_lines=args.limit).profile_quests(DataManipulator(args.json_file_path).data)
+    pattern_profiler.print_report(args.limit)
+    if args.output:
+        pattern_profiler.save(args.output, args.limit)
@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import ast
+import inspect
+import argparse
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_imported_modules(source):
+    """Top-level names of the modules imported anywhere in the source, including imports inside functions."""
+    names = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split('.')[0])
+    return names
+
+
+def get_script_dependencies(source):
+    """
+    Files of the Scripts modules a piece of code imports, directly or through other Scripts modules.
+    :return: Sorted list of file names, e.g. ['DataManipulator.py', 'DialogueDataStructurer.py', ...].
+    """
+    dependencies = set()
+    pending = list(get_imported_modules(source))
+    while pending:
+        file_name = pending.pop() + '.py'
+        path = os.path.join(SCRIPTS_DIR, file_name)
+        if file_name in dependencies or not os.path.exists(path):
+            continue  # Already visited, or a standard library or third-party module
+        dependencies.add(file_name)
+        with open(path, 'r', encoding='utf-8') as f:
+            pending.extend(get_imported_modules(f.read()))
+    return sorted(dependencies)
+
+
+class Stage:
+    """
+    A named pipeline step. Inputs are artifact names produced by other stages, outputs are artifact
+    names this stage writes. Sources are parameter names pointing to external files or folders,
+    params are the other parameter names the stage reads. The Scripts modules the stage function imports,
+    directly or indirectly, are part of its code version; modules lists further files to hash.
+    A checkpointed stage function takes a fourth argument, the CheckpointJournal options to pass to
+    the long running method it calls.
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=(), sources=(), params=(), modules=(), version="1",
+                 checkpointed=False):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.sources = list(sources)
+        self.params = list(params)
+        self.modules = list(modules)
+        self.version = version
+        self.checkpointed = checkpointed
+
+    def get_code_version(self):
+        """Hash of the stage function and the modules it runs, so code changes invalidate the cache."""
+        digest = hashlib.sha256(self.version.encode('utf-8'))
+        source = inspect.getsource(self.function)
+        digest.update(source.encode('utf-8'))
+        for module in sorted(set(get_script_dependencies(source)) | set(self.modules)):
+            digest.update(module.encode('utf-8'))
+            with open(os.path.join(SCRIPTS_DIR, module), 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, params, cache_dir=".pipeline_cache", checkpoint_interval=100):
+        self.params = params
+        self.cache_dir = cache_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.stages = {}
+        self.producers = {}  # artifact name -> stage name
+
+    def add_stage(self, stage):
+        for output in stage.outputs:
+            if output in self.producers:
+                raise ValueError(f"Artifact '{output}' is already produced by stage '{self.producers[output]}'")
+            self.producers[output] = stage.name
+        self.stages[stage.name] = stage
+
+    def get_execution_order(self, targets=None):
+        """
+        Return the stages needed for the targets in dependency order.
+        :param targets: Stage names to run, or None for all stages.
+        """
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle in pipeline at stage '{name}'")
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage '{name}', expected one of {list(self.stages)}")
+            visiting.add(name)
+            for artifact in self.stages[name].inputs:
+                if artifact not in self.producers:
+                    raise ValueError(f"No stage produces artifact '{artifact}' needed by '{name}'")
+                visit(self.producers[artifact])
+            visiting.discard(name)
+            order.append(name)
+
+        for name in targets or self.stages:
+            visit(name)
+        return order
+
+    @staticmethod
+    def hash_path(path):
+        """Content hash of a file, or of every file below a folder."""
+        digest = hashlib.sha256()
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    file_path = os.path.join(root, file)
+                    digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+                    digest.update(Pipeline.hash_path(file_path).encode('utf-8'))
+        else:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def fingerprint_source(path):
+        # Size and modification time are enough for the large external dumps and avoid re-reading them
+        if not os.path.exists(path):
+            return None
+        if os.path.isdir(path):
+            return [(os.path.relpath(os.path.join(root, file), path), os.stat(os.path.join(root, file)).st_mtime_ns)
+                    for root, dirs, files in sorted(os.walk(path)) for file in sorted(files)]
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get_stage_key(self, stage, artifact_hashes):
+        key = {
+            'stage': stage.name,
+            'code': stage.get_code_version(),
+            'inputs': {artifact: artifact_hashes[artifact] for artifact in stage.inputs},
+            'sources': {source: self.fingerprint_source(self.params[source]) for source in stage.sources},
+            'params': {name: self.params[name] for name in stage.params},
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def run(self, targets=None, force=False):
+        """
+        Run the stages needed for the targets. A stage is skipped when its outputs are cached
+        for the same input hashes, sources, parameters and code version.
+        :param targets: Stage names to run, or None for all stages.
+        :param force: Re-run every stage even if its outputs are cached.
+        :return: Dictionary mapping stage names to 'cached' or 'executed'.
+        """
+        artifact_paths = {}
+        artifact_hashes = {}
+        status = {}
+        for name in self.get_execution_order(targets):
+            stage = self.stages[name]
+            stage_dir = os.path.join(self.cache_dir, name, self.get_stage_key(stage, artifact_hashes))
+            manifest_path = os.path.join(stage_dir, 'manifest.json')
+            outputs = {artifact: os.path.join(stage_dir, artifact) for artifact in stage.outputs}
+
+            if not force and os.path.exists(manifest_path):
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    output_hashes = json.load(f)
+                status[name] = 'cached'
+            else:
+                if os.path.exists(stage_dir):
+                    shutil.rmtree(stage_dir)
+                os.makedirs(stage_dir)
+                print(f"Running stage '{name}'")
+                stage_inputs = {artifact: artifact_paths[artifact] for artifact in stage.inputs}
+                # The journal lives next to the stage folder, so it survives the cleanup of an interrupted run
+                # and is only resumed by a run with the same stage key
+                journal_path = stage_dir + '.journal'
+                if stage.checkpointed:
+                    checkpoint = {'journal_path': journal_path, 'checkpoint_interval': self.checkpoint_interval,
+                                  'resume': not force}
+                    stage.function(self.params, stage_inputs, outputs, checkpoint)
+                else:
+                    stage.function(self.params, stage_inputs, outputs)
+                output_hashes = {artifact: self.hash_path(path) for artifact, path in outputs.items()}
+                # The manifest is written last, an interrupted stage is never mistaken for a cached one
+                with open(manifest_path, 'w', encoding='utf-8') as f:
+                    json.dump(output_hashes, f, indent=4)
+                if os.path.exists(journal_path):
+                    os.remove(journal_path)
+                status[name] = 'executed'
+
+            artifact_paths.update(outputs)
+            artifact_hashes.update(output_hashes)
+            print(f"Stage '{name}': {status[name]} ({stage_dir})")
+        self.artifact_paths = artifact_paths
+        return status
+
+
+def parse_stage(params, inputs, outputs, checkpoint):
+    from XMLParser import XMLParser
+
+    xml_parser = XMLParser(params['xml_file_path'])
+    xml_parser.save_to_json(xml_parser.parse_all_pages(**checkpoint), outputs['parsed_quests.json'])
+
+
+def filter_stage(params, inputs, outputs):
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator(inputs['parsed_quests.json'])
+    data_manipulator.save_quests_by_game(params['game'], outputs['filtered_quests.json'])
+
+
+def clean_stage(params, inputs, outputs):
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator(inputs['filtered_quests.json'])
+    data_manipulator.delete_replace_sanitize()
+    data_manipulator.replace_empty_string_with_none_in_memory_infobox()
+    data_manipulator.remove_null_key_values_in_memory_infobox()
+    data_manipulator.save_json(outputs['cleaned_quests.json'])
+
+
+def chapter_tag_stage(params, inputs, outputs, checkpoint):
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator(inputs['cleaned_quests.json'])
+    data_manipulator.match_quests_that_with_inside_manual_chapter_folder(params['chapter_folder'], **checkpoint)
+    data_manipulator.drop_unnessary_keys()
+    data_manipulator.save_json(outputs['chapter_tagged_quests.json'])
+
+
+def structure_stage(params, inputs, outputs, checkpoint):
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator(inputs['chapter_tagged_quests.json'])
+    data_manipulator.structure_dialogues(**checkpoint)
+    data_manipulator.save_json(outputs['structured_quests.json'])
+
+
+def categorize_stage(params, inputs, outputs):
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator(inputs['structured_quests.json'])
+    data_manipulator.save_categorized_quests(data_manipulator.categorize_quests(),
+                                             main_folder=outputs['categorized_quests'])
+
+
+def export_stage(params, inputs, outputs):
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator(inputs['structured_quests.json'])
+    data_manipulator.save_dialogues_to_csv(outputs['dialogues.csv'])
+    data_manipulator.save_dialogues_to_csv1(outputs['dialogues_with_speakers.csv'])
+
+
+def build_pipeline(params, cache_dir=".pipeline_cache", checkpoint_interval=100):
+    pipeline = Pipeline(params, cache_dir, checkpoint_interval)
+    pipeline.add_stage(Stage('parse', parse_stage, outputs=['parsed_quests.json'],
+                             sources=['xml_file_path'], checkpointed=True))
+    pipeline.add_stage(Stage('filter', filter_stage, inputs=['parsed_quests.json'],
+                             outputs=['filtered_quests.json'], params=['game']))
+    pipeline.add_stage(Stage('clean', clean_stage, inputs=['filtered_quests.json'],
+                             outputs=['cleaned_quests.json']))
+    pipeline.add_stage(Stage('chapter_tag', chapter_tag_stage, inputs=['cleaned_quests.json'],
+                             outputs=['chapter_tagged_quests.json'], sources=['chapter_folder'], checkpointed=True))
+    pipeline.add_stage(Stage('structure', structure_stage, inputs=['chapter_tagged_quests.json'],
+                             outputs=['structured_quests.json'], checkpointed=True))
+    pipeline.add_stage(Stage('categorize', categorize_stage, inputs=['structured_quests.json'],
+                             outputs=['categorized_quests']))
+    pipeline.add_stage(Stage('export', export_stage, inputs=['structured_quests.json'],
+                             outputs=['dialogues.csv', 'dialogues_with_speakers.csv']))
+    return pipeline
+
+
+def export_artifacts(pipeline, output_dir):
+    """Copy the final artifacts of a run out of the cache."""
+    os.makedirs(output_dir, exist_ok=True)
+    for artifact, path in pipeline.artifact_paths.items():
+        destination = os.path.join(output_dir, artifact)
+        if os.path.isdir(path):
+            shutil.copytree(path, destination, dirs_exist_ok=True)
+        else:
+            shutil.copyfile(path, destination)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the quest processing pipeline with cached stages.")
+    parser.add_argument('command', choices=['run', 'list'])
+    parser.add_argument('--stages', nargs='*', help="Stages to run, their dependencies run as needed.")
+    parser.add_argument('--force', action='store_true', help="Ignore cached stage outputs.")
+    parser.add_argument('--xml', default="Datasets/MainDatabaseNew.xml", help="MediaWiki XML dump.")
+    parser.add_argument('--chapters', default="Manual Chapterin", help="Manually tagged chapter folder.")
+    parser.add_argument('--game', default="odyssey", choices=['odyssey', 'valhalla'])
+    parser.add_argument('--cache-dir', default=".pipeline_cache")
+    parser.add_argument('--checkpoint-interval', type=int, default=100,
+                        help="Items between two journal writes of the parse, chapter_tag and structure stages.")
+    parser.add_argument('--output-dir', default=None, help="Copy the produced artifacts into this folder.")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, SCRIPTS_DIR)
+    from AppearanceNormalizer import ODYSSEY, VALHALLA
+
+    params = {
+        'xml_file_path': args.xml,
+        'chapter_folder': args.chapters,
+        'game': ODYSSEY if args.game == 'odyssey' else VALHALLA,
+    }
+    pipeline = build_pipeline(params, args.cache_dir, args.checkpoint_interval)
+
+    if args.command == 'list':
+        for name in pipeline.get_execution_order(args.stages):
+            stage = pipeline.stages[name]
+            print(f"{name}: {stage.inputs + stage.sources} -> {stage.outputs}")
+        return
+
+    pipeline.run(args.stages, force=args.force)
+    if args.output_dir:
+        export_artifacts(pipeline, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import re
+import json
+import hashlib
+from collections import OrderedDict
+
+
+placeholder_pattern = re.compile(r"\{([^{}\n]+)\}")
+
+# Same layout as the records generated before templates: overview, quest summary, then the setting
+DEFAULT_USER_TEMPLATE = (
+    " \"{Quest Title}\" Quest Narrative Generation \n\n"
+    "{Narrative Overview}"
+    "{Quest Summary}"
+    "{Setting}"
+)
+
+
+class PromptTemplate:
+    """
+    A prompt template with {Placeholder Name}-style fields, compiled once into literal and field parts.
+    Placeholders without a value are rendered unchanged, so the system prompt keeps its {Quest Title} markers.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.parts = []  # Even positions are literals, odd positions are field names
+        position = 0
+        for match in placeholder_pattern.finditer(template):
+            self.parts.append(template[position:match.start()])
+            self.parts.append(match.group(1))
+            position = match.end()
+        self.parts.append(template[position:])
+        self.fields = set(self.parts[1::2])
+
+    def render(self, values):
+        """
+        Render the template.
+        :param values: Dictionary mapping placeholder names to values.
+        :return: Rendered string.
+        """
+        if not self.fields:
+            return self.template
+        rendered = list(self.parts)
+        for index in range(1, len(rendered), 2):
+            field = rendered[index]
+            value = values.get(field)
+            rendered[index] = '{' + field + '}' if value is None else str(value)
+        return ''.join(rendered)
+
+
+class FragmentCache:
+    """
+    LRU cache for rendered per-quest fragments, keyed by fragment name and a hash of the source content.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_hash(content):
+        if not isinstance(content, str):
+            content = json.dumps(content, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get_or_render(self, name, content, render):
+        """
+        Return the cached fragment for the content or render and store it.
+        :param name: Fragment name, e.g. 'infobox_summary'.
+        :param content: Source content the fragment is derived from.
+        :param render: Callable rendering the fragment from the content.
+        """
+        key = (name, self.content_hash(content))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        fragment = render(content)
+        self.entries[key] = fragment
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return fragment
+
+    def get_statistics(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def save(self, file_path):
+        """Persist the cache so a later dataset regeneration can reuse the rendered fragments."""
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump([[name, digest, fragment] for (name, digest), fragment in self.entries.items()], f)
+
+    def load(self, file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for name, digest, fragment in json.load(f):
+                self.entries[(name, digest)] = fragment
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class QuestFragmentRenderer:
+    """
+    Renders the reusable per-quest fragments (narrative overview, setting, cleaned dialogue) through a FragmentCache.
+    Every non-empty fragment ends with a blank line separating it from the next one.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else FragmentCache()
+
+    def narrative_overview(self, quest):
+        description = (quest.get('MemoryInfobox') or {}).get('description')
+        if not description:
+            return ''
+        return self.cache.get_or_render('narrative_overview', description, self.render_narrative_overview)
+
+    def setting(self, quest):
+        memory_infobox = quest.get('MemoryInfobox') or {}
+        content = {
+            'MemoryInfobox': {key: memory_infobox.get(key) for key in ('source', 'location', 'date', 'type')},
+            'Chapter_Name': quest.get('Chapter_Name'),
+            'Chapter_Type': quest.get('Chapter_Type'),
+        }
+        return self.cache.get_or_render('setting', content, self.render_setting)
+
+    def infobox_summary(self, quest):
+        """Narrative overview followed by the setting."""
+        return self.narrative_overview(quest) + self.setting(quest)
+
+    def cleaned_dialogue(self, quest):
+        dialogue = quest.get('Section_Dialogue')
+        if not dialogue:
+            return dialogue
+        return self.cache.get_or_render('cleaned_dialogue', dialogue, self.render_cleaned_dialogue)
+
+    @staticmethod
+    def render_narrative_overview(description):
+        return f"**## Core Narrative Overview:**\n\n{description}\n\n"
+
+    @staticmethod
+    def render_setting(content):
+        memory_infobox = content['MemoryInfobox']
+        setting = [f"* **{key.capitalize()}:** {memory_infobox[key]}" for key in ('source', 'location', 'date', 'type')
+                   if memory_infobox.get(key)]
+        if content['Chapter_Name']:
+            setting.append(f"* **Chapter:** {content['Chapter_Name']} ({content['Chapter_Type'] or 'Unknown'})")
+        return "**## Setting:**\n\n" + "\n".join(setting) + "\n\n" if setting else ''
+
+    @staticmethod
+    def render_cleaned_dialogue(dialogue):
+        # Drop gallery images and blank lines, they carry no dialogue content
+        lines = []
+        for line in dialogue.split('\n'):
+            stripped = line.strip()
+            if stripped and not stripped.startswith('[[File:'):
+                lines.append(stripped)
+        return '\n'.join(lines)
@@ -0,0 +1,300 @@
+import re
+import heapq
+from array import array
+
+from QuestQuery import get_quest_key
+
+
+# Entries of one previous/next value are separated by line breaks
+entry_separator_pattern = re.compile(r"<br\s*/?>|\n", re.IGNORECASE)
+# Annotations after a quest name, e.g. {{c|support quest}} or (support) written without a space
+annotation_pattern = re.compile(r"\{\{[^{}]*\}\}|\((?:support|conditional|concurrent|non-canon)[^)]*\)", re.IGNORECASE)
+disambiguation_pattern = re.compile(r"\s*\([^()]*\)$")
+
+
+def parse_link_entries(value):
+    """
+    Quest names referenced by a MemoryInfobox previous/next value, in order. Links are resolved to
+    their target, e.g. "[[Lost and Found (Odyssey)|Lost and Found]]" or the sanitized
+    "Lost and Found (Odyssey)|Lost and Found" both give "Lost and Found (Odyssey)".
+    List headings like "Support quests:" are skipped.
+    """
+    if not isinstance(value, str):
+        return []
+    names = []
+    for entry in entry_separator_pattern.split(value):
+        entry = annotation_pattern.sub('', entry).replace('[[', '').replace(']]', '')
+        name = entry.split('|', 1)[0].strip().strip("'").strip()
+        if name and not name.endswith(':'):
+            names.append(name)
+    return names
+
+
+class QuestChainGraph:
+    """
+    Directed graph of the quest chains given by the MemoryInfobox previous/next links.
+    Quests get integer node ids in corpus order; an edge a -> b exists when b lists a as previous, or a lists
+    b as next unless b lists a as next too. Successors and predecessors are stored as CSR arrays,
+    so both lookups are a slice.
+    The topological order, the position of every node in it and the storylines (weakly connected
+    components, each in topological order) are computed once when the graph is built.
+    """
+
+    def __init__(self):
+        self.node_keys = []
+        self.node_names = []
+        self.node_positions = array('I')  # node -> position of the quest in the data
+        self.nodes_by_key = {}
+        self.nodes_by_name = {}
+        self.successor_offsets = array('I', [0])
+        self.successor_nodes = array('I')
+        self.predecessor_offsets = array('I', [0])
+        self.predecessor_nodes = array('I')
+        self.topological_order = array('I')
+        self.order_positions = array('I')  # node -> index in topological_order
+        self.storylines = []  # list of arrays of nodes in topological order
+        self.storyline_ids = array('I')  # node -> storyline
+        self.cycle_nodes = []
+        self.unresolved_links = []  # (quest name, link field, referenced name)
+        self.size = 0  # number of quests the graph was built from
+
+    def resolve_name(self, name, aliases):
+        """Resolve a referenced quest name to a node, trying the exact name, its case and a unique undisambiguated name."""
+        node = self.nodes_by_name.get(name)
+        if node is None:
+            node = aliases.get(name.casefold())
+        return node
+
+    def build(self, data):
+        """
+        :param data: List of quests, e.g. DataManipulator.data. Duplicates of a quest key are merged into one node.
+        :return: The graph itself.
+        """
+        infoboxes = []
+        for position, quest in enumerate(data):
+            quest_key = get_quest_key(quest)
+            if quest_key in self.nodes_by_key:
+                continue
+            node = len(self.node_keys)
+            self.nodes_by_key[quest_key] = node
+            self.node_keys.append(quest_key)
+            name = quest.get('Quest_Name') or quest.get('QuestName')
+            self.node_names.append(name)
+            self.node_positions.append(position)
+            if name is not None:
+                self.nodes_by_name.setdefault(name, node)
+            infoboxes.append(quest.get('MemoryInfobox') or {})
+
+        # 'Ashes to Ashes' refers to 'Ashes to Ashes (Odyssey)' when only one quest has that base name
+        aliases = {}
+        ambiguous = set()
+        for name, node in self.nodes_by_name.items():
+            for alias in {name.casefold(), disambiguation_pattern.sub('', name).casefold()}:
+                if alias in aliases and aliases[alias] != node:
+                    ambiguous.add(alias)
+                aliases[alias] = node
+        for alias in ambiguous - {name.casefold() for name in self.nodes_by_name}:
+            del aliases[alias]
+
+        previous_edges = set()
+        next_edges = set()
+        for node, memory_infobox in enumerate(infoboxes):
+            for field in ('previous', 'next'):
+                for name in parse_link_entries(memory_infobox.get(field)):
+                    other = self.resolve_name(name, aliases)
+                    if other is None:
+                        self.unresolved_links.append((self.node_names[node], field, name))
+                    elif other == node:
+                        continue
+                    elif field == 'previous':
+                        previous_edges.add((other, node))
+                    else:
+                        next_edges.add((node, other))
+
+        # Quests unlocked together list each other as next, e.g. 'Ajax on Fire' and 'The Blind Blacksmith'.
+        # A previous link decides the direction of such a pair, a pair only linked by next is not ordered.
+        edges = set(previous_edges)
+        for source, target in next_edges:
+            if (target, source) not in previous_edges and (target, source) not in next_edges:
+                edges.add((source, target))
+
+        node_count = len(self.node_keys)
+        self.successor_offsets, self.successor_nodes = self.build_adjacency(node_count, sorted(edges))
+        self.predecessor_offsets, self.predecessor_nodes = self.build_adjacency(
+            node_count, sorted((target, source) for source, target in edges))
+        self.compute_topological_order()
+        self.compute_storylines()
+        self.size = len(data)
+        return self
+
+    @staticmethod
+    def build_adjacency(node_count, sorted_edges):
+        offsets = array('I', [0] * (node_count + 1))
+        targets = array('I', (target for _, target in sorted_edges))
+        for source, _ in sorted_edges:
+            offsets[source + 1] += 1
+        for node in range(node_count):
+            offsets[node + 1] += offsets[node]
+        return offsets, targets
+
+    def get_successors(self, node):
+        return self.successor_nodes[self.successor_offsets[node]:self.successor_offsets[node + 1]]
+
+    def get_predecessors(self, node):
+        return self.predecessor_nodes[self.predecessor_offsets[node]:self.predecessor_offsets[node + 1]]
+
+    def get_strongly_connected_components(self):
+        """Iterative Tarjan, returns the component id of every node. Components of several nodes are link cycles."""
+        node_count = len(self.node_keys)
+        indexes = [-1] * node_count
+        lowlinks = [0] * node_count
+        on_stack = [False] * node_count
+        stack = []
+        components = array('I', [0] * node_count)
+        component_count = 0
+        counter = 0
+        for root in range(node_count):
+            if indexes[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, child_position = work.pop()
+                if child_position == 0:
+                    indexes[node] = lowlinks[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                successors = self.get_successors(node)
+                for position in range(child_position, len(successors)):
+                    successor = successors[position]
+                    if indexes[successor] == -1:
+                        work.append((node, position + 1))
+                        work.append((successor, 0))
+                        break
+                    if on_stack[successor]:
+                        lowlinks[node] = min(lowlinks[node], indexes[successor])
+                else:
+                    if lowlinks[node] == indexes[node]:
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = False
+                            components[member] = component_count
+                            if member == node:
+                                break
+                        component_count += 1
+                    if work:
+                        parent = work[-1][0]
+                        lowlinks[parent] = min(lowlinks[parent], lowlinks[node])
+        return components
+
+    def compute_topological_order(self):
+        """
+        Kahn's algorithm, always taking the lowest ready node id so the order follows the corpus order.
+        The links contain a few cycles, e.g. the last quest of an arc listing the first one as next.
+        When only cycles are left, the node of a cycle with no unplaced predecessors outside the cycle
+        and the fewest inside it is placed next, and listed in cycle_nodes.
+        """
+        node_count = len(self.node_keys)
+        components = self.get_strongly_connected_components()
+        in_degree = array('I', [0] * node_count)
+        external_in_degree = array('I', [0] * node_count)  # unplaced predecessors outside the node's component
+        for node in range(node_count):
+            for predecessor in self.get_predecessors(node):
+                in_degree[node] += 1
+                if components[predecessor] != components[node]:
+                    external_in_degree[node] += 1
+
+        ready = [node for node in range(node_count) if in_degree[node] == 0]
+        heapq.heapify(ready)
+        placed = array('B', [0] * node_count)
+        order = array('I')
+        self.cycle_nodes = []
+        while len(order) < node_count:
+            if not ready:
+                node = min((node for node in range(node_count) if not placed[node] and not external_in_degree[node]),
+                           key=lambda node: (in_degree[node], node))
+                self.cycle_nodes.append(node)
+                heapq.heappush(ready, node)
+            node = heapq.heappop(ready)
+            if placed[node]:
+                continue
+            placed[node] = 1
+            order.append(node)
+            for successor in self.get_successors(node):
+                if not placed[successor]:
+                    in_degree[successor] -= 1
+                    if components[successor] != components[node]:
+                        external_in_degree[successor] -= 1
+                    if in_degree[successor] == 0:
+                        heapq.heappush(ready, successor)
+
+        self.topological_order = order
+        self.order_positions = array('I', [0] * node_count)
+        for position, node in enumerate(order):
+            self.order_positions[node] = position
+
+    def compute_storylines(self):
+        node_count = len(self.node_keys)
+        parents = list(range(node_count))
+
+        def find(node):
+            while parents[node] != node:
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+
+        for source in range(node_count):
+            for target in self.get_successors(source):
+                root_source, root_target = find(source), find(target)
+                if root_source != root_target:
+                    parents[max(root_source, root_target)] = min(root_source, root_target)
+
+        storyline_by_root = {}
+        self.storylines = []
+        self.storyline_ids = array('I', [0] * node_count)
+        # Walking the topological order keeps every storyline in topological order
+        for node in self.topological_order:
+            root = find(node)
+            if root not in storyline_by_root:
+                storyline_by_root[root] = len(self.storylines)
+                self.storylines.append(array('I'))
+            self.storylines[storyline_by_root[root]].append(node)
+            self.storyline_ids[node] = storyline_by_root[root]
+
+    def get_node(self, quest_key=None, quest_name=None):
+        if quest_key is not None:
+            return self.nodes_by_key.get(str(quest_key))
+        return self.nodes_by_name.get(quest_name)
+
+    def get_chain_before(self, node, max_depth=None):
+        """
+        Walk back along the first predecessor of each quest.
+        :return: List of nodes from the earliest reached quest to the direct predecessor.
+        """
+        chain = []
+        seen = {node}
+        while max_depth is None or len(chain) < max_depth:
+            start, end = self.predecessor_offsets[node], self.predecessor_offsets[node + 1]
+            if start == end:
+                break
+            # With several predecessors the one latest in the topological order is the closest step back
+            node = max(self.predecessor_nodes[start:end], key=self.order_positions.__getitem__)
+            if node in seen:  # A cycle in the links
+                break
+            seen.add(node)
+            chain.append(node)
+        chain.reverse()
+        return chain
+
+    def get_storyline(self, node):
+        return self.storylines[self.storyline_ids[node]]
+
+    def get_statistics(self):
+        return {
+            'nodes': len(self.node_keys),
+            'edges': len(self.successor_nodes),
+            'storylines': len(self.storylines),
+            'longest_storyline': max((len(storyline) for storyline in self.storylines), default=0),
+            'cycle_nodes': len(self.cycle_nodes),
+            'unresolved_links': len(self.unresolved_links),
+        }
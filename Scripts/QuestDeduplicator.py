@@ -0,0 +1,202 @@
+import re
+import os
+import json
+import time
+import zlib
+from collections import defaultdict
+
+from QuestQuery import get_quest_key
+
+
+word_pattern = re.compile(r"[a-z0-9']+")
+markup_pattern = re.compile(r"\[\[(?:[^\]|]*\|)?([^\]]*)\]\]|'{2,}|\{\{[^}]*\}\}|<[^>]+>")
+MAX_HASH = 0xFFFFFFFF
+
+
+class QuestDeduplicator:
+    """
+    Finds near-duplicate quests with one-permutation MinHash signatures and LSH banding.
+    Each quest is hashed once, candidates only come from shared LSH buckets, so clustering
+    avoids the pairwise comparison of every quest against every other quest.
+    """
+
+    def __init__(self, num_perm=128, bands=16, threshold=0.8, shingle_size=3):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bin_size = (MAX_HASH + 1) // num_perm
+        self.signatures = {}
+        self.buckets = defaultdict(list)
+
+    @staticmethod
+    def get_quest_text(quest):
+        """Description and dialogue text the similarity is computed on."""
+        memory_infobox = quest.get('MemoryInfobox') or {}
+        parts = [memory_infobox.get('description'), quest.get('Section_Description'), quest.get('Section_Dialogue')]
+        return '\n'.join(part for part in parts if isinstance(part, str))
+
+    def get_shingles(self, text):
+        text = markup_pattern.sub(lambda match: match.group(1) or ' ', text.lower())
+        words = word_pattern.findall(text)
+        if len(words) < self.shingle_size:
+            return {' '.join(words)} if words else set()
+        return {' '.join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def get_signature(self, text):
+        """
+        One-permutation MinHash: a single hash per shingle, the hash range is split into num_perm bins
+        and the minimum of every bin is kept. Empty bins borrow the value of the next non-empty bin.
+        """
+        signature = [None] * self.num_perm
+        bin_size = self.bin_size
+        for shingle in self.get_shingles(text):
+            value = zlib.crc32(shingle.encode('utf-8'))
+            index = value // bin_size
+            offset = value - index * bin_size
+            current = signature[index]
+            if current is None or offset < current:
+                signature[index] = offset
+        if all(value is None for value in signature):
+            return None
+
+        # Densification by rotation keeps the signature comparable between sparse and dense quests
+        for index in range(self.num_perm):
+            if signature[index] is None:
+                step = 1
+                while signature[(index + step) % self.num_perm] is None:
+                    step += 1
+                signature[index] = signature[(index + step) % self.num_perm] + step * bin_size
+        return tuple(signature)
+
+    def estimate_similarity(self, signature_a, signature_b):
+        return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / self.num_perm
+
+    def add_quest(self, quest, key=None):
+        """
+        Compute the signature of a quest and insert it into the LSH buckets.
+        :param quest: Quest dictionary.
+        :param key: Key to identify the quest, defaults to its Quest_ID.
+        :return: The key, or None if the quest has no text to compare.
+        """
+        key = key if key is not None else get_quest_key(quest)
+        signature = self.get_signature(self.get_quest_text(quest))
+        if signature is None:
+            return None
+        self.signatures[key] = signature
+        for band in range(self.bands):
+            band_values = signature[band * self.rows:(band + 1) * self.rows]
+            self.buckets[(band, hash(band_values))].append(key)
+        return key
+
+    def find_clusters(self, quests=None):
+        """
+        Group near-duplicate quests.
+        :param quests: Optional iterable of quests to add before clustering.
+        :return: List of clusters (sorted lists of keys) with at least two members.
+        """
+        if quests is not None:
+            for quest in quests:
+                self.add_quest(quest)
+
+        parent = {}
+
+        def find(key):
+            parent.setdefault(key, key)
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+
+        checked = set()
+        self.comparisons = 0
+        for keys in self.buckets.values():
+            if len(keys) < 2:
+                continue
+            for i in range(len(keys)):
+                for j in range(i + 1, len(keys)):
+                    pair = (keys[i], keys[j]) if str(keys[i]) < str(keys[j]) else (keys[j], keys[i])
+                    if pair in checked:
+                        continue
+                    checked.add(pair)
+                    self.comparisons += 1
+                    if self.estimate_similarity(self.signatures[pair[0]], self.signatures[pair[1]]) >= self.threshold:
+                        root_a, root_b = find(pair[0]), find(pair[1])
+                        if root_a != root_b:
+                            parent[root_b] = root_a
+
+        clusters = defaultdict(list)
+        for key in parent:
+            clusters[find(key)].append(key)
+        return sorted((sorted(members, key=str) for members in clusters.values() if len(members) > 1),
+                      key=lambda members: str(members[0]))
+
+    @staticmethod
+    def get_split_keys(clusters):
+        """
+        Map every clustered quest key to the representative key of its cluster.
+        Using the representative for the train/validation split keeps all variants in the same split.
+        """
+        split_keys = {}
+        for members in clusters:
+            for key in members:
+                split_keys[key] = members[0]
+        return split_keys
+
+    @staticmethod
+    def find_cross_split_clusters(clusters, is_validation):
+        """
+        Return clusters whose members were assigned to both the training and the validation split.
+        :param clusters: Clusters from find_clusters.
+        :param is_validation: Callable taking a quest key and returning True for validation quests.
+        """
+        return [members for members in clusters if len({bool(is_validation(key)) for key in members}) > 1]
+
+
+def load_quests_from_folder(base_path):
+    quests = {}
+    for root, dirs, files in os.walk(base_path):
+        for file in files:
+            if file.endswith('.json'):
+                with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                    quest = json.load(f)
+                if isinstance(quest, dict):
+                    quests.setdefault(get_quest_key(quest), quest)
+    return list(quests.values())
+
+
+def run_benchmark(base_path="Quests", threshold=0.8):
+    """
+    Benchmark deduplication on every distinct quest below base_path.
+    :return: Dictionary with timings and cluster counts.
+    """
+    quests = load_quests_from_folder(base_path)
+    deduplicator = QuestDeduplicator(threshold=threshold)
+
+    start = time.perf_counter()
+    for quest in quests:
+        deduplicator.add_quest(quest)
+    signature_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    clusters = deduplicator.find_clusters()
+    cluster_seconds = time.perf_counter() - start
+
+    results = {
+        'quests': len(quests),
+        'signature_seconds': round(signature_seconds, 4),
+        'cluster_seconds': round(cluster_seconds, 4),
+        'candidate_comparisons': deduplicator.comparisons,
+        'pairwise_comparisons': len(quests) * (len(quests) - 1) // 2,
+        'clusters': len(clusters),
+        'clustered_quests': sum(len(members) for members in clusters),
+    }
+    print(results)
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark("Quests")
@@ -0,0 +1,365 @@
+import operator
+from itertools import islice
+
+from DialogueDataStructurer import SegmentList, SegmentType, extract_speaker_and_text
+
+
+class Missing:
+    """Value of a path that does not exist in a quest, distinct from a stored None."""
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = Missing()
+
+comparison_operators = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, values: value in values,
+    'contains': lambda value, part: part in value,
+}
+# Operators a HashIndex can answer by probing its buckets
+indexable_operators = {'==', 'in', 'exists', 'missing'}
+
+
+def get_path_value(quest, path):
+    """
+    Resolve a dotted path like 'MemoryInfobox.appearance' in a quest.
+    :return: The value, or MISSING if a key is absent or an intermediate value is not a dictionary.
+    """
+    value = quest
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def get_quest_key(quest):
+    """:return: Identity of a quest shared by the indexes, its Quest_ID or, for quests without one, its name."""
+    return str(quest.get('Quest_ID') or quest.get('QuestID') or quest.get('Quest_Name') or quest.get('QuestName'))
+
+
+class Predicate:
+    """Base class of the composable filters, combine them with &, | and ~."""
+
+    def matches(self, quest):
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class Comparison(Predicate):
+    def __init__(self, path, op, value=None):
+        self.path = path
+        self.op = op
+        self.value = value
+
+    def matches(self, quest):
+        value = get_path_value(quest, self.path)
+        if self.op == 'exists':
+            return value is not MISSING
+        if self.op == 'missing':
+            return value is MISSING
+        if value is MISSING:
+            return False
+        try:
+            return comparison_operators[self.op](value, self.value)
+        except TypeError:  # e.g. None < 3 or 'x' in None
+            return False
+
+    def __repr__(self):
+        if self.op in ('exists', 'missing'):
+            return f"{self.path} {self.op}"
+        return f"{self.path} {self.op} {self.value!r}"
+
+
+class Field:
+    """
+    Builds comparisons on a top-level key or a dotted path, e.g. Field('Chapter_Type') == 'World'
+    or Field('MemoryInfobox.location').contains('Athens').
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __eq__(self, value):
+        return Comparison(self.path, '==', value)
+
+    def __ne__(self, value):
+        return Comparison(self.path, '!=', value)
+
+    def __lt__(self, value):
+        return Comparison(self.path, '<', value)
+
+    def __le__(self, value):
+        return Comparison(self.path, '<=', value)
+
+    def __gt__(self, value):
+        return Comparison(self.path, '>', value)
+
+    def __ge__(self, value):
+        return Comparison(self.path, '>=', value)
+
+    __hash__ = None
+
+    def isin(self, values):
+        return Comparison(self.path, 'in', frozenset(values))
+
+    def contains(self, part):
+        return Comparison(self.path, 'contains', part)
+
+    def exists(self):
+        return Comparison(self.path, 'exists')
+
+    def missing(self):
+        return Comparison(self.path, 'missing')
+
+
+def Infobox(key):
+    """Field on a MemoryInfobox key."""
+    return Field(f"MemoryInfobox.{key}")
+
+
+class HasSegmentType(Predicate):
+    """Quests whose Structured_Dialogue contains at least one segment of a type."""
+
+    def __init__(self, segment_type):
+        self.segment_type = segment_type
+
+    def matches(self, quest):
+        structured_dialogue = quest.get('Structured_Dialogue')
+        if not structured_dialogue:
+            return False
+        if isinstance(structured_dialogue, SegmentList):
+            return structured_dialogue.count_type(self.segment_type) > 0
+        return any(segment['segment_type'] == self.segment_type.value for segment in structured_dialogue)
+
+    def __repr__(self):
+        return f"has {self.segment_type.value} segment"
+
+
+class HasSpeaker(Predicate):
+    """Quests in which a character speaks at least one dialogue line."""
+
+    def __init__(self, speaker):
+        self.speaker = speaker
+
+    def matches(self, quest):
+        for segment in quest.get('Structured_Dialogue') or []:
+            if segment['segment_type'] == SegmentType.DIALOGUE.value \
+                    and extract_speaker_and_text(segment['content'])[0] == self.speaker:
+                return True
+        return False
+
+    def __repr__(self):
+        return f"speaker {self.speaker!r}"
+
+
+class Where(Predicate):
+    """Arbitrary function of the quest, always evaluated by scanning."""
+
+    def __init__(self, function, name=None):
+        self.function = function
+        self.name = name or getattr(function, '__name__', 'function')
+
+    def matches(self, quest):
+        return bool(self.function(quest))
+
+    def __repr__(self):
+        return f"where {self.name}"
+
+
+class And(Predicate):
+    def __init__(self, *predicates):
+        # Flatten nested conjunctions so the planner sees every indexable part
+        self.predicates = []
+        for predicate in predicates:
+            self.predicates.extend(predicate.predicates if isinstance(predicate, And) else [predicate])
+
+    def matches(self, quest):
+        return all(predicate.matches(quest) for predicate in self.predicates)
+
+    def __repr__(self):
+        return "(" + " AND ".join(map(repr, self.predicates)) + ")"
+
+
+class Or(Predicate):
+    def __init__(self, *predicates):
+        self.predicates = []
+        for predicate in predicates:
+            self.predicates.extend(predicate.predicates if isinstance(predicate, Or) else [predicate])
+
+    def matches(self, quest):
+        return any(predicate.matches(quest) for predicate in self.predicates)
+
+    def __repr__(self):
+        return "(" + " OR ".join(map(repr, self.predicates)) + ")"
+
+
+class Not(Predicate):
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def matches(self, quest):
+        return not self.predicate.matches(quest)
+
+    def __repr__(self):
+        return f"NOT {self.predicate!r}"
+
+
+class HashIndex:
+    """
+    Positions of the quests per value of a path. Quests without the path are kept under MISSING,
+    so exists/missing predicates can be answered too.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.buckets = {}
+        self.size = 0
+        self.complete = True
+
+    def build(self, data):
+        self.buckets = {}
+        self.complete = True
+        for position, quest in enumerate(data):
+            value = get_path_value(quest, self.path)
+            try:
+                self.buckets.setdefault(value, []).append(position)
+            except TypeError:  # Unhashable values like lists cannot be probed, the planner falls back to a scan
+                self.complete = False
+        self.size = len(data)
+        return self
+
+    def probe(self, comparison):
+        """Return the sorted positions matching an indexable comparison."""
+        if comparison.op == '==':
+            return list(self.buckets.get(comparison.value, []))
+        if comparison.op == 'in':
+            return sorted({position for value in comparison.value for position in self.buckets.get(value, [])})
+        if comparison.op == 'missing':
+            return list(self.buckets.get(MISSING, []))
+        return sorted({position for value, positions in self.buckets.items() if value is not MISSING
+                       for position in positions})
+
+
+class Query:
+    """
+    Lazily evaluated query over a list of quests, e.g.
+    data_manipulator.query(Infobox('appearance') == appearance).select('Quest_Name').limit(10)
+    Conjunctions of ==, isin, exists and missing on indexed paths are answered by probing the
+    indexes, everything else is checked while scanning the remaining candidates once.
+    """
+
+    def __init__(self, data, indexes=None, predicate=None):
+        self.data = data
+        self.indexes = indexes or {}
+        self.predicate = predicate
+        self.fields = None
+        self.max_results = None
+
+    def where(self, predicate):
+        self.predicate = predicate if self.predicate is None else And(self.predicate, predicate)
+        return self
+
+    def select(self, *fields):
+        """Project the results on top-level keys or dotted paths, missing values become None."""
+        self.fields = fields
+        return self
+
+    def limit(self, max_results):
+        self.max_results = max_results
+        return self
+
+    def get_index(self, predicate):
+        if not isinstance(predicate, Comparison) or predicate.op not in indexable_operators:
+            return None
+        index = self.indexes.get(predicate.path)
+        # An index built before quests were added or removed would miss or misplace quests
+        if index is None or not index.complete or index.size != len(self.data):
+            return None
+        if predicate.op == '==':
+            try:
+                hash(predicate.value)
+            except TypeError:
+                return None
+        return index
+
+    def plan(self):
+        """
+        :return: Tuple (candidate positions or None for a full scan, residual predicate or None, description).
+        """
+        predicate = self.predicate
+        if predicate is None:
+            return None, None, "full scan"
+
+        if isinstance(predicate, Or):
+            indexes = [self.get_index(child) for child in predicate.predicates]
+            if all(indexes):
+                positions = sorted({position for index, child in zip(indexes, predicate.predicates)
+                                    for position in index.probe(child)})
+                return positions, None, f"index union {predicate!r}"
+            return None, predicate, f"full scan, filter {predicate!r}"
+
+        children = predicate.predicates if isinstance(predicate, And) else [predicate]
+        probed = []
+        residual = []
+        for child in children:
+            index = self.get_index(child)
+            if index is None:
+                residual.append(child)
+            else:
+                probed.append(index.probe(child))
+        residual_predicate = And(*residual) if len(residual) > 1 else (residual[0] if residual else None)
+        if not probed:
+            return None, residual_predicate, f"full scan, filter {predicate!r}"
+
+        probed.sort(key=len)
+        candidates = set(probed[0])
+        for positions in probed[1:]:
+            candidates.intersection_update(positions)
+        description = f"index probe ({len(candidates)} candidates)"
+        if residual_predicate is not None:
+            description += f", filter {residual_predicate!r}"
+        return sorted(candidates), residual_predicate, description
+
+    def explain(self):
+        return self.plan()[2]
+
+    def project(self, quest):
+        if self.fields is None:
+            return quest
+        values = {}
+        for field in self.fields:
+            value = get_path_value(quest, field)
+            values[field] = None if value is MISSING else value
+        return values
+
+    def __iter__(self):
+        positions, residual, _ = self.plan()
+        quests = self.data if positions is None else (self.data[position] for position in positions)
+        matching = (quest for quest in quests if residual is None or residual.matches(quest))
+        results = (self.project(quest) for quest in matching)
+        return iter(results if self.max_results is None else islice(results, self.max_results))
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        return next(iter(self), None)
+
+    def count(self):
+        return sum(1 for _ in self)
@@ -0,0 +1,298 @@
+import re
+import json
+import math
+import hashlib
+import heapq
+from collections import defaultdict
+
+from DialogueDataStructurer import SegmentType, extract_speaker_and_text
+from QuestQuery import get_quest_key
+
+
+term_pattern = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+markup_pattern = re.compile(r"\[\[(?:[^\]|]*\|)?([^\]]*)\]\]|'{2,}|<[^>]+>")
+phrase_pattern = re.compile(r'"([^"]+)"')
+
+# Quest level text that is indexed next to the structured dialogue segments
+SECTION_KEYS = ['General_Description', 'Section_Description', 'Section_Outcome']
+FILTER_FIELDS = ['quest', 'chapter_type', 'location', 'speaker', 'addressee', 'segment_type', 'section']
+
+
+class QuestSearchIndex:
+    """
+    Inverted index over quest sections and structured dialogue segments with BM25 ranking,
+    phrase queries and exact-match filters (quest, chapter type, location, speaker, addressee, segment type).
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = {}  # doc_id -> document metadata
+        self.postings = defaultdict(dict)  # term -> {doc_id: [positions]}
+        self.filters = defaultdict(set)  # (field, value) -> {doc_id}
+        self.quest_documents = defaultdict(list)  # quest key -> [doc_id]
+        self.quest_hashes = {}  # quest key -> content hash
+        self.next_doc_id = 0
+        self.total_length = 0
+
+    @staticmethod
+    def tokenize(text):
+        if not text:
+            return []
+        return term_pattern.findall(markup_pattern.sub(lambda match: match.group(1) or ' ', text).lower())
+
+    @staticmethod
+    def get_quest_hash(quest):
+        return hashlib.md5(json.dumps(quest, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def add_document(self, quest_key, content, metadata, filter_values):
+        terms = self.tokenize(content)
+        doc_id = self.next_doc_id
+        self.next_doc_id += 1
+
+        positions = defaultdict(list)
+        for position, term in enumerate(terms):
+            positions[term].append(position)
+        for term, term_positions in positions.items():
+            self.postings[term][doc_id] = term_positions
+
+        metadata['length'] = len(terms)
+        metadata['content'] = content
+        metadata['filters'] = filter_values
+        self.documents[doc_id] = metadata
+        self.total_length += len(terms)
+        for field, values in filter_values.items():
+            for value in values:
+                self.filters[(field, value.lower())].add(doc_id)
+        self.quest_documents[quest_key].append(doc_id)
+
+    def add_quest(self, quest):
+        """
+        Index the sections and dialogue segments of a quest.
+        :param quest: Quest dictionary.
+        """
+        quest_key = get_quest_key(quest)
+        if quest_key in self.quest_hashes:
+            self.remove_quest(quest_key)
+        self.quest_hashes[quest_key] = self.get_quest_hash(quest)
+
+        memory_infobox = quest.get('MemoryInfobox') or {}
+        quest_filters = {'quest': [str(value) for value in (quest_key, quest.get('Quest_Name')) if value]}
+        if quest.get('Chapter_Type'):
+            quest_filters['chapter_type'] = [quest['Chapter_Type']]
+        if memory_infobox.get('location'):
+            quest_filters['location'] = [part.strip() for part in memory_infobox['location'].split(',') if part.strip()]
+
+        for section in SECTION_KEYS:
+            if quest.get(section):
+                metadata = {'quest': quest_key, 'quest_name': quest.get('Quest_Name'), 'section': section}
+                self.add_document(quest_key, quest[section], metadata, dict(quest_filters, section=[section]))
+
+        segments = quest.get('Structured_Dialogue') or []
+        speakers = [extract_speaker_and_text(segment['content'])[0]
+                    if segment['segment_type'] == SegmentType.DIALOGUE.value else None for segment in segments]
+        for position, segment in enumerate(segments):
+            metadata = {'quest': quest_key, 'quest_name': quest.get('Quest_Name'), 'section': 'Structured_Dialogue',
+                        'global_id': segment['global_id'], 'segment_type': segment['segment_type']}
+            filter_values = dict(quest_filters, section=['Structured_Dialogue'], segment_type=[segment['segment_type']])
+            speaker = speakers[position]
+            if speaker:
+                metadata['speaker'] = speaker
+                filter_values['speaker'] = [speaker]
+                filter_values['addressee'] = self.get_addressees(speakers, position)
+            self.add_document(quest_key, segment['content'], metadata, filter_values)
+
+    @staticmethod
+    def get_addressees(speakers, position):
+        # The nearest different speakers before and after a line are taken as the ones being addressed
+        addressees = []
+        for step in (-1, 1):
+            index = position + step
+            while 0 <= index < len(speakers):
+                if speakers[index] and speakers[index] != speakers[position]:
+                    addressees.append(speakers[index])
+                    break
+                index += step
+        return addressees
+
+    def remove_quest(self, quest_key):
+        for doc_id in self.quest_documents.pop(quest_key, []):
+            document = self.documents.pop(doc_id)
+            self.total_length -= document['length']
+            for term in set(self.tokenize(document['content'])):
+                postings = self.postings[term]
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self.postings[term]
+            for field, values in document['filters'].items():
+                for value in values:
+                    self.filters[(field, value.lower())].discard(doc_id)
+        self.quest_hashes.pop(quest_key, None)
+
+    def build(self, data):
+        """
+        Update the index to match the given quests. Only new and changed quests are re-indexed,
+        quests that are no longer present are removed.
+        :param data: List of quests, e.g. DataManipulator.data.
+        :return: Dictionary with the number of added, updated, unchanged and removed quests.
+        """
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        seen = set()
+        for quest in data:
+            quest_key = get_quest_key(quest)
+            seen.add(quest_key)
+            previous_hash = self.quest_hashes.get(quest_key)
+            if previous_hash is None:
+                counts['added'] += 1
+            elif previous_hash == self.get_quest_hash(quest):
+                counts['unchanged'] += 1
+                continue
+            else:
+                counts['updated'] += 1
+            self.add_quest(quest)
+
+        for quest_key in list(self.quest_hashes):
+            if quest_key not in seen:
+                self.remove_quest(quest_key)
+                counts['removed'] += 1
+        return counts
+
+    def filter_documents(self, **filters):
+        """
+        Return the ids of documents matching all filters, e.g. speaker='Kassandra', chapter_type='Character'.
+        :return: Set of document ids, or None if no filter was given.
+        """
+        matches = []
+        for field, value in filters.items():
+            if value is None:
+                continue
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"Unknown filter '{field}', expected one of {FILTER_FIELDS}")
+            matches.append(self.filters.get((field, str(value).lower()), set()))
+        if not matches:
+            return None
+
+        # Intersect starting from the most selective filter
+        matches.sort(key=len)
+        result = set(matches[0])
+        for match in matches[1:]:
+            if not result:
+                break
+            result &= match
+        return result
+
+    def contains_phrase(self, doc_id, phrase_terms):
+        first_positions = self.postings.get(phrase_terms[0], {}).get(doc_id)
+        if not first_positions:
+            return False
+        following = [set(self.postings.get(term, {}).get(doc_id, ())) for term in phrase_terms[1:]]
+        return any(all(start + offset + 1 in positions for offset, positions in enumerate(following))
+                   for start in first_positions)
+
+    def search(self, query, limit=10, **filters):
+        """
+        BM25-ranked search. Quoted parts of the query must appear as phrases.
+        Example: search('"sacred grove" wolf', speaker='Kassandra', location='Phokis').
+        :param query: Query string.
+        :param limit: Maximum number of results.
+        :return: List of result dictionaries with 'score' and 'doc_id' added.
+        """
+        phrases = [self.tokenize(phrase) for phrase in phrase_pattern.findall(query)]
+        phrases = [phrase for phrase in phrases if phrase]
+        terms = self.tokenize(phrase_pattern.sub(' ', query)) + [term for phrase in phrases for term in phrase]
+        allowed = self.filter_documents(**filters)
+
+        if not terms:
+            doc_ids = sorted(allowed) if allowed is not None else []
+            return [self.get_result(doc_id, 0.0) for doc_id in doc_ids[:limit]]
+
+        # Phrases restrict the candidates before scoring, so common phrase terms are not scored for every document
+        if phrases:
+            phrase_terms = sorted({term for phrase in phrases for term in phrase},
+                                  key=lambda term: len(self.postings.get(term, ())))
+            candidates = set(self.postings.get(phrase_terms[0], ()))
+            for term in phrase_terms[1:]:
+                candidates &= self.postings.get(term, {}).keys()
+            if allowed is not None:
+                candidates &= allowed
+            allowed = {doc_id for doc_id in candidates if all(self.contains_phrase(doc_id, phrase) for phrase in phrases)}
+
+        document_count = len(self.documents)
+        average_length = self.total_length / document_count if document_count else 0
+        scores = defaultdict(float)
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            if allowed is not None and len(allowed) < len(postings):
+                matched = ((doc_id, postings[doc_id]) for doc_id in allowed if doc_id in postings)
+            else:
+                matched = ((doc_id, positions) for doc_id, positions in postings.items()
+                           if allowed is None or doc_id in allowed)
+            for doc_id, positions in matched:
+                length_norm = 1 - self.b + self.b * self.documents[doc_id]['length'] / average_length
+                frequency = len(positions)
+                scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [self.get_result(doc_id, score) for doc_id, score in best]
+
+    def find_lines(self, speaker=None, addressee=None, limit=None, **filters):
+        """
+        Return dialogue lines by speaker and/or addressee in corpus order,
+        e.g. find_lines(speaker='Kassandra', addressee='Myrrine').
+        """
+        doc_ids = self.filter_documents(speaker=speaker, addressee=addressee, **filters)
+        doc_ids = sorted(doc_ids) if doc_ids is not None else []
+        return [self.get_result(doc_id) for doc_id in doc_ids[:limit]]
+
+    def get_result(self, doc_id, score=None):
+        document = self.documents[doc_id]
+        result = {key: value for key, value in document.items() if key not in ('filters', 'length')}
+        result['doc_id'] = doc_id
+        if score is not None:
+            result['score'] = score
+        return result
+
+    def save(self, file_path):
+        """Save the index to a JSON file, the filter sets are rebuilt from the stored documents on load."""
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'k1': self.k1,
+                'b': self.b,
+                'next_doc_id': self.next_doc_id,
+                'quest_hashes': self.quest_hashes,
+                'quest_documents': self.quest_documents,
+                'documents': self.documents,
+                'postings': self.postings,
+            }, f)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+        index = cls(stored['k1'], stored['b'])
+        index.next_doc_id = stored['next_doc_id']
+        index.quest_hashes = stored['quest_hashes']
+        index.quest_documents = defaultdict(list, stored['quest_documents'])
+        index.documents = {int(doc_id): document for doc_id, document in stored['documents'].items()}
+        for term, postings in stored['postings'].items():
+            index.postings[term] = {int(doc_id): positions for doc_id, positions in postings.items()}
+        for doc_id, document in index.documents.items():
+            index.total_length += document['length']
+            for field, values in document['filters'].items():
+                for value in values:
+                    index.filters[(field, value.lower())].add(doc_id)
+        return index
+
+
+if __name__ == "__main__":
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator("OdysseyChapterAndSequenceStructuredDialogue.json")
+    search_index = QuestSearchIndex()
+    print(search_index.build(data_manipulator.data))
+    search_index.save("quest_search_index.json")
+    for line in search_index.find_lines(speaker="Kassandra", addressee="Myrrine", limit=10):
+        print(line['quest_name'], line['content'])
@@ -0,0 +1,313 @@
+import os
+import json
+import asyncio
+import hashlib
+import argparse
+from collections import OrderedDict, Counter
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from DataManipulator import DataManipulator
+from DialogueDataStructurer import SegmentType, extract_speaker_and_text, segment_to_dict, serialize_segment
+from QuestQuery import Field, HasSpeaker, get_quest_key
+from AppearanceNormalizer import normalize_appearance
+
+
+status_reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+# Paths indexed at startup, the filters of /quests on them are answered by index probes
+indexed_paths = ['Quest_ID', 'Quest_Name', 'Chapter_Type', 'Chapter_Name', 'MemoryInfobox.appearance']
+# Query parameters of /quests that filter on a field, everything else is an option
+filter_paths = {
+    'chapter_type': 'Chapter_Type',
+    'chapter_name': 'Chapter_Name',
+    'appearance': 'MemoryInfobox.appearance',
+    'location': 'MemoryInfobox.location',
+    'source': 'MemoryInfobox.source',
+}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class QuestService:
+    """
+    Read-only HTTP/JSON service over a processed corpus, e.g. OdysseyChapterAndSequenceStructuredDialogue.json.
+    The corpus is loaded and indexed once, lookups then take milliseconds instead of a reload per tool.
+    Every response is keyed by the corpus version (a hash of the file) and the request target:
+    responses are cached in an LRU and carry an ETag, so a client sending If-None-Match gets a
+    304 without a body. Connections are served by asyncio and kept alive between requests.
+
+    GET /quests/<Quest_ID>                        one quest
+    GET /quests/by-name/<Quest_Name>              one quest
+    GET /quests?chapter_type=World&game=odyssey   filtered quests, also appearance, location, source,
+                                                  speaker, fields=Quest_Name,Quest_ID, limit, offset
+    GET /quests/<Quest_ID>/dialogue               Structured_Dialogue segments, filter with segment_type and speaker
+    GET /statistics                               corpus counts
+    """
+
+    def __init__(self, json_file_path, cache_size=1024, default_limit=100):
+        self.json_file_path = json_file_path
+        self.cache_size = cache_size
+        self.default_limit = default_limit
+        self.response_cache = OrderedDict()  # request target -> (status, body)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.requests = 0
+        self.load()
+
+    def load(self):
+        """Load the corpus, build the indexes and start a new version, cached responses of the old one are dropped."""
+        digest = hashlib.blake2b(digest_size=8)
+        with open(self.json_file_path, 'rb') as f:
+            content = f.read()
+        digest.update(content)
+        self.version = digest.hexdigest()
+
+        self.data_manipulator = DataManipulator()
+        self.data_manipulator.data = json.loads(content)
+        for path in indexed_paths:
+            self.data_manipulator.create_index(path)
+        self.quests_by_key = {get_quest_key(quest): quest for quest in self.data_manipulator.data}
+        self.games = {}  # lowercase full or short name like 'odyssey' -> canonical game name
+        self.game_appearances = {}  # canonical game name -> raw appearance values, probed on the appearance index
+        for quest in self.data_manipulator.data:
+            appearance = (quest.get('MemoryInfobox') or {}).get('appearance')
+            game = normalize_appearance(appearance)[0]
+            if game:
+                self.games[game.lower()] = game
+                self.games[game.split(':')[-1].strip().lower()] = game
+                self.game_appearances.setdefault(game, set()).add(appearance)
+        self.loaded_mtime = os.path.getmtime(self.json_file_path)
+        self.response_cache.clear()
+        print(f"Loaded {len(self.data_manipulator.data)} quests from {self.json_file_path}, version {self.version}")
+
+    def reload_if_changed(self):
+        if os.path.getmtime(self.json_file_path) != self.loaded_mtime:
+            self.load()
+
+    def get_etag(self, target):
+        return '"' + self.version + '-' + hashlib.blake2b(target.encode('utf-8'), digest_size=8).hexdigest() + '"'
+
+    @staticmethod
+    def get_option(options, name, default=None):
+        values = options.get(name)
+        return values[-1] if values else default
+
+    def get_int_option(self, options, name, default):
+        value = self.get_option(options, name)
+        if value is None:
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            raise RequestError(400, f"'{name}' must be an integer")
+        if number < 0:
+            raise RequestError(400, f"'{name}' must not be negative")
+        return number
+
+    def get_quest(self, quest_key):
+        quest = self.quests_by_key.get(quest_key)
+        if quest is None:
+            raise RequestError(404, f"No quest with id '{quest_key}'")
+        return quest
+
+    def get_quest_by_name(self, quest_name):
+        quest = self.data_manipulator.query(Field('Quest_Name') == quest_name).first()
+        if quest is None:
+            raise RequestError(404, f"No quest named '{quest_name}'")
+        return quest
+
+    def filter_quests(self, options):
+        query = self.data_manipulator.query()
+        for name, path in filter_paths.items():
+            values = options.get(name)
+            if values:
+                query.where(Field(path) == values[0] if len(values) == 1 else Field(path).isin(values))
+        game_name = self.get_option(options, 'game')
+        if game_name is not None:
+            game = self.games.get(game_name.lower())
+            if game is None:
+                raise RequestError(400, f"Unknown game '{game_name}', expected one of {sorted(set(self.games.values()))}")
+            query.where(Field('MemoryInfobox.appearance').isin(self.game_appearances[game]))
+        speaker = self.get_option(options, 'speaker')
+        if speaker is not None:
+            query.where(HasSpeaker(speaker))
+
+        fields = self.get_option(options, 'fields')
+        if fields:
+            query.select(*fields.split(','))
+        offset = self.get_int_option(options, 'offset', 0)
+        limit = self.get_int_option(options, 'limit', self.default_limit)
+        results = list(query)
+        return {
+            'total': len(results),
+            'offset': offset,
+            'plan': query.explain(),
+            'quests': results[offset:offset + limit],
+        }
+
+    def get_dialogue(self, quest, options):
+        segment_type = self.get_option(options, 'segment_type')
+        if segment_type is not None and segment_type not in {member.value for member in SegmentType}:
+            raise RequestError(400, f"Unknown segment type '{segment_type}'")
+        speaker = self.get_option(options, 'speaker')
+        segments = []
+        for segment in quest.get('Structured_Dialogue') or []:
+            if segment_type is not None and segment['segment_type'] != segment_type:
+                continue
+            if speaker is not None and (segment['segment_type'] != SegmentType.DIALOGUE.value
+                                        or extract_speaker_and_text(segment['content'])[0] != speaker):
+                continue
+            segments.append(segment_to_dict(segment))
+        return {'Quest_ID': quest.get('Quest_ID'), 'Quest_Name': quest.get('Quest_Name'), 'segments': segments}
+
+    def get_statistics(self):
+        data = self.data_manipulator.data
+        segment_types = Counter()
+        for quest in data:
+            for segment in quest.get('Structured_Dialogue') or []:
+                segment_types[segment['segment_type']] += 1
+        games = Counter()
+        for quest in data:
+            games[normalize_appearance((quest.get('MemoryInfobox') or {}).get('appearance'))[0]] += 1
+        return {
+            'version': self.version,
+            'quests': len(data),
+            'chapter_types': dict(Counter(quest.get('Chapter_Type') for quest in data).most_common()),
+            'games': {str(game): count for game, count in games.most_common()},
+            'segment_types': dict(segment_types.most_common()),
+            'memory_infobox': self.data_manipulator.get_memory_infobox_statistics(),
+        }
+
+    def route(self, path, options):
+        parts = [unquote(part) for part in path.strip('/').split('/') if part]
+        if parts == ['statistics']:
+            return self.get_statistics()
+        if parts == ['quests']:
+            return self.filter_quests(options)
+        if len(parts) == 3 and parts[:2] == ['quests', 'by-name']:
+            return self.get_quest_by_name(parts[2])
+        if len(parts) == 2 and parts[0] == 'quests':
+            return self.get_quest(parts[1])
+        if len(parts) == 3 and parts[0] == 'quests' and parts[2] == 'dialogue':
+            return self.get_dialogue(self.get_quest(parts[1]), options)
+        raise RequestError(404, f"Unknown path '{path}'")
+
+    def get_response(self, target):
+        """
+        :param target: Request target, path and query string.
+        :return: Tuple (status, JSON body bytes), from the response cache when possible.
+        """
+        cached = self.response_cache.get(target)
+        if cached is not None:
+            self.cache_hits += 1
+            self.response_cache.move_to_end(target)
+            return cached
+
+        self.cache_misses += 1
+        url = urlsplit(target)
+        try:
+            status, result = 200, self.route(url.path, parse_qs(url.query))
+        except RequestError as e:
+            status, result = e.status, {'error': e.message}
+        response = (status, json.dumps(result, ensure_ascii=False, default=serialize_segment).encode('utf-8'))
+        self.response_cache[target] = response
+        if len(self.response_cache) > self.cache_size:
+            self.response_cache.popitem(last=False)
+        return response
+
+    async def write_response(self, writer, status, body, headers, head_only=False):
+        lines = [f"HTTP/1.1 {status} {status_reasons.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Content-Length: {len(body)}")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body and not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.write_response(writer, 400, b'', {'Connection': 'close'})
+                    break
+                request_headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    request_headers[name.strip().lower()] = value.strip()
+                if request_headers.get('content-length'):
+                    await reader.readexactly(int(request_headers['content-length']))
+
+                self.requests += 1
+                keep_alive = request_headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                headers = {'Content-Type': 'application/json; charset=utf-8',
+                           'Connection': 'keep-alive' if keep_alive else 'close'}
+                if method not in ('GET', 'HEAD'):
+                    headers['Allow'] = 'GET, HEAD'
+                    await self.write_response(writer, 405, b'{"error": "read-only service"}', headers)
+                else:
+                    etag = self.get_etag(target)
+                    headers['ETag'] = etag
+                    headers['Cache-Control'] = 'no-cache'  # Clients revalidate, unchanged corpus versions answer 304
+                    if etag in [tag.strip() for tag in request_headers.get('if-none-match', '').split(',')]:
+                        await self.write_response(writer, 304, b'', headers)
+                    else:
+                        status, body = self.get_response(target)
+                        await self.write_response(writer, status, body, headers, head_only=method == 'HEAD')
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def watch_corpus(self, interval):
+        # A new corpus file starts a new version, so stale ETags stop matching
+        while True:
+            await asyncio.sleep(interval)
+            self.reload_if_changed()
+
+    async def serve(self, host='127.0.0.1', port=8765, watch_interval=None):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving {self.json_file_path} on http://{host}:{port}")
+        if watch_interval:
+            asyncio.get_running_loop().create_task(self.watch_corpus(watch_interval))
+        async with server:
+            await server.serve_forever()
+
+    def get_cache_statistics(self):
+        total = self.cache_hits + self.cache_misses
+        return {
+            'size': len(self.response_cache),
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': self.cache_hits / total if total else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve read-only quest queries over HTTP.")
+    parser.add_argument('json_file_path', nargs='?', default="OdysseyChapterAndSequenceStructuredDialogue.json")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--watch', type=float, default=None, help="Reload the corpus when the file changes, "
+                                                                  "checked every n seconds.")
+    args = parser.parse_args()
+
+    quest_service = QuestService(args.json_file_path, cache_size=args.cache_size)
+    try:
+        asyncio.run(quest_service.serve(args.host, args.port, args.watch))
+    except KeyboardInterrupt:
+        print(f"Served {quest_service.requests} requests, response cache: {quest_service.get_cache_statistics()}")
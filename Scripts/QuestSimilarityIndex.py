@@ -0,0 +1,305 @@
+import os
+import json
+import math
+import mmap
+import heapq
+from array import array
+from collections import Counter, defaultdict
+
+from DialogueDataStructurer import SegmentType, extract_speaker_and_text
+from QuestQuery import get_quest_key
+from QuestSearchIndex import QuestSearchIndex
+
+
+# Quest level text a quest is compared on, dialogue text is added from Structured_Dialogue
+TEXT_KEYS = ['General_Description', 'Section_Description']
+# Arrays written by save(), with their typecodes
+ARRAY_TYPECODES = {
+    'row_offsets': 'Q',
+    'row_terms': 'I',
+    'row_counts': 'f',
+    'deleted': 'B',
+    'document_frequency': 'I',
+    'idf': 'f',
+    'column_offsets': 'Q',
+    'column_rows': 'I',
+    'column_weights': 'f',
+}
+
+
+def map_array(file_path, typecode):
+    """Memory-map an array written with array.tofile(), returned as a read-only memoryview of the typecode."""
+    if os.path.getsize(file_path) == 0:
+        return array(typecode)
+    with open(file_path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+class QuestSimilarityIndex:
+    """
+    TF-IDF index for finding the quests most similar to a text or to another quest, e.g. to pick few-shot examples.
+    Quests are rows of a sparse matrix kept in flat arrays: the raw term counts in CSR form
+    (row_offsets, row_terms, row_counts) and, once finalized, the normalized TF-IDF weights in CSC form
+    (column_offsets, column_rows, column_weights), so a query only touches the columns of its own terms.
+    Adding quests appends rows and marks the weights stale, they are recomputed in one O(nonzeros)
+    pass before the next query. Terms in more than max_document_ratio of the quests carry little
+    signal and are left out of the weights, which also keeps the longest columns out of every query.
+    """
+
+    def __init__(self, max_document_ratio=0.5, min_document_frequency=1):
+        self.max_document_ratio = max_document_ratio
+        self.min_document_frequency = min_document_frequency
+        self.quest_keys = []
+        self.quest_names = []
+        self.rows = {}  # quest key -> row
+        self.terms = []
+        self.vocabulary = {}  # term -> term id
+        self.row_offsets = array('Q', [0])
+        self.row_terms = array('I')
+        self.row_counts = array('f')
+        self.deleted = array('B')
+        self.document_frequency = array('I')
+        self.idf = array('f')
+        self.column_offsets = array('Q', [0])
+        self.column_rows = array('I')
+        self.column_weights = array('f')
+        self.stale = False
+
+    @staticmethod
+    def get_quest_text(quest):
+        texts = [quest[key] for key in TEXT_KEYS if isinstance(quest.get(key), str)]
+        segments = quest.get('Structured_Dialogue')
+        if segments:
+            for segment in segments:
+                if segment['segment_type'] == SegmentType.DIALOGUE.value:
+                    texts.append(extract_speaker_and_text(segment['content'])[1] or '')
+        elif isinstance(quest.get('Section_Dialogue'), str):
+            texts.append(quest['Section_Dialogue'])
+        return '\n'.join(texts)
+
+    def make_writable(self):
+        # Arrays loaded with mmap are read-only views, copy them before the first change
+        for name, typecode in ARRAY_TYPECODES.items():
+            value = getattr(self, name)
+            if not isinstance(value, array):
+                setattr(self, name, array(typecode, value))
+
+    def add_quest(self, quest):
+        """
+        Append a quest as a new row, a quest already in the index is replaced.
+        :param quest: Quest dictionary.
+        """
+        self.make_writable()
+        quest_key = get_quest_key(quest)
+        if quest_key in self.rows:
+            self.remove_quest(quest_key)
+
+        counts = Counter()
+        for term in QuestSearchIndex.tokenize(self.get_quest_text(quest)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                term_id = len(self.terms)
+                self.vocabulary[term] = term_id
+                self.terms.append(term)
+                self.document_frequency.append(0)
+            counts[term_id] += 1
+
+        for term_id in sorted(counts):
+            self.row_terms.append(term_id)
+            self.row_counts.append(counts[term_id])
+            self.document_frequency[term_id] += 1
+        self.row_offsets.append(len(self.row_terms))
+        self.deleted.append(0)
+        self.rows[quest_key] = len(self.quest_keys)
+        self.quest_keys.append(quest_key)
+        self.quest_names.append(quest.get('Quest_Name') or quest.get('QuestName'))
+        self.stale = True
+
+    def remove_quest(self, quest_key):
+        """Mark the row of a quest as deleted, its terms no longer count towards the document frequencies."""
+        self.make_writable()
+        row = self.rows.pop(quest_key)
+        self.deleted[row] = 1
+        for position in range(self.row_offsets[row], self.row_offsets[row + 1]):
+            self.document_frequency[self.row_terms[position]] -= 1
+        self.stale = True
+
+    def build(self, data):
+        """
+        Add every quest of a list, e.g. DataManipulator.data, and compute the weights.
+        :return: The index itself.
+        """
+        for quest in data:
+            self.add_quest(quest)
+        self.finalize()
+        return self
+
+    def get_row_weights(self, row, idf):
+        """Sublinear TF-IDF weights of a row as a list of (term id, weight), normalized to unit length."""
+        weights = []
+        for position in range(self.row_offsets[row], self.row_offsets[row + 1]):
+            term_id = self.row_terms[position]
+            if idf[term_id]:
+                weights.append((term_id, (1 + math.log(self.row_counts[position])) * idf[term_id]))
+        norm = math.sqrt(sum(weight * weight for _, weight in weights))
+        return [(term_id, weight / norm) for term_id, weight in weights] if norm else []
+
+    def finalize(self):
+        """Recompute the IDF and the CSC weight arrays from the term counts."""
+        if not self.stale:
+            return
+        self.make_writable()
+        document_count = len(self.rows)
+        max_frequency = self.max_document_ratio * document_count
+        self.idf = array('f', (math.log((1 + document_count) / (1 + frequency)) + 1
+                               if self.min_document_frequency <= frequency <= max_frequency else 0.0
+                               for frequency in self.document_frequency))
+
+        # Counting sort of the nonzeros by term id gives the columns without sorting the entries
+        column_lengths = array('Q', bytes(8 * len(self.terms)))
+        row_weights = []
+        for row in range(len(self.quest_keys)):
+            weights = [] if self.deleted[row] else self.get_row_weights(row, self.idf)
+            row_weights.append(weights)
+            for term_id, _ in weights:
+                column_lengths[term_id] += 1
+        self.column_offsets = array('Q', [0])
+        for length in column_lengths:
+            self.column_offsets.append(self.column_offsets[-1] + length)
+        fill = array('Q', self.column_offsets[:-1])
+        nonzeros = self.column_offsets[-1]
+        self.column_rows = array('I', bytes(4 * nonzeros))
+        self.column_weights = array('f', bytes(4 * nonzeros))
+        for row, weights in enumerate(row_weights):
+            for term_id, weight in weights:
+                position = fill[term_id]
+                self.column_rows[position] = row
+                self.column_weights[position] = weight
+                fill[term_id] += 1
+        self.stale = False
+
+    def get_query_weights(self, text):
+        counts = Counter(self.vocabulary[term] for term in QuestSearchIndex.tokenize(text) if term in self.vocabulary)
+        weights = [(term_id, (1 + math.log(count)) * self.idf[term_id]) for term_id, count in counts.items()
+                   if self.idf[term_id]]
+        norm = math.sqrt(sum(weight * weight for _, weight in weights))
+        return [(term_id, weight / norm) for term_id, weight in weights] if norm else []
+
+    def score_batch(self, queries, k, exclude_rows=None):
+        """
+        Cosine top-k for a batch of query vectors. Scores are accumulated in a dense list per query,
+        and the query terms of the whole batch are visited in term order, so each column is sliced
+        once however many queries contain the term.
+        :param queries: List of [(term id, weight)] query vectors.
+        :param exclude_rows: Optional list with a row per query to leave out, e.g. the query quest itself.
+        :return: List of [(row, score)] per query, best first, only rows sharing a term with the query.
+        """
+        self.finalize()
+        row_count = len(self.quest_keys)
+        scores = [[0.0] * row_count for _ in queries]
+        queries_by_term = defaultdict(list)
+        for query_index, weights in enumerate(queries):
+            for term_id, weight in weights:
+                queries_by_term[term_id].append((query_index, weight))
+
+        for term_id in sorted(queries_by_term):
+            start, end = self.column_offsets[term_id], self.column_offsets[term_id + 1]
+            column_rows = self.column_rows[start:end]
+            column_weights = self.column_weights[start:end]
+            for query_index, query_weight in queries_by_term[term_id]:
+                query_scores = scores[query_index]
+                for row, weight in zip(column_rows, column_weights):
+                    query_scores[row] += query_weight * weight
+
+        results = []
+        for query_index, query_scores in enumerate(scores):
+            if exclude_rows is not None:
+                query_scores[exclude_rows[query_index]] = 0.0
+            best = heapq.nlargest(k, range(row_count), key=query_scores.__getitem__)
+            results.append([(row, query_scores[row]) for row in best if query_scores[row] > 0.0])
+        return results
+
+    def get_result(self, row, score):
+        return {'quest': self.quest_keys[row], 'quest_name': self.quest_names[row], 'score': score}
+
+    def query(self, texts, k=5):
+        """
+        Most similar quests for each text.
+        :param texts: A text or a list of texts, e.g. the description of the quest being generated.
+        :return: List of results with quest key, quest name and cosine score, or a list of lists for a list of texts.
+        """
+        self.finalize()
+        batch = [texts] if isinstance(texts, str) else list(texts)
+        results = [[self.get_result(row, score) for row, score in matches]
+                   for matches in self.score_batch([self.get_query_weights(text) for text in batch], k)]
+        return results[0] if isinstance(texts, str) else results
+
+    def most_similar(self, quest_keys, k=5):
+        """
+        Most similar other quests for quests already in the index.
+        :param quest_keys: A quest key (Quest_ID) or a list of them.
+        """
+        self.finalize()
+        keys = [quest_keys] if isinstance(quest_keys, str) else list(quest_keys)
+        rows = [self.rows[str(quest_key)] for quest_key in keys]
+        queries = [self.get_row_weights(row, self.idf) for row in rows]
+        results = [[self.get_result(row, score) for row, score in matches]
+                   for matches in self.score_batch(queries, k, exclude_rows=rows)]
+        return results[0] if isinstance(quest_keys, str) else results
+
+    def save(self, directory):
+        """
+        Save the index as one raw binary file per array plus metadata.json, load() memory-maps the arrays.
+        """
+        self.finalize()
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAY_TYPECODES:
+            value = getattr(self, name)
+            with open(os.path.join(directory, f"{name}.bin"), 'wb') as f:
+                f.write(value)
+        with open(os.path.join(directory, "metadata.json"), 'w', encoding='utf-8') as f:
+            json.dump({
+                'max_document_ratio': self.max_document_ratio,
+                'min_document_frequency': self.min_document_frequency,
+                'quest_keys': self.quest_keys,
+                'quest_names': self.quest_names,
+                'terms': self.terms,
+            }, f)
+
+    @classmethod
+    def load(cls, directory, memory_map=True):
+        """
+        :param memory_map: Map the arrays instead of reading them, pages are loaded on first access
+                           and shared between processes serving the same index.
+        """
+        with open(os.path.join(directory, "metadata.json"), 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        index = cls(metadata['max_document_ratio'], metadata['min_document_frequency'])
+        index.quest_keys = metadata['quest_keys']
+        index.quest_names = metadata['quest_names']
+        index.terms = metadata['terms']
+        index.vocabulary = {term: term_id for term_id, term in enumerate(index.terms)}
+        for name, typecode in ARRAY_TYPECODES.items():
+            file_path = os.path.join(directory, f"{name}.bin")
+            if memory_map:
+                setattr(index, name, map_array(file_path, typecode))
+            else:
+                value = array(typecode)
+                with open(file_path, 'rb') as f:
+                    value.frombytes(f.read())
+                setattr(index, name, value)
+        index.rows = {quest_key: row for row, quest_key in enumerate(index.quest_keys) if not index.deleted[row]}
+        return index
+
+
+if __name__ == "__main__":
+    import sys
+    from DataManipulator import DataManipulator
+
+    data_manipulator = DataManipulator("OdysseyChapterAndSequenceStructuredDialogue.json")
+    similarity_index = QuestSimilarityIndex().build(data_manipulator.data)
+    similarity_index.save("quest_similarity_index")
+    query = sys.argv[1] if len(sys.argv) > 1 else "Kassandra helps a grieving mother find her son in Athens"
+    for result in similarity_index.query(query, k=5):
+        print(f"{result['score']:.3f} {result['quest_name']}")
@@ -0,0 +1,481 @@
+import json
+import sqlite3
+from itertools import islice
+
+from DialogueDataStructurer import SegmentList, segment_to_dict, serialize_segment
+from Metrics import metrics
+from QuestQuery import Query, Comparison, HasSegmentType, And, Or, Not, get_quest_key
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS quests (
+    row_id INTEGER PRIMARY KEY,  -- position of the quest in the data
+    quest_key TEXT,
+    key_order TEXT NOT NULL  -- JSON array of the top-level keys in their original order
+);
+CREATE INDEX IF NOT EXISTS quests_by_key ON quests (quest_key);
+
+CREATE TABLE IF NOT EXISTS quest_fields (
+    row_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value,  -- No declared type, so stored strings, integers and floats keep their type
+    is_json INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (row_id, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS quest_fields_by_value ON quest_fields (key, value);
+
+CREATE TABLE IF NOT EXISTS sections (
+    row_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value,
+    is_json INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (row_id, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sections_by_key ON sections (key);
+
+CREATE TABLE IF NOT EXISTS infobox_fields (
+    row_id INTEGER NOT NULL,
+    ordinal INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value,
+    is_json INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (row_id, ordinal)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS infobox_fields_by_value ON infobox_fields (key, value);
+
+CREATE TABLE IF NOT EXISTS segments (
+    row_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    id,
+    global_id,
+    content,
+    segment_type TEXT,
+    extra TEXT,  -- JSON object of any further keys, e.g. from an annotated export
+    PRIMARY KEY (row_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS segments_by_type ON segments (segment_type, row_id);
+"""
+# Tables holding key/value rows of a quest, the columns are shared so predicates compile the same way on each
+value_tables = ('quest_fields', 'sections', 'infobox_fields')
+segment_keys = ('id', 'global_id', 'content', 'segment_type')
+essentially_null_values = ('', "''", '""')
+
+
+def is_scalar(value):
+    """Values SQLite stores and compares like Python does, bools are excluded because SQLite stores them as 0 and 1."""
+    return value is None or isinstance(value, (str, float)) or (isinstance(value, int) and not isinstance(value, bool))
+
+
+def encode_value(value):
+    """:return: Tuple (column value, is_json), anything but a scalar is stored as JSON text."""
+    if is_scalar(value):
+        return value, 0
+    return json.dumps(value, default=serialize_segment), 1
+
+
+def decode_value(value, is_json):
+    return json.loads(value) if is_json else value
+
+
+def is_segment_list(value):
+    if isinstance(value, SegmentList):
+        return True
+    return isinstance(value, list) and all(
+        isinstance(segment, dict) and tuple(segment)[:len(segment_keys)] == segment_keys for segment in value)
+
+
+def get_value_location(path):
+    """
+    Table and key holding a path, e.g. 'MemoryInfobox.appearance' -> ('infobox_fields', 'appearance').
+    :return: Tuple (table, key), or None for paths only answered in Python like 'Structured_Dialogue' or 'Tags.x'.
+    """
+    parts = path.split('.')
+    if len(parts) == 2 and parts[0] == 'MemoryInfobox':
+        return 'infobox_fields', parts[1]
+    if len(parts) == 1 and path not in ('MemoryInfobox', 'Structured_Dialogue'):
+        return ('sections' if path.startswith('Section_') else 'quest_fields'), path
+    return None
+
+
+def compile_comparison(comparison):
+    """:return: Tuple (SQL condition on the quest row q, parameters), or None if SQL cannot match Python exactly."""
+    location = get_value_location(comparison.path)
+    if location is None:
+        if comparison.op in ('exists', 'missing') and '.' not in comparison.path:
+            condition = "EXISTS (SELECT 1 FROM json_each(q.key_order) k WHERE k.value = ?)"
+            return condition if comparison.op == 'exists' else f"NOT {condition}", [comparison.path]
+        return None
+    table, key = location
+    op, value = comparison.op, comparison.value
+    if op in ('exists', 'missing'):
+        condition, params = "1", []
+    elif op == '==' and is_scalar(value):
+        if value is None:
+            condition, params = "t.is_json = 0 AND t.value IS NULL", []
+        else:
+            condition, params = "t.is_json = 0 AND t.value = ?", [value]
+    elif op == '!=' and is_scalar(value):
+        # A stored list or dictionary never equals a scalar
+        condition, params = "(t.is_json = 1 OR t.value IS NOT ?)", [value]
+    elif op == 'in' and all(is_scalar(member) for member in value):
+        members = [member for member in value if member is not None]
+        alternatives = [f"t.value IN ({', '.join('?' * len(members))})"] if members else []
+        if None in value:
+            alternatives.append("t.value IS NULL")
+        condition = f"t.is_json = 0 AND ({' OR '.join(alternatives) or '0'})"
+        params = members
+    elif op == 'contains' and isinstance(value, str):
+        # Substring of a string, element of a list or key of a dictionary, like the Python in operator
+        condition = ("((t.is_json = 0 AND typeof(t.value) = 'text' AND instr(t.value, ?) > 0)"
+                     " OR (t.is_json = 1 AND EXISTS (SELECT 1 FROM json_each(t.value) j WHERE"
+                     " (json_type(t.value) = 'array' AND j.type = 'text' AND j.value = ?)"
+                     " OR (json_type(t.value) = 'object' AND j.key = ?))))")
+        params = [value, value, value]
+    elif op in ('<', '<=', '>', '>=') and is_scalar(value) and value is not None:
+        # Python only orders strings with strings and numbers with numbers, mixed types never match
+        types = "'text'" if isinstance(value, str) else "'integer', 'real'"
+        condition, params = f"t.is_json = 0 AND typeof(t.value) IN ({types}) AND t.value {op} ?", [value]
+    else:
+        return None
+    # The subquery does not depend on q, so it runs once and probes the (key, value) index
+    sql = f"q.row_id {'NOT IN' if op == 'missing' else 'IN'} (SELECT t.row_id FROM {table} t WHERE t.key = ? AND {condition})"
+    return sql, [key] + params
+
+
+def compile_predicate(predicate):
+    """
+    Translate a QuestQuery predicate to SQL.
+    :return: Tuple (SQL condition, parameters), or None if a part of it has to be evaluated in Python.
+    """
+    if isinstance(predicate, Comparison):
+        return compile_comparison(predicate)
+    if isinstance(predicate, HasSegmentType):
+        return ("q.row_id IN (SELECT s.row_id FROM segments s WHERE s.segment_type = ?)",
+                [predicate.segment_type.value])
+    if isinstance(predicate, (And, Or)):
+        compiled = [compile_predicate(child) for child in predicate.predicates]
+        if any(part is None for part in compiled):
+            return None
+        joiner = " AND " if isinstance(predicate, And) else " OR "
+        return "(" + joiner.join(sql for sql, _ in compiled) + ")", [param for _, params in compiled for param in params]
+    if isinstance(predicate, Not):
+        compiled = compile_predicate(predicate.predicate)
+        return None if compiled is None else (f"NOT {compiled[0]}", compiled[1])
+    return None  # HasSpeaker and Where need the dialogue text or an arbitrary function
+
+
+class SQLiteQuery(Query):
+    """
+    Query answered by the SQLite store. Comparisons on top-level keys, sections and MemoryInfobox keys
+    and segment type checks are translated to SQL and use the value indexes; the parts of a conjunction
+    that cannot be translated, e.g. HasSpeaker or Where, filter the quests read from the store.
+    """
+
+    def __init__(self, store, predicate=None):
+        super().__init__(None, None, predicate)
+        self.store = store
+
+    def plan(self):
+        """:return: Tuple (SQL condition, parameters, residual predicate or None, description)."""
+        predicate = self.predicate
+        if predicate is None:
+            return "1", [], None, "sqlite: all quests"
+        children = predicate.predicates if isinstance(predicate, And) else [predicate]
+        conditions, params, residual = [], [], []
+        for child in children:
+            compiled = compile_predicate(child)
+            if compiled is None:
+                residual.append(child)
+            else:
+                conditions.append(compiled[0])
+                params.extend(compiled[1])
+        residual_predicate = And(*residual) if len(residual) > 1 else (residual[0] if residual else None)
+        condition = " AND ".join(conditions) or "1"
+        description = f"sqlite: WHERE {condition}" if conditions else "sqlite: all quests"
+        if residual_predicate is not None:
+            description += f", filter {residual_predicate!r}"
+        return condition, params, residual_predicate, description
+
+    def explain(self):
+        condition, params, _, description = self.plan()
+        steps = self.store.connection.execute(
+            f"EXPLAIN QUERY PLAN SELECT q.row_id FROM quests q WHERE {condition}", params).fetchall()
+        return description + "\n" + "\n".join(step[-1] for step in steps)
+
+    def __iter__(self):
+        condition, params, residual, _ = self.plan()
+        selection = f"SELECT q.row_id FROM quests q WHERE {condition} ORDER BY q.row_id"
+        if residual is None and self.max_results is not None:
+            selection += " LIMIT ?"
+            params = params + [self.max_results]
+        quests = self.store.read_quests(selection, params)
+        matching = (quest for quest in quests if residual is None or residual.matches(quest))
+        results = (self.project(quest) for quest in matching)
+        return iter(results if self.max_results is None else islice(results, self.max_results))
+
+    def count(self):
+        condition, params, residual, _ = self.plan()
+        if residual is not None:
+            return super().count()
+        count = self.store.connection.execute(f"SELECT COUNT(*) FROM quests q WHERE {condition}", params).fetchone()[0]
+        return count if self.max_results is None else min(count, self.max_results)
+
+
+class SQLiteQuestStore:
+    """
+    Quests stored in normalized SQLite tables: one row per quest with its key and key order, and rows for
+    the top-level fields, the Section_* texts, the MemoryInfobox fields and the Structured_Dialogue segments.
+    (key, value) indexes on the fields and an index on the segment types answer the query() predicates
+    without loading the corpus, and quests are rebuilt with their original key order when read.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def split_value(row_id, key, value, rows):
+        """Append the rows storing one top-level value to rows, a dictionary of lists per table."""
+        if key == 'MemoryInfobox' and isinstance(value, dict):
+            for ordinal, (infobox_key, infobox_value) in enumerate(value.items()):
+                rows['infobox_fields'].append((row_id, ordinal, infobox_key, *encode_value(infobox_value)))
+        elif key == 'Structured_Dialogue' and is_segment_list(value):
+            for position, segment in enumerate(value):
+                segment = segment_to_dict(segment)
+                extra = {key: value for key, value in segment.items() if key not in segment_keys}
+                rows['segments'].append((row_id, position, *(segment[segment_key] for segment_key in segment_keys),
+                                         json.dumps(extra) if extra else None))
+        else:
+            table = 'sections' if key.startswith('Section_') else 'quest_fields'
+            rows[table].append((row_id, key, *encode_value(value)))
+
+    def insert_rows(self, rows):
+        self.connection.executemany("INSERT INTO quests VALUES (?, ?, ?)", rows['quests'])
+        self.connection.executemany("INSERT INTO quest_fields VALUES (?, ?, ?, ?)", rows['quest_fields'])
+        self.connection.executemany("INSERT INTO sections VALUES (?, ?, ?, ?)", rows['sections'])
+        self.connection.executemany("INSERT INTO infobox_fields VALUES (?, ?, ?, ?, ?)", rows['infobox_fields'])
+        self.connection.executemany("INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?)", rows['segments'])
+
+    @metrics.timed()
+    def write_quests(self, data):
+        """
+        Replace the stored quests with data in a single transaction.
+        :param data: List of quests, e.g. DataManipulator.data.
+        """
+        rows = {table: [] for table in ('quests', 'quest_fields', 'sections', 'infobox_fields', 'segments')}
+        for row_id, quest in enumerate(data):
+            rows['quests'].append((row_id, get_quest_key(quest), json.dumps(list(quest))))
+            for key, value in quest.items():
+                self.split_value(row_id, key, value, rows)
+        with self.connection:
+            for table in rows:
+                self.connection.execute(f"DELETE FROM {table}")
+            self.insert_rows(rows)
+        metrics.add_items(len(data))
+
+    def read_quests(self, selection=None, params=()):
+        """
+        :param selection: Optional SELECT statement returning the row ids to read, all quests by default.
+        :return: List of quests ordered by position.
+        """
+        restriction = f" WHERE row_id IN ({selection})" if selection else ""
+        params = list(params)
+        quest_rows = self.connection.execute(
+            f"SELECT row_id, key_order FROM quests{restriction} ORDER BY row_id", params).fetchall()
+        values = {row_id: {} for row_id, _ in quest_rows}
+        for table in ('quest_fields', 'sections'):
+            for row_id, key, value, is_json in self.connection.execute(
+                    f"SELECT row_id, key, value, is_json FROM {table}{restriction}", params):
+                values[row_id][key] = decode_value(value, is_json)
+        infoboxes = {}
+        for row_id, key, value, is_json in self.connection.execute(
+                f"SELECT row_id, key, value, is_json FROM infobox_fields{restriction} ORDER BY row_id, ordinal", params):
+            infoboxes.setdefault(row_id, {})[key] = decode_value(value, is_json)
+        dialogues = {}
+        for row_id, *segment, extra in self.connection.execute(
+                f"SELECT row_id, id, global_id, content, segment_type, extra FROM segments{restriction}"
+                f" ORDER BY row_id, position", params):
+            segment = dict(zip(segment_keys, segment))
+            if extra is not None:
+                segment.update(json.loads(extra))
+            dialogues.setdefault(row_id, []).append(segment)
+
+        quests = []
+        for row_id, key_order in quest_rows:
+            quest_values = values[row_id]
+            quest = {}
+            for key in json.loads(key_order):
+                if key in quest_values:
+                    quest[key] = quest_values[key]
+                elif key == 'MemoryInfobox':
+                    quest[key] = infoboxes.get(row_id, {})
+                else:
+                    quest[key] = dialogues.get(row_id, [])
+            quests.append(quest)
+        metrics.increment('sqlite.quests_read', len(quests))
+        return quests
+
+    def read_quest(self, index):
+        """:return: The quest at a position, negative positions count from the end like list indexes."""
+        row_id = self.get_row_id(index)
+        return self.read_quests("SELECT ?", [row_id])[0]
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM quests").fetchone()[0]
+
+    def get_row_id(self, index):
+        count = self.count()
+        row_id = index + count if index < 0 else index
+        if not 0 <= row_id < count:
+            raise IndexError("quest index out of range")
+        return row_id
+
+    def query(self, predicate=None):
+        return SQLiteQuery(self, predicate)
+
+    def set_value(self, index, key, value):
+        """Set a top-level key of the quest at a position, adding the key after the existing ones if it is new."""
+        row_id = self.get_row_id(index)
+        rows = {table: [] for table in ('quests', 'quest_fields', 'sections', 'infobox_fields', 'segments')}
+        self.split_value(row_id, key, value, rows)
+        with self.connection:
+            self.delete_values(row_id, key)
+            self.insert_rows(rows)
+            self.connection.execute(
+                "UPDATE quests SET key_order = json_insert(key_order, '$[#]', ?) WHERE row_id = ?"
+                " AND NOT EXISTS (SELECT 1 FROM json_each(key_order) k WHERE k.value = ?)", (key, row_id, key))
+            if key in ('Quest_ID', 'QuestID', 'Quest_Name', 'QuestName'):
+                quest_key = get_quest_key(self.read_quest(row_id))
+                self.connection.execute("UPDATE quests SET quest_key = ? WHERE row_id = ?", (quest_key, row_id))
+
+    def delete_values(self, row_id, key):
+        for table in ('quest_fields', 'sections'):
+            self.connection.execute(f"DELETE FROM {table} WHERE row_id = ? AND key = ?", (row_id, key))
+        if key == 'MemoryInfobox':
+            self.connection.execute("DELETE FROM infobox_fields WHERE row_id = ?", (row_id,))
+        elif key == 'Structured_Dialogue':
+            self.connection.execute("DELETE FROM segments WHERE row_id = ?", (row_id,))
+
+    def set_nested_value(self, index, section, key, value):
+        """
+        Set a key inside a dictionary valued top-level key, e.g. a MemoryInfobox field.
+        :raise KeyError: If the quest has no such section.
+        """
+        row_id = self.get_row_id(index)
+        with self.connection:
+            stored = self.connection.execute(
+                "SELECT value, is_json FROM quest_fields WHERE row_id = ? AND key = ?", (row_id, section)).fetchone()
+            if stored is None and section.startswith('Section_'):
+                stored = self.connection.execute(
+                    "SELECT value, is_json FROM sections WHERE row_id = ? AND key = ?", (row_id, section)).fetchone()
+            if stored is not None:
+                # Dictionaries other than the MemoryInfobox are stored as JSON, strings raise like in memory
+                section_value = decode_value(*stored)
+                section_value[key] = value
+                self.set_value(row_id, section, section_value)
+                return
+            if section != 'MemoryInfobox' or not self.connection.execute(
+                    "SELECT 1 FROM quests, json_each(quests.key_order) k WHERE row_id = ? AND k.value = ?",
+                    (row_id, section)).fetchone():
+                raise KeyError(section)
+            updated = self.connection.execute(
+                "UPDATE infobox_fields SET value = ?, is_json = ? WHERE row_id = ? AND key = ?",
+                (*encode_value(value), row_id, key))
+            if not updated.rowcount:
+                self.connection.execute(
+                    "INSERT INTO infobox_fields SELECT ?, COALESCE(MAX(ordinal) + 1, 0), ?, ?, ? FROM infobox_fields"
+                    " WHERE row_id = ?", (row_id, key, *encode_value(value), row_id))
+
+    def replace_infobox_values(self, old_values, new_value):
+        """Replace MemoryInfobox string values, e.g. '' by None. :return: Number of replaced values."""
+        with self.connection:
+            return self.connection.execute(
+                f"UPDATE infobox_fields SET value = ?, is_json = 0 WHERE is_json = 0"
+                f" AND value IN ({', '.join('?' * len(old_values))})", (new_value, *old_values)).rowcount
+
+    def delete_null_infobox_values(self):
+        with self.connection:
+            return self.connection.execute("DELETE FROM infobox_fields WHERE is_json = 0 AND value IS NULL").rowcount
+
+    def sanitize_infobox_values(self):
+        """SQL version of DataManipulator.sanitize_value on every MemoryInfobox string."""
+        with self.connection:
+            return self.connection.execute(
+                "UPDATE infobox_fields SET value = replace(replace(replace(value, '[[', ''), ']]', ''), '''''', '''')"
+                " WHERE is_json = 0 AND typeof(value) = 'text'").rowcount
+
+    def delete_keys(self, keys):
+        """Drop top-level keys from every quest."""
+        keys = list(keys)
+        placeholders = ', '.join('?' * len(keys))
+        with self.connection:
+            for table in ('quest_fields', 'sections'):
+                self.connection.execute(f"DELETE FROM {table} WHERE key IN ({placeholders})", keys)
+            if 'MemoryInfobox' in keys:
+                self.connection.execute("DELETE FROM infobox_fields")
+            if 'Structured_Dialogue' in keys:
+                self.connection.execute("DELETE FROM segments")
+            self.connection.execute(
+                f"UPDATE quests SET key_order = (SELECT json_group_array(k.value) FROM json_each(quests.key_order) k"
+                f" WHERE k.value NOT IN ({placeholders}))"
+                f" WHERE EXISTS (SELECT 1 FROM json_each(quests.key_order) k WHERE k.value IN ({placeholders}))",
+                keys + keys)
+
+    def delete_nested_key(self, section, key):
+        """Remove a key from a JSON stored dictionary in every quest, e.g. the text of the Revision."""
+        with self.connection:
+            return self.connection.execute(
+                "UPDATE quest_fields SET value = json_remove(value, ?) WHERE key = ? AND is_json = 1"
+                " AND json_type(value) = 'object'", (f'$."{key}"', section)).rowcount
+
+    def replace_essentially_null_values(self):
+        """
+        Replace '', "''" and '""' by None in the top-level values and the values of dictionaries one level down.
+        :return: Number of replaced values.
+        """
+        placeholders = ', '.join('?' * len(essentially_null_values))
+        replaced = 0
+        with self.connection:
+            for table in value_tables:
+                replaced += self.connection.execute(
+                    f"UPDATE {table} SET value = NULL WHERE is_json = 0 AND value IN ({placeholders})",
+                    essentially_null_values).rowcount
+            for table in ('quest_fields', 'sections'):
+                updates = []
+                for row_id, key, value in self.connection.execute(
+                        f"SELECT row_id, key, value FROM {table} WHERE is_json = 1 AND json_type(value) = 'object'"):
+                    dictionary = json.loads(value)
+                    null_keys = [subkey for subkey, subvalue in dictionary.items()
+                                 if isinstance(subvalue, str) and subvalue in essentially_null_values]
+                    for subkey in null_keys:
+                        dictionary[subkey] = None
+                    if null_keys:
+                        updates.append((json.dumps(dictionary), row_id, key))
+                        replaced += len(null_keys)
+                self.connection.executemany(f"UPDATE {table} SET value = ? WHERE row_id = ? AND key = ?", updates)
+        return replaced
+
+    def get_statistics(self):
+        tables = ('quests', 'quest_fields', 'sections', 'infobox_fields', 'segments')
+        return {table: self.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+
+
+if __name__ == "__main__":
+    import sys
+    from DataManipulator import DataManipulator
+    from QuestQuery import Infobox
+
+    json_file_path = sys.argv[1] if len(sys.argv) > 1 else "OdysseyChapterAndSequenceStructuredDialogue.json"
+    db_path = sys.argv[2] if len(sys.argv) > 2 else "Quests.sqlite"
+    DataManipulator(json_file_path).save_sqlite(db_path)
+    data_manipulator = DataManipulator.from_sqlite(db_path)
+    print(data_manipulator.store.get_statistics())
+    query = data_manipulator.query(Infobox('appearance').contains('Odyssey')).select('Quest_Name').limit(5)
+    print(query.explain())
+    print(query.all())
@@ -0,0 +1,125 @@
+from collections import Counter
+
+
+# Canonical spelling of the section names shared by most quest pages
+known_sections = [
+    'Description',
+    'Dialogue',
+    'Outcome',
+    'Trivia',
+    'Behind_the_scenes',
+    'Gallery',
+    'References',
+    'Riddle',
+    'Messages',
+]
+# Titles too far from their section for the typo rule below, e.g. the singular of a plural name
+section_aliases = {
+    'Message': 'Messages',
+    'Reference': 'References',
+}
+
+
+def get_edit_distance(first, second, max_distance):
+    """
+    Levenshtein distance between two strings, stops early once every cell of a row exceeds max_distance.
+    :return: The distance, or max_distance + 1 if it is larger than max_distance.
+    """
+    if abs(len(first) - len(second)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (first_char != second_char)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+def normalize_title(title):
+    """Collapse whitespace and underscores, e.g. ' Behind the  scenes_' becomes 'Behind_the_scenes'."""
+    return '_'.join(title.replace('_', ' ').split())
+
+
+class SectionKeyCanonicalizer:
+    """
+    Maps section titles to quest keys like 'Section_Behind_the_scenes'. Titles are normalized
+    (whitespace, underscores), then matched case-insensitively against the known section names and
+    aliases like ' Reference', then clustered to the closest known name within a small edit distance,
+    so 'Behind the scnes' lands on the same key as its correct spelling. A typo keeps the length within
+    one character and the first and last letter, other titles like 'Middle', 'Trivial' or 'Outcomes'
+    are other words than 'Riddle', 'Trivia' or 'Outcome' and keep their normalized spelling, as does
+    'Meeting Kyra'.
+    The mapping is memoized per distinct title, so every quest after the first one costs a dictionary lookup.
+    """
+
+    def __init__(self, sections=known_sections, prefix='Section_', max_distance=2, aliases=section_aliases):
+        self.sections = list(sections)
+        self.folded_sections = {section.casefold(): section for section in self.sections}
+        self.folded_aliases = {alias.casefold(): section for alias, section in aliases.items()}
+        self.prefix = prefix
+        self.max_distance = max_distance
+        self.mapping = {}
+        self.variant_counts = Counter()  # occurrences of titles whose key differs from the plain spelling
+
+    def get_allowed_distance(self, section):
+        # One edit per five characters, short names like 'Trivia' only tolerate a single typo
+        return min(self.max_distance, max(1, len(section) // 5))
+
+    def find_section(self, title):
+        """
+        :param title: Normalized section title.
+        :return: The known section name the title belongs to, or None.
+        """
+        folded = title.casefold()
+        if folded in self.folded_sections:
+            return self.folded_sections[folded]
+        if folded in self.folded_aliases:
+            return self.folded_aliases[folded]
+        best_section = None
+        best_distance = self.max_distance + 1
+        for section_folded, section in self.folded_sections.items():
+            if abs(len(folded) - len(section_folded)) > 1 or folded[0] != section_folded[0] \
+                    or folded[-1] != section_folded[-1]:
+                continue
+            allowed_distance = self.get_allowed_distance(section)
+            distance = get_edit_distance(folded, section_folded, allowed_distance)
+            if distance <= allowed_distance and distance < best_distance:
+                best_section, best_distance = section, distance
+        return best_section
+
+    def get_plain_key(self, title):
+        """:return: Quest key of a title with only its whitespace normalized, without matching a known section."""
+        normalized = normalize_title(title)
+        return self.prefix + normalized if normalized else None
+
+    def canonicalize(self, title):
+        """
+        :param title: Raw section title as written in the wikitext.
+        :return: Quest key for the section, or None for an empty title.
+        """
+        key = self.mapping.get(title)
+        if key is None and title not in self.mapping:
+            normalized = normalize_title(title)
+            section = self.find_section(normalized) if normalized else None
+            key = self.prefix + (section or normalized) if normalized else None
+            self.mapping[title] = key
+        if key is not None and key != self.prefix + title.strip().replace(' ', '_'):
+            self.variant_counts[title] += 1
+        return key
+
+    def get_clustered_variants(self):
+        """
+        :return: Dictionary of the raw titles that were rewritten to {title: (key, occurrences)}, most common first.
+        """
+        return {title: (self.mapping[title], count) for title, count in self.variant_counts.most_common()}
+
+    def print_report(self):
+        variants = self.get_clustered_variants()
+        print(f"Canonicalized {len(self.mapping)} distinct section titles, clustered {len(variants)} variants")
+        for title, (key, count) in variants.items():
+            print(f"    {title!r} -> {key} ({count})")
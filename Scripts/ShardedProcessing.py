@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+
+from Metrics import metrics
+from QuestQuery import get_quest_key
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARD_MANIFEST = "manifest.json"
+
+
+def get_shard_index(quest, shard_count):
+    """
+    Shard of a quest from a stable hash of its Quest_ID. Python's hash() is salted per process,
+    so a digest is used to send the same quest to the same shard on every machine and run.
+    """
+    digest = hashlib.blake2b(get_quest_key(quest).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+
+def get_shard_paths(shard_dir, shard_index):
+    name = f"shard_{shard_index:05d}"
+    return {
+        'input': os.path.join(shard_dir, f"{name}.json"),
+        'output': os.path.join(shard_dir, f"{name}.processed.json"),
+        'statistics': os.path.join(shard_dir, f"{name}.statistics.json"),
+        'log': os.path.join(shard_dir, f"{name}.log"),
+    }
+
+
+def write_json_atomically(data, file_path, **dump_options):
+    # Written next to the target and renamed, a crashed job never leaves a half written shard behind
+    temporary_path = file_path + ".tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **dump_options)
+    os.replace(temporary_path, file_path)
+
+
+def partition(json_file_path, shard_dir, shard_count):
+    """
+    Split a quest JSON file into shard_count shard files by get_shard_index.
+    Every shard stores the input positions of its quests, so the merge restores the input order.
+    :return: The manifest, also written to shard_dir/manifest.json.
+    """
+    with open(json_file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    shards = [{'positions': [], 'quests': []} for _ in range(shard_count)]
+    for position, quest in enumerate(data):
+        shard = shards[get_shard_index(quest, shard_count)]
+        shard['positions'].append(position)
+        shard['quests'].append(quest)
+
+    os.makedirs(shard_dir, exist_ok=True)
+    for shard_index, shard in enumerate(shards):
+        paths = get_shard_paths(shard_dir, shard_index)
+        # Outputs of an earlier partition would otherwise mark the new shard as done
+        for stale_path in (paths['output'], paths['statistics']):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        write_json_atomically(shard, paths['input'], ensure_ascii=False)
+
+    manifest = {
+        'source': os.path.abspath(json_file_path),
+        'shard_count': shard_count,
+        'quest_count': len(data),
+        'shard_sizes': [len(shard['quests']) for shard in shards],
+    }
+    write_json_atomically(manifest, os.path.join(shard_dir, SHARD_MANIFEST), indent=4)
+    print(f"Partitioned {len(data)} quests into {shard_count} shards: {manifest['shard_sizes']}")
+    return manifest
+
+
+def process_shard(shard_path, output_path, statistics_path, chapter_folder=None):
+    """
+    Clean, chapter tag and structure the dialogues of one shard, the unit of work of a job.
+    :param chapter_folder: Manually tagged chapter folder, chapter tagging is skipped when None.
+    """
+    from DataManipulator import DataManipulator
+
+    with open(shard_path, 'r', encoding='utf-8') as f:
+        shard = json.load(f)
+
+    metrics.reset()
+    metrics.enable()
+    data_manipulator = DataManipulator()
+    data_manipulator.data = shard['quests']
+    data_manipulator.delete_replace_sanitize()
+    data_manipulator.replace_empty_string_with_none_in_memory_infobox()
+    data_manipulator.remove_null_key_values_in_memory_infobox()
+    if chapter_folder:
+        data_manipulator.match_quests_that_with_inside_manual_chapter_folder(chapter_folder)
+        data_manipulator.drop_unnessary_keys()
+    quests_without_dialogue = data_manipulator.structure_dialogues()
+    metrics.disable()
+
+    statistics = metrics.get_statistics()
+    statistics['quests'] = len(data_manipulator.data)
+    statistics['quests_without_dialogue'] = quests_without_dialogue
+    write_json_atomically({'positions': shard['positions'], 'quests': data_manipulator.data}, output_path,
+                          ensure_ascii=False)
+    # Statistics are written last, their presence marks the shard as done
+    write_json_atomically(statistics, statistics_path, indent=4)
+
+
+def merge_statistics(shard_statistics):
+    """
+    Combine the per-shard statistics in shard order: counts and seconds are summed, peak memory is the maximum.
+    """
+    merged = {'quests': 0, 'quests_without_dialogue': 0, 'stages': {}, 'counters': {}}
+    for statistics in shard_statistics:
+        merged['quests'] += statistics['quests']
+        merged['quests_without_dialogue'] += statistics['quests_without_dialogue']
+        for name, value in statistics['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+        for name, stats in statistics['stages'].items():
+            stage = merged['stages'].setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                       'items': 0, 'peak_memory_bytes': 0})
+            for key in ('calls', 'wall_seconds', 'cpu_seconds', 'items'):
+                stage[key] += stats[key]
+            stage['peak_memory_bytes'] = max(stage['peak_memory_bytes'], stats['peak_memory_bytes'])
+
+    for stage in merged['stages'].values():
+        stage['items_per_second'] = stage['items'] / stage['wall_seconds'] if stage['wall_seconds'] else 0.0
+    merged['counters'] = dict(sorted(merged['counters'].items()))
+    merged['stages'] = dict(sorted(merged['stages'].items()))
+    return merged
+
+
+class ShardCoordinator:
+    """
+    Runs the per-shard jobs as independent processes and merges their outputs. Each job is the command
+    line returned by get_job_command, so a cluster scheduler can run the same jobs on other machines
+    with a shared shard_dir; locally at most max_jobs processes run at once. Shards whose statistics
+    file exists are considered done, so rerunning the coordinator only retries failed shards.
+    """
+
+    def __init__(self, shard_dir, chapter_folder=None, max_jobs=None, poll_interval=0.2):
+        self.shard_dir = shard_dir
+        self.chapter_folder = chapter_folder
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        self.poll_interval = poll_interval
+        self.failed_shards = []
+
+    def load_manifest(self):
+        with open(os.path.join(self.shard_dir, SHARD_MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def get_job_command(self, shard_index):
+        paths = get_shard_paths(self.shard_dir, shard_index)
+        command = [sys.executable, os.path.join(SCRIPTS_DIR, 'ShardedProcessing.py'), 'worker',
+                   paths['input'], paths['output'], paths['statistics']]
+        if self.chapter_folder:
+            command += ['--chapters', self.chapter_folder]
+        return command
+
+    def get_pending_shards(self, shard_count):
+        return [shard_index for shard_index in range(shard_count)
+                if not os.path.exists(get_shard_paths(self.shard_dir, shard_index)['statistics'])]
+
+    def run_jobs(self):
+        """
+        Run every pending shard job.
+        :return: List of the shard indexes whose job failed.
+        """
+        pending = self.get_pending_shards(self.load_manifest()['shard_count'])
+        running = {}  # shard index -> (process, log file)
+        self.failed_shards = []
+        print(f"Running {len(pending)} shard jobs with up to {self.max_jobs} processes")
+
+        while pending or running:
+            while pending and len(running) < self.max_jobs:
+                shard_index = pending.pop(0)
+                log_file = open(get_shard_paths(self.shard_dir, shard_index)['log'], 'w', encoding='utf-8')
+                process = subprocess.Popen(self.get_job_command(shard_index), stdout=log_file,
+                                           stderr=subprocess.STDOUT, cwd=os.getcwd())
+                running[shard_index] = (process, log_file)
+
+            for shard_index, (process, log_file) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                log_file.close()
+                del running[shard_index]
+                if process.returncode != 0:
+                    self.failed_shards.append(shard_index)
+                    print(f"Shard {shard_index} failed with exit code {process.returncode}, "
+                          f"see {get_shard_paths(self.shard_dir, shard_index)['log']}")
+            if running:
+                time.sleep(self.poll_interval)
+
+        self.failed_shards.sort()
+        return self.failed_shards
+
+    def merge(self, output_path, statistics_path=None):
+        """
+        Merge the processed shards into one JSON file in the original input order, independent of
+        the shard count and of the order in which the jobs finished.
+        :return: The merged statistics.
+        """
+        from DataManipulator import DataManipulator
+
+        manifest = self.load_manifest()
+        pending = self.get_pending_shards(manifest['shard_count'])
+        if pending:
+            raise RuntimeError(f"Shards {pending} are not processed yet, run the jobs first")
+
+        merged = [None] * manifest['quest_count']
+        shard_statistics = []
+        for shard_index in range(manifest['shard_count']):
+            paths = get_shard_paths(self.shard_dir, shard_index)
+            with open(paths['output'], 'r', encoding='utf-8') as f:
+                shard = json.load(f)
+            for position, quest in zip(shard['positions'], shard['quests']):
+                merged[position] = quest
+            with open(paths['statistics'], 'r', encoding='utf-8') as f:
+                shard_statistics.append(json.load(f))
+
+        statistics = merge_statistics(shard_statistics)
+        statistics['shard_count'] = manifest['shard_count']
+        # Written by save_json like a serial run, so the output is the same byte for byte
+        data_manipulator = DataManipulator()
+        data_manipulator.data = merged
+        data_manipulator.save_json(output_path)
+        if statistics_path:
+            with open(statistics_path, 'w', encoding='utf-8') as f:
+                json.dump(statistics, f, indent=4)
+        print(f"Merged {len(merged)} quests from {manifest['shard_count']} shards into {output_path}")
+        return statistics
+
+    def run(self, json_file_path, shard_count, output_path, statistics_path=None):
+        """Partition, process every shard and merge, the single machine equivalent of a cluster run."""
+        partition(json_file_path, self.shard_dir, shard_count)
+        failed_shards = self.run_jobs()
+        if failed_shards:
+            raise RuntimeError(f"Shards {failed_shards} failed, rerun to retry them")
+        return self.merge(output_path, statistics_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process a quest JSON file in shards with independent jobs.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Partition, run every shard job locally and merge.")
+    run_parser.add_argument('json_file_path')
+    run_parser.add_argument('output_path')
+    run_parser.add_argument('--shards', type=int, default=8)
+    run_parser.add_argument('--jobs', type=int, default=None, help="Parallel processes, default one per CPU.")
+
+    partition_parser = subparsers.add_parser('partition', help="Only write the shard files.")
+    partition_parser.add_argument('json_file_path')
+    partition_parser.add_argument('--shards', type=int, default=8)
+
+    jobs_parser = subparsers.add_parser('jobs', help="Print the command of every pending shard job.")
+    resume_parser = subparsers.add_parser('resume', help="Run the pending shard jobs locally.")
+    resume_parser.add_argument('--jobs', type=int, default=None)
+
+    merge_parser = subparsers.add_parser('merge', help="Merge the processed shards.")
+    merge_parser.add_argument('output_path')
+
+    worker_parser = subparsers.add_parser('worker', help="Process one shard, run by the coordinator.")
+    worker_parser.add_argument('shard_path')
+    worker_parser.add_argument('output_path')
+    worker_parser.add_argument('statistics_path')
+
+    for subparser in (run_parser, jobs_parser, resume_parser, worker_parser):
+        subparser.add_argument('--chapters', default=None, help="Manually tagged chapter folder.")
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--shard-dir', default="Shards")
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        process_shard(args.shard_path, args.output_path, args.statistics_path, args.chapters)
+        return
+
+    coordinator = ShardCoordinator(args.shard_dir, getattr(args, 'chapters', None), getattr(args, 'jobs', None))
+    if args.command == 'run':
+        coordinator.run(args.json_file_path, args.shards, args.output_path,
+                        os.path.splitext(args.output_path)[0] + "_statistics.json")
+    elif args.command == 'partition':
+        partition(args.json_file_path, args.shard_dir, args.shards)
+    elif args.command == 'jobs':
+        for shard_index in coordinator.get_pending_shards(coordinator.load_manifest()['shard_count']):
+            print(subprocess.list2cmdline(coordinator.get_job_command(shard_index)))
+    elif args.command == 'resume':
+        coordinator.run_jobs()
+    elif args.command == 'merge':
+        coordinator.merge(args.output_path, os.path.splitext(args.output_path)[0] + "_statistics.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import re
+import html
+
+from DialogueDataStructurer import extract_speaker_and_text
+from Metrics import metrics
+from PromptTemplates import FragmentCache
+
+
+# Every markup construct the renderer understands, matched left to right in a single pass.
+# Runs of ordinary characters are consumed as one text token, so the alternatives are only tried
+# where markup can start.
+token_pattern = re.compile(r"""
+    (?P<text>[^<\[\]{}'|&\n*\#:;][^<\[\]{}'|&\n]*)
+  | (?P<comment><!--.*?(?:-->|\Z))
+  | (?P<ref><ref\b[^>]*/>|<ref\b[^>]*>.*?(?:</ref>|\Z))
+  | (?P<nowiki><nowiki>(?P<nowiki_text>.*?)</nowiki>)
+  | (?P<gallery><gallery\b[^>]*>.*?(?:</gallery>|\Z))
+  | (?P<line_break><br\s*/?>)
+  | (?P<html_tag></?[A-Za-z][^<>]*>)
+  | (?P<tab>\|-\||\{\{!\}\}-\{\{!\}\})
+  | (?P<open_link>\[\[)
+  | (?P<close_link>\]\])
+  | (?P<open_template>\{\{)
+  | (?P<close_template>\}\})
+  | (?P<external_link>\[(?:https?:)?//[^\s\]]+(?:[ \t]+(?P<external_label>[^\]\n]*))?\])
+  | (?P<quotes>'{2,})
+  | (?P<pipe>\|)
+  | (?P<list_marker>^[*\#:;]+[ \t]*)
+  | (?P<entity>&(?:\#[0-9]+|\#x[0-9a-fA-F]+|[A-Za-z]+);)
+""", re.VERBOSE | re.DOTALL | re.IGNORECASE | re.MULTILINE)
+spaces_pattern = re.compile(r"[ \t]+")
+blank_lines_pattern = re.compile(r"\n\s*\n\s*\n+")
+named_argument_pattern = re.compile(r"\s*([\w ]+?)\s*=(.*)", re.DOTALL)
+# Option of a {{#tag:tabber}}: a label line ending in '=' followed by the body of the option
+tabber_option_pattern = re.compile(r"\s*([^\n]*?)\s*=[ \t]*\n(.*)", re.DOTALL)
+interlanguage_pattern = re.compile(r"[a-z]{2,3}(?:-[a-z]+)?")
+
+# Links into these namespaces are page metadata, not text
+hidden_namespaces = {'file', 'image', 'media', 'category'}
+# Templates that stand for a character, everything else without a rule renders to nothing
+character_templates = {'!': '|', "'": "'", '=': '=', '-': ''}
+
+
+def render_link(parts):
+    """[[Target]] renders to Target, [[Target|label]] to label, files, categories and interlanguage links vanish."""
+    target = ''.join(parts[0]).strip()
+    if ':' in target and not target.startswith(':'):
+        namespace = target.split(':', 1)[0].strip().lower()
+        if namespace in hidden_namespaces or interlanguage_pattern.fullmatch(namespace):
+            return ''
+    if len(parts) > 1:
+        return ''.join(parts[-1])
+    # Interwiki prefixes like 'wikt:' are only shown when the link has no label
+    return target.lstrip(':').rsplit(':', 1)[-1] if target.lower().startswith(('wikt:', 'w:', ':')) else target
+
+
+def render_template(parts):
+    """Keep the text of the templates that carry content, drop maintenance and navigation templates."""
+    name = ''.join(parts[0]).strip()
+    if name in character_templates:
+        return character_templates[name]
+    name = ' '.join(name.replace('_', ' ').lower().split()).replace(': ', ':')
+    if name == '#tag:tabber':
+        # Every option is kept in order as its label and body, the options hold the branches of the dialogue
+        options = []
+        for part in parts[1:]:
+            argument = ''.join(part)
+            match = tabber_option_pattern.match(argument)
+            options.append(match.group(1) + '\n' + match.group(2).strip() if match else argument.strip())
+        return '\n'.join(option for option in options if option)
+    positional = []
+    named = {}
+    for part in parts[1:]:
+        argument = ''.join(part)
+        match = named_argument_pattern.match(argument)
+        if match:
+            named[match.group(1).lower()] = match.group(2).strip()
+        else:
+            positional.append(argument)
+    if name in ('wiki', 'w', 'c'):
+        # {{Wiki|Target|label}} shows the label, {{c|text}} shows its text
+        return positional[-1] if positional else ''
+    if name == 'iunote':
+        return '\n'.join(named[key] for key in ('title', 'text') if named.get(key))
+    return ''
+
+
+def is_tabber_frame(frame):
+    kind, parts = frame
+    return kind == 'open_template' and ''.join(parts[0]).replace(' ', '').replace('_', '').lower() == '#tag:tabber'
+
+
+def find_missing_dialogue_lines(quests, renderer=None):
+    """
+    Check that rendering keeps the dialogue: every '''Speaker:''' line of a Section_Dialogue, rendered on
+    its own, has to appear in the rendered section, including the lines inside nested tabber options.
+    :return: List of (Quest_Name, source line) for the lines missing from the rendered text.
+    """
+    renderer = renderer or WikitextRenderer()
+    missing = []
+    for quest in quests:
+        section_dialogue = quest.get('Section_Dialogue')
+        if not isinstance(section_dialogue, str):
+            continue
+        rendered = renderer.render(section_dialogue)
+        for line in section_dialogue.split('\n'):
+            # The last line of a tabber option also closes it, those braces belong to the tabber
+            while line.rstrip().endswith('}}') and line.count('}}') > line.count('{{'):
+                line = line.rstrip()[:-2]
+            if extract_speaker_and_text(line)[0] and renderer.render(line) not in rendered:
+                missing.append((quest.get('Quest_Name'), line))
+    return missing
+
+
+class WikitextRenderer:
+    """
+    Renders wikitext to plain text with a single regex tokenizer instead of the wikitextparser object model:
+    links become their label, bold and italic quotes, references, comments, HTML tags and list markers
+    are dropped, and templates keep only the text of the few that carry content (Wiki, c, tabber, IUNote).
+    Nested links and templates are resolved with a stack of open frames, each holding its arguments.
+    Rendered text is memoized by a hash of the source, so repeated descriptions and dialogue lines,
+    e.g. across merged corpora, are only tokenized once.
+    """
+
+    def __init__(self, cache=None, max_cache_size=65536):
+        self.cache = cache if cache is not None else FragmentCache(max_size=max_cache_size)
+
+    @staticmethod
+    def render_uncached(text):
+        output = []
+        stack = []  # open frames as (kind, list of arguments, each a list of text pieces)
+        current = output
+        position = 0
+        for match in token_pattern.finditer(text):
+            if match.start() > position:
+                current.append(text[position:match.start()])
+            position = match.end()
+            kind = match.lastgroup  # The outer group of each alternative, it closes after its inner groups
+
+            if kind == 'text':
+                current.append(match.group())
+            elif kind == 'open_link' or kind == 'open_template':
+                stack.append((kind, [[]]))
+                current = stack[-1][1][-1]
+            elif kind == 'close_link' or kind == 'close_template':
+                expected = 'open_link' if kind == 'close_link' else 'open_template'
+                if not stack or stack[-1][0] != expected:
+                    current.append(match.group())  # Unbalanced brackets are kept as text
+                    continue
+                _, parts = stack.pop()
+                current = stack[-1][1][-1] if stack else output
+                current.append(render_link(parts) if kind == 'close_link' else render_template(parts))
+            elif kind == 'pipe':
+                if stack:
+                    stack[-1][1].append([])
+                    current = stack[-1][1][-1]
+                else:
+                    current.append('|')
+            elif kind == 'tab' and stack and is_tabber_frame(stack[-1]):
+                # {{!}}-{{!}} separates the options of a {{#tag:tabber}} like a pipe
+                stack[-1][1].append([])
+                current = stack[-1][1][-1]
+            elif kind == 'tab' or kind == 'line_break':
+                current.append('\n')
+            elif kind == 'nowiki':
+                current.append(match.group('nowiki_text'))
+            elif kind == 'external_link':
+                current.append(match.group('external_label') or '')
+            elif kind == 'entity':
+                current.append(html.unescape(match.group()))
+            elif kind == 'quotes':
+                # '' and ''' toggle italic and bold, '''' is an apostrophe before bold, extra quotes are text
+                quotes = len(match.group())
+                current.append("'" if quotes == 4 else "'" * max(0, quotes - 5))
+        if position < len(text):
+            current.append(text[position:])
+
+        # Frames left open at the end of the text are written back as they were
+        while stack:
+            kind, parts = stack.pop()
+            opening = '[[' if kind == 'open_link' else '{{'
+            source = opening + '|'.join(''.join(part) for part in parts)
+            (stack[-1][1][-1] if stack else output).append(source)
+
+        rendered = spaces_pattern.sub(' ', ''.join(output))
+        rendered = '\n'.join(line.strip() for line in rendered.split('\n'))
+        return blank_lines_pattern.sub('\n\n', rendered).strip()
+
+    def render(self, text):
+        """
+        :param text: Wikitext, e.g. a General_Description, a Section_* value or a dialogue segment content.
+        :return: Plain text, non-string values are returned unchanged.
+        """
+        if not isinstance(text, str) or not text:
+            return text
+        return self.cache.get_or_render('plaintext', text, self.render_uncached)
+
+    @metrics.timed()
+    def render_quests(self, data, include_dialogue=True, output_key='Plaintext'):
+        """
+        Render the text fields of every quest and store them as derived fields, e.g.
+        quest['Plaintext'] = {'General_Description': ..., 'Section_Description': ..., 'Structured_Dialogue': [...]}.
+        The source fields are left untouched, so the markup stays available for parsing.
+        :param data: List of quests, e.g. DataManipulator.data.
+        :param include_dialogue: Also render the content of every Structured_Dialogue segment, in segment order.
+        :return: Number of rendered fields.
+        """
+        rendered_fields = 0
+        for quest in data:
+            plaintext = {}
+            for key, value in quest.items():
+                if (key == 'General_Description' or key.startswith('Section_')) and isinstance(value, str):
+                    plaintext[key] = self.render(value)
+            structured_dialogue = quest.get('Structured_Dialogue')
+            if include_dialogue and structured_dialogue:
+                plaintext['Structured_Dialogue'] = [self.render(segment['content']) for segment in structured_dialogue]
+            quest[output_key] = plaintext
+            rendered_fields += len(plaintext)
+        metrics.add_items(len(data))
+        metrics.increment('plaintext.fields_rendered', rendered_fields)
+        return rendered_fields
+
+    def get_statistics(self):
+        return self.cache.get_statistics()
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import json
+    from DataManipulator import DataManipulator
+
+    # Nested tabbers hold whole branches of dialogue, none of their lines may be lost by rendering
+    nested_tabbers_folder = "../Quests/GroupedByComplexity/quests_with_nested_tabbers"
+    if os.path.isdir(nested_tabbers_folder):
+        nested_tabber_quests = []
+        for file in sorted(os.listdir(nested_tabbers_folder)):
+            with open(os.path.join(nested_tabbers_folder, file), 'r', encoding='utf-8') as f:
+                nested_tabber_quests.append(json.load(f))
+        missing_lines = find_missing_dialogue_lines(nested_tabber_quests)
+        assert not missing_lines, missing_lines[:10]
+        print(f"Every dialogue line of {len(nested_tabber_quests)} quests with nested tabbers is rendered")
+
+    data_manipulator = DataManipulator(sys.argv[1] if len(sys.argv) > 1 else "OdysseyChapterAndSequenceStructuredDialogue.json")
+    wikitext_renderer = WikitextRenderer()
+    print(f"Rendered {wikitext_renderer.render_quests(data_manipulator.data)} fields")
+    print(wikitext_renderer.get_statistics())
+    data_manipulator.save_json("OdysseyPlaintext.json")
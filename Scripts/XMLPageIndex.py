@@ -0,0 +1,172 @@
+import os
+import re
+import html
+import json
+import mmap
+import bisect
+from array import array
+
+from Metrics import metrics
+
+
+page_start_tag = b'<page>'
+page_end_tag = b'</page>'
+root_tag_pattern = re.compile(rb'<mediawiki\b[^>]*>')
+title_pattern = re.compile(rb'<title>(.*?)</title>', re.DOTALL)
+page_id_pattern = re.compile(rb'<id>\s*(\d+)\s*</id>')
+# The title and page id come before the first revision, only this much of a page is searched for them
+page_header_size = 4096
+
+
+class XMLPageIndex:
+    """
+    Byte offsets of every <page> element of a MediaWiki XML dump with its title and page id (the Quest_ID),
+    found by one scan of the memory mapped file for the page tags. Saved next to the dump, it lets
+    XMLParser parse single pages without building the tree of the whole dump, and split the dump into
+    byte ranges at page boundaries for parallel workers.
+    """
+
+    def __init__(self, xml_file_path):
+        self.xml_file_path = xml_file_path
+        self.titles = []
+        self.page_ids = []
+        self.starts = array('Q')  # Byte offset of <page>
+        self.ends = array('Q')  # Byte offset just after </page>
+        self.root_tag = b''  # <mediawiki ...> start tag, it declares the namespace the pages are parsed in
+        self.xml_file_size = 0
+        self.xml_file_mtime_ns = 0
+        self.positions_by_title = {}
+        self.positions_by_id = {}
+
+    @staticmethod
+    def get_default_index_path(xml_file_path):
+        return xml_file_path + '.index.json'
+
+    @metrics.timed()
+    def build(self):
+        """Scan the dump for its pages. :return: The index itself."""
+        stat = os.stat(self.xml_file_path)
+        self.titles, self.page_ids = [], []
+        self.starts, self.ends = array('Q'), array('Q')
+        with open(self.xml_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            root_match = root_tag_pattern.search(dump, 0, page_header_size)
+            self.root_tag = root_match.group() if root_match else b''
+            start = dump.find(page_start_tag)
+            while start != -1:
+                end = dump.find(page_end_tag, start)
+                if end == -1:  # Truncated dump, the last page is incomplete
+                    break
+                end += len(page_end_tag)
+                header_end = min(end, start + page_header_size)
+                title_match = title_pattern.search(dump, start, header_end)
+                id_match = page_id_pattern.search(dump, start, header_end)
+                self.titles.append(html.unescape(title_match.group(1).decode('utf-8')).strip() if title_match else None)
+                self.page_ids.append(id_match.group(1).decode('ascii') if id_match else None)
+                self.starts.append(start)
+                self.ends.append(end)
+                start = dump.find(page_start_tag, end)
+        self.xml_file_size = stat.st_size
+        self.xml_file_mtime_ns = stat.st_mtime_ns
+        self.build_lookups()
+        metrics.add_items(len(self.starts))
+        metrics.increment('xml.pages_indexed', len(self.starts))
+        return self
+
+    def build_lookups(self):
+        self.positions_by_title = {}
+        self.positions_by_id = {}
+        for position, (title, page_id) in enumerate(zip(self.titles, self.page_ids)):
+            self.positions_by_title.setdefault(title, position)
+            self.positions_by_id.setdefault(page_id, position)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_current(self):
+        """Whether the dump is unchanged since the index was built, judged by its size and modification time."""
+        try:
+            stat = os.stat(self.xml_file_path)
+        except OSError:
+            return False
+        return stat.st_size == self.xml_file_size and stat.st_mtime_ns == self.xml_file_mtime_ns
+
+    def save(self, index_path=None):
+        index_path = index_path or self.get_default_index_path(self.xml_file_path)
+        index = {
+            'xml_file_size': self.xml_file_size,
+            'xml_file_mtime_ns': self.xml_file_mtime_ns,
+            'root_tag': self.root_tag.decode('utf-8'),
+            'pages': [[title, page_id, start, end]
+                      for title, page_id, start, end in zip(self.titles, self.page_ids, self.starts, self.ends)],
+        }
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        return index_path
+
+    @classmethod
+    def load(cls, xml_file_path, index_path=None):
+        with open(index_path or cls.get_default_index_path(xml_file_path), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        page_index = cls(xml_file_path)
+        page_index.xml_file_size = index['xml_file_size']
+        page_index.xml_file_mtime_ns = index['xml_file_mtime_ns']
+        page_index.root_tag = index['root_tag'].encode('utf-8')
+        for title, page_id, start, end in index['pages']:
+            page_index.titles.append(title)
+            page_index.page_ids.append(page_id)
+            page_index.starts.append(start)
+            page_index.ends.append(end)
+        page_index.build_lookups()
+        return page_index
+
+    @classmethod
+    def load_or_build(cls, xml_file_path, index_path=None):
+        """Load the saved index, or scan the dump and save the index when there is none or the dump changed."""
+        index_path = index_path or cls.get_default_index_path(xml_file_path)
+        if os.path.exists(index_path):
+            page_index = cls.load(xml_file_path, index_path)
+            if page_index.is_current():
+                return page_index
+            print(f"{xml_file_path} changed since {index_path} was built, rebuilding the page index")
+        page_index = cls(xml_file_path).build()
+        page_index.save(index_path)
+        print(f"Indexed {len(page_index)} pages of {xml_file_path} in {index_path}")
+        return page_index
+
+    def get_position(self, title=None, page_id=None):
+        """:return: Position of the page with a title or page id, or None."""
+        if page_id is not None:
+            return self.positions_by_id.get(str(page_id))
+        return self.positions_by_title.get(title)
+
+    def get_byte_ranges(self, part_count):
+        """
+        Split the pages into at most part_count contiguous runs of about the same number of bytes.
+        :return: List of (start, end) byte ranges, each starting at a <page> and ending after a </page>.
+        """
+        if not self.starts:
+            return []
+        total_size = self.ends[-1] - self.starts[0]
+        ranges = []
+        range_start = 0
+        for position in range(len(self.starts)):
+            target = self.starts[0] + total_size * (len(ranges) + 1) / part_count
+            if self.ends[position] >= target or position == len(self.starts) - 1:
+                ranges.append((self.starts[range_start], self.ends[position]))
+                range_start = position + 1
+        return ranges
+
+    def get_positions_in_range(self, start, end):
+        """:return: range of the positions of the pages lying within a byte range."""
+        first = bisect.bisect_left(self.starts, start)
+        return range(first, max(first, bisect.bisect_right(self.ends, end)))
+
+
+if __name__ == "__main__":
+    import sys
+
+    xml_file_path = sys.argv[1] if len(sys.argv) > 1 else "Datasets/MainDatabaseNew.xml"
+    page_index = XMLPageIndex(xml_file_path).build()
+    print(f"Saved the offsets of {len(page_index)} pages to {page_index.save()}")
+    for start, end in page_index.get_byte_ranges(4):
+        print(f"Pages {start}-{end}: {len(page_index.get_positions_in_range(start, end))}")
@@ -1,18 +1,38 @@
-import imp
 import xml.etree.ElementTree as ET
 import random
 import json
-import wikitextparser as wtp
 import re
+import os
+import mmap
+
+from Metrics import metrics
+from SectionKeyCanonicalizer import SectionKeyCanonicalizer
+from XMLPageIndex import XMLPageIndex
+from CheckpointJournal import CheckpointJournal
 
 
 class XMLParser:
     def __init__(self, xml_file_path, namespaces=None):
         self.namespaces = namespaces or {'mw': 'http://www.mediawiki.org/xml/export-0.11/'}
-        self.root = self.get_xml_root(xml_file_path)
+        self.xml_file_path = xml_file_path
+        self._root = None  # The whole dump is only parsed when all pages are needed
+        self.page_index = None
         self.total_pages = 0
         self.failed_quests = []
         self.quests_without_infobox = []  # List to hold quests without Memory Infobox
+        self.section_keys = SectionKeyCanonicalizer()  # Shared across pages so each distinct title is resolved once
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = self.get_xml_root(self.xml_file_path)
+        return self._root
+
+    def get_page_index(self, index_path=None):
+        """Byte offsets of the pages, built by one scan of the dump the first time and saved next to it."""
+        if self.page_index is None:
+            self.page_index = XMLPageIndex.load_or_build(self.xml_file_path, index_path)
+        return self.page_index
 
     def get_xml_root(self, xml_file_path):
         try:
@@ -47,29 +67,110 @@ class XMLParser:
             sanitized_name = "Tag_" + sanitized_name
         return sanitized_name
 
-    def parse_all_pages(self, limit=None, random_selection=False):
+    @metrics.timed()
+    def parse_all_pages(self, limit=None, random_selection=False, journal_path=None, checkpoint_interval=100,
+                        resume=False):
+        """
+        :param journal_path: Optional CheckpointJournal file the parsed quests are written to as they are done.
+        :param checkpoint_interval: Number of parsed pages between two writes of the journal.
+        :param resume: Take the pages already in the journal from it instead of parsing them again.
+        """
         all_quests = []
         pages = list(self.root.findall('.//mw:page', namespaces=self.namespaces))
 
         if random_selection and limit:
             pages = random.sample(pages, min(limit, len(pages)))
 
-        for page in pages[:limit]:
-            self.total_pages += 1
-            quest = self.parse_page(page)
-            if quest:
-                all_quests.append(quest)
-
-        # Generate typo dict and fix typos in keys
-        all_keys = set().union(*(d.keys() for d in all_quests))
-        typo_dict = self.generate_typo_dict_keys(all_keys)
-        all_quests = self.fix_typos_in_keys(all_quests, typo_dict)
+        journal = None
+        if journal_path:
+            stat = os.stat(self.xml_file_path)
+            journal = CheckpointJournal(journal_path, 'XMLParser.parse_all_pages', [stat.st_size, stat.st_mtime_ns],
+                                        checkpoint_interval, resume)
+        try:
+            for page in pages[:limit]:
+                self.total_pages += 1
+                page_id = page.findtext('mw:id', namespaces=self.namespaces) if journal else None
+                if journal and journal.is_done(page_id):
+                    quest = journal.get_output(page_id)
+                    # parse_text always sets General_Description, a quest without it had no text
+                    if 'General_Description' in quest and not quest.get('MemoryInfobox'):
+                        self.quests_without_infobox.append(quest)
+                else:
+                    quest = self.parse_page(page)
+                    if quest and journal:  # Failed pages are not recorded, so a resumed run reports them again
+                        journal.record(page_id, quest)
+                if quest:
+                    all_quests.append(quest)
+        finally:
+            if journal:
+                journal.close()
+
+        metrics.add_items(len(pages[:limit]))
+        metrics.increment('xml.pages_parsed', len(pages[:limit]))
+        metrics.increment('xml.pages_failed', len(pages[:limit]) - len(all_quests))
+        metrics.increment('xml.section_variants', sum(self.section_keys.variant_counts.values()))
+
+        # Section keys are canonicalized while parsing, only report the variants that were merged
+        self.section_keys.print_report()
 
         return all_quests
 
+    @metrics.timed()
+    def parse_pages(self, titles=(), quest_ids=()):
+        """
+        Parse only the requested pages, e.g. to debug one quest, by reading them at their offsets in the
+        memory mapped dump.
+        :param titles: Page titles, i.e. Quest_Name values.
+        :param quest_ids: Page ids, i.e. Quest_ID values.
+        :return: List of quests in the order requested, pages that are not in the dump are reported and skipped.
+        """
+        page_index = self.get_page_index()
+        positions = []
+        for title in titles:
+            positions.append((title, page_index.get_position(title=title)))
+        for quest_id in quest_ids:
+            positions.append((quest_id, page_index.get_position(page_id=quest_id)))
+        for requested, position in positions:
+            if position is None:
+                print(f"Page {requested!r} not found in {self.xml_file_path}")
+        return self.parse_positions([position for _, position in positions if position is not None])
+
+    @metrics.timed()
+    def parse_byte_range(self, start, end):
+        """
+        Parse the pages within a byte range from XMLPageIndex.get_byte_ranges, so workers can each take a range.
+        :return: List of quests in dump order.
+        """
+        return self.parse_positions(self.get_page_index().get_positions_in_range(start, end))
+
+    def parse_positions(self, positions):
+        page_index = self.get_page_index()
+        # A page parsed on its own still needs the namespace declaration of the dump
+        root_tag = page_index.root_tag or f'<mediawiki xmlns="{self.namespaces["mw"]}">'.encode('utf-8')
+        quests = []
+        with open(self.xml_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            for position in positions:
+                page_bytes = dump[page_index.starts[position]:page_index.ends[position]]
+                try:
+                    page = ET.fromstring(root_tag + page_bytes + b'</mediawiki>').find('mw:page', namespaces=self.namespaces)
+                except ET.ParseError as e:
+                    print(f"Error parsing page {page_index.titles[position]!r}: {e}")
+                    page = None
+                self.total_pages += 1
+                quest = self.parse_page(page) if page is not None else None
+                if quest:
+                    quests.append(quest)
+                metrics.increment('bytes_read', len(page_bytes))
+        metrics.add_items(len(positions))
+        metrics.increment('xml.pages_parsed', len(positions))
+        metrics.increment('xml.pages_failed', len(positions) - len(quests))
+        return quests
+
+    @metrics.timed()
     def save_to_json(self, data, file_path):
         with open(file_path, 'w') as f:
             json.dump(data, f, indent=4)
+            metrics.increment('bytes_written', f.tell())
 
     def parse_page(self, page):
         try:
@@ -113,6 +214,8 @@ class XMLParser:
         return revision_data
 
     def parse_text(self, text_content, quest):
+        import wikitextparser as wtp  # Imported here so loading the module stays fast
+
         parsed = wtp.parse(text_content)
 
         # Find the start index of the first section
@@ -142,14 +245,15 @@ class XMLParser:
         general_description = text_content[infobox_end_index:first_section_start].strip()
         quest['General_Description'] = general_description
 
-        
-        
-        # Extract Sections
+        # Extract Sections, misspelled titles like 'Behind the scnes' are stored under their canonical key
         for section in parsed.sections:
             if section.title:
-                section_title = section.title.strip().replace(' ', '_')
-                if section_title:
-                    quest[f'Section_{section_title}'] = section.contents.strip()
+                section_key = self.section_keys.canonicalize(section.title)
+                if section_key in quest and section_key != self.section_keys.get_plain_key(section.title):
+                    # A variant never replaces a section the page already has, it keeps its own spelling
+                    section_key = self.section_keys.get_plain_key(section.title)
+                if section_key:
+                    quest[section_key] = section.contents.strip()
 
     def parse_tags(self, text_content, quest, tag_category):
         tags = re.findall(r'{{(.*?)}}', text_content, re.DOTALL)
@@ -165,43 +269,6 @@ class XMLParser:
             tag_content = self.sanitize_text(' | '.join(tag_parts[1:]))
             quest[tag_category][f'Tag_{tag_name}'] = {"description": tag_content}
 
-    def generate_typo_dict_keys(self, all_keys):
-        # Here you can write logic to automatically generate typo_dict based on all_keys
-        # Or you can manually create this dict
-        typo_dict = {
-            'Section_Behind_the_Scenes': 'Section_Behind_the_scenes',
-            'Section_Behind_the_scenes_': 'Section_Behind_the_scenes',
-            'Section_Behind_the_scnes': 'Section_Behind_the_scenes',
-            'Section_Description_': 'Section_Description',
-            'Section_Dialogue_': 'Section_Dialogue',
-            'Section__Behind_the_scenes_': 'Section_Behind_the_scenes',
-            'Section__Description': 'Section_Description',
-            'Section__Dialogue': 'Section_Dialogue',
-            'Section__Gallery': 'Section_Gallery',
-            'Section__Gallery_': 'Section_Gallery',
-            'Section__Outcome': 'Section_Outcome',
-            'Section__Outcome_': 'Section_Outcome',
-            'Section__References': 'Section_References',
-            'Section__References_': 'Section_References',
-            'Section_Reference': 'Section_References',
-            'Section_Trivia': 'Section_Trivia',
-            'Section__Trivia_': 'Section_Trivia',
-            'Section_Message': 'Section_Messages',
-            'Section_Outcome_': 'Section_Outcome',
-        }
-        return typo_dict
-
-    def fix_typos_in_keys(self, json_data, typo_dict):
-        corrected_data = []
-        for quest in json_data:
-            corrected_quest = {}
-            for key, value in quest.items():
-                corrected_key = typo_dict.get(key,
-                                              key)  # Get the corrected key if exists, otherwise use the original key
-                corrected_quest[corrected_key] = value
-            corrected_data.append(corrected_quest)
-        return corrected_data
-
     def save_quests_without_infobox(self, file_path):
         with open(file_path, 'w') as f:
             json.dump(self.quests_without_infobox, f, indent=4)
@@ -222,33 +289,34 @@ class XMLParser:
         print(f"Unique keys in quests without infobox: {len(unique_keys)}")
         print(f"Keys: {', '.join(unique_keys)}")
         
-xml_file_path = "Datasets/MainDatabaseNew.xml"
+if __name__ == "__main__":
+    xml_file_path = "Datasets/MainDatabaseNew.xml"
 
-# Example usage
-xml_parser = XMLParser(xml_file_path)
-quests = xml_parser.parse_all_pages(limit=2, random_selection=True)
-all_quests = xml_parser.parse_all_pages()
-key_counts = xml_parser.count_key_occurrences(all_quests)
+    # Example usage
+    xml_parser = XMLParser(xml_file_path)
+    quests = xml_parser.parse_all_pages(limit=2, random_selection=True)
+    all_quests = xml_parser.parse_all_pages()
+    key_counts = xml_parser.count_key_occurrences(all_quests)
 
 
-# Example usage
-xml_parser.print_unique_keys_info()
-xml_parser.save_to_json(all_quests, "Memories relived using the Animus HR-8.5.json")
-print(xml_parser.count_unique_keys(all_quests))
-print(xml_parser.get_unique_keys(all_quests))
-print(f"Total quests: {xml_parser.total_pages}")
-xml_parser.save_quests_without_infobox("quests_without_infobox.json")
-print(f"Quests without infobox: {len(xml_parser.quests_without_infobox)}")
+    # Example usage
+    xml_parser.print_unique_keys_info()
+    xml_parser.save_to_json(all_quests, "Memories relived using the Animus HR-8.5.json")
+    print(xml_parser.count_unique_keys(all_quests))
+    print(xml_parser.get_unique_keys(all_quests))
+    print(f"Total quests: {xml_parser.total_pages}")
+    xml_parser.save_quests_without_infobox("quests_without_infobox.json")
+    print(f"Quests without infobox: {len(xml_parser.quests_without_infobox)}")
 
 
-for key, count in key_counts.items():
-    print(f"{key}: {count}")
-    
-files_without_questname = []
-for quest in all_quests:
-    if 'QuestName' not in quest:
-        files_without_questname.append(quest)
+    for key, count in key_counts.items():
+        print(f"{key}: {count}")
+
+    files_without_questname = []
+    for quest in all_quests:
+        if 'QuestName' not in quest:
+            files_without_questname.append(quest)
 
-print(f"Number of files without QuestName: {len(files_without_questname)}")
+    print(f"Number of files without QuestName: {len(files_without_questname)}")
 
-print(f"Number of failed quests: {len(xml_parser.failed_quests)}")
\ No newline at end of file
+    print(f"Number of failed quests: {len(xml_parser.failed_quests)}")